@@ -0,0 +1,3 @@
+# The Celery app (qr_project.celery) is not loaded here: web workers only
+# need it to queue a batch, and qrgen.tasks imports it then. Celery workers
+# started with ``celery -A qr_project`` find it by its module name.
@@ -0,0 +1,17 @@
+"""
+Celery config for qr_project.
+
+Workers are started with ``celery -A qr_project worker`` and read every
+``CELERY_*`` setting from Django's settings. Web workers import this module
+through qrgen.tasks, the first time a batch is queued, so that Celery,
+kombu and amqp stay out of their startup.
+"""
+
+import os
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'qr_project.settings')
+
+app = Celery('qr_project')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
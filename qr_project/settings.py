@@ -12,7 +12,6 @@ https://docs.djangoproject.com/en/4.x/ref/settings/
 
 import os
 from pathlib import Path
-from mongoengine import connect
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -44,7 +43,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # WhiteNoise that does not force the views below it into a thread under ASGI
+    'qrgen.middleware.AsyncWhiteNoiseMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -71,6 +71,8 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'qr_project.wsgi.application'
+# What production serves (see the Procfile); measured by `manage.py startup_report`
+ASGI_APPLICATION = 'qr_project.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.x/ref/settings/#databases
@@ -83,18 +85,9 @@ DATABASES = {
         }
     }
 
-# MongoDB connection for Railway (if using MongoDB)
-import mongoengine
+# MongoDB connection for Railway (if using MongoDB). qrgen.mongo connects on
+# first use so that booting a worker never waits for the server
 MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/qrgen')
-try:
-    mongoengine.connect(host=MONGODB_URI)
-    MONGODB_AVAILABLE = True
-    print("MongoDB connected successfully")
-except Exception as e:
-    print(f"MongoDB connection failed: {e}")
-    print("Continuing without MongoDB - using Django ORM instead")
-    MONGODB_AVAILABLE = False
-    # Continue without MongoDB if not available
 
 # Password validation
 # https://docs.djangoproject.com/en/4.x/ref/settings/#auth-password-validators
@@ -145,5 +138,60 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CELERY_BROKER_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
-
-DATA_UPLOAD_MAX_NUMBER_FILES = 2000  # or any number you need
\ No newline at end of file
+# Run tasks inline instead of sending them to the broker (tests, local development without Redis)
+CELERY_TASK_ALWAYS_EAGER = os.environ.get('CELERY_TASK_ALWAYS_EAGER', 'False') == 'True'
+CELERY_TASK_EAGER_PROPAGATES = True
+
+# Larger batches can be uploaded as one zip or tar archive (qr_archive), which is
+# a single file however many QR images it holds
+DATA_UPLOAD_MAX_NUMBER_FILES = 2000  # or any number you need
+# Stream every uploaded file to a temporary file instead of keeping small ones
+# in memory; FileSystemStorage then moves it into MEDIA_ROOT without a copy
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+
+# QR block rendering
+# Processes in the long-lived render pool of each web worker (0 or 1 = render in the request thread)
+QRGEN_RENDER_WORKERS = int(os.environ.get('QRGEN_RENDER_WORKERS', os.cpu_count() or 1))
+# QR blocks sent to a render process per task
+QRGEN_RENDER_CHUNK_SIZE = int(os.environ.get('QRGEN_RENDER_CHUNK_SIZE', 8))
+# Send the PDF page by page with StreamingHttpResponse instead of buffering the whole document
+QRGEN_STREAM_PDF = os.environ.get('QRGEN_STREAM_PDF', 'False') == 'True'
+# Default block encoding when the form leaves it blank: 'flate' (lossless), 'jpeg' or '1bit'
+QRGEN_BLOCK_ENCODING = os.environ.get('QRGEN_BLOCK_ENCODING', 'flate')
+QRGEN_JPEG_QUALITY = int(os.environ.get('QRGEN_JPEG_QUALITY', 85))
+# Default output format when the form leaves it blank: 'pdf', or 'pdf_raster', 'tiff'
+# or 'png' to composite every page into a single image (see qrgen.sheets)
+QRGEN_OUTPUT_FORMAT = os.environ.get('QRGEN_OUTPUT_FORMAT', 'pdf')
+# Rendered block cache: in-process LRU size (0 disables the cache) and an optional
+# on-disk tier shared by all workers on the host
+QRGEN_BLOCK_CACHE_MAX_BYTES = int(os.environ.get('QRGEN_BLOCK_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+QRGEN_BLOCK_CACHE_DIR = os.environ.get('QRGEN_BLOCK_CACHE_DIR') or None
+QRGEN_BLOCK_CACHE_DIR_MAX_BYTES = int(os.environ.get('QRGEN_BLOCK_CACHE_DIR_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+# SVG uploads parsed (or rasterized by cairosvg) per process, by content
+QRGEN_SVG_MEMO_ENTRIES = int(os.environ.get('QRGEN_SVG_MEMO_ENTRIES', 512))
+# Timing metrics: clients allowed to read /metrics/, and cProfile dumps of the
+# N slowest PDF downloads per QRGEN_PROFILE_DIR (0 disables profiling)
+QRGEN_METRICS_ALLOWED_IPS = os.environ.get('QRGEN_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+QRGEN_PROFILE_SLOWEST = int(os.environ.get('QRGEN_PROFILE_SLOWEST', 0))
+QRGEN_PROFILE_DIR = os.environ.get('QRGEN_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+# Budget checked by `manage.py startup_report`: time to import the ASGI
+# application and load the URLconf, and the resulting resident memory
+QRGEN_STARTUP_MAX_SECONDS = float(os.environ.get('QRGEN_STARTUP_MAX_SECONDS', 1.5))
+QRGEN_STARTUP_MAX_RSS_MB = float(os.environ.get('QRGEN_STARTUP_MAX_RSS_MB', 120))
+# Upload limits: per QR image, per batch (all QR images together, also checked
+# against Content-Length before the body is parsed) and per image in pixels,
+# and the threads that read the image headers
+QRGEN_MAX_QR_FILE_BYTES = int(os.environ.get('QRGEN_MAX_QR_FILE_BYTES', 5 * 1024 * 1024))
+QRGEN_MAX_BATCH_BYTES = int(os.environ.get('QRGEN_MAX_BATCH_BYTES', 512 * 1024 * 1024))
+QRGEN_MAX_QR_PIXELS = int(os.environ.get('QRGEN_MAX_QR_PIXELS', 4096 * 4096))
+QRGEN_UPLOAD_VALIDATION_THREADS = int(os.environ.get('QRGEN_UPLOAD_VALIDATION_THREADS', 8))
+# Finished PDFs are stored under a content hash and served from storage on
+# re-download; they are deleted this many seconds after rendering (0 keeps them)
+QRGEN_PDF_RETENTION_SECONDS = int(os.environ.get('QRGEN_PDF_RETENTION_SECONDS', 7 * 24 * 3600))
+# Async views (ASGI): batches rendered at once per worker process, and seconds a
+# download waits for a free slot before it is refused with 503
+QRGEN_MAX_CONCURRENT_RENDERS = int(os.environ.get('QRGEN_MAX_CONCURRENT_RENDERS', 2))
+QRGEN_RENDER_QUEUE_TIMEOUT = float(os.environ.get('QRGEN_RENDER_QUEUE_TIMEOUT', 30))
+# Batches longer than this many pages save a checkpoint every this many pages while
+# rendering, so a retry after a worker timeout resumes there (0 disables checkpoints)
+QRGEN_CHECKPOINT_PAGES = int(os.environ.get('QRGEN_CHECKPOINT_PAGES', 20))
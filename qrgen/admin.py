@@ -1,5 +1,8 @@
-# from django.contrib import admin
-# from .models import QRBatch, QRCode  # Replace with your actual model name
+from django.contrib import admin
+from .models import LogoPreset
 
-# admin.site.register(QRBatch)  # Register your model with the admin site
-# admin.site.register(QRCode)  # Register your model with the admin site
\ No newline at end of file
+
+@admin.register(LogoPreset)
+class LogoPresetAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'created_at')
+    readonly_fields = ('digest',)
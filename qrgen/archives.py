@@ -0,0 +1,108 @@
+"""
+Zip or tar archives of QR images. The archive is stored as uploaded, and
+rendering reads its members one at a time in archive order without ever
+extracting it. An upload is checked from the member headers alone, so a
+batch of any number of QR images is one file to the multipart parser.
+"""
+import logging
+import posixpath
+import tarfile
+import zipfile
+import zlib
+from django.conf import settings
+from django.template.defaultfilters import filesizeformat
+from .uploads import QR_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+# Errors raised by zipfile/tarfile (and the decompressors below them) for a
+# corrupt or truncated archive
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError, zlib.error, RuntimeError)
+
+
+def _iter_members(archive_file):
+    """(name, size, read) of every regular file in the archive, in archive order."""
+    archive_file.seek(0)
+    if zipfile.is_zipfile(archive_file):
+        archive_file.seek(0)
+        with zipfile.ZipFile(archive_file) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda info=info: archive.read(info)
+        return
+    archive_file.seek(0)
+    # Stream mode reads the tar (compressed or not) front to back once; a
+    # member can only be read before moving on to the next one
+    with tarfile.open(fileobj=archive_file, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, member.size, lambda member=member: archive.extractfile(member).read()
+
+
+def _is_ignored(name):
+    """Folders and metadata added by archivers (e.g. macOS), not uploads."""
+    base = posixpath.basename(name)
+    return not base or base.startswith('.') or name.startswith('__MACOSX/')
+
+
+def _member_reason(name, size):
+    ext = name.rsplit('.', 1)[-1].lower() if '.' in posixpath.basename(name) else ''
+    if ext not in QR_EXTENSIONS:
+        return "unsupported file type"
+    if size > settings.QRGEN_MAX_QR_FILE_BYTES:
+        return "larger than %s" % filesizeformat(settings.QRGEN_MAX_QR_FILE_BYTES)
+    return None
+
+
+def scan_qr_archive(upload):
+    """
+    Check an uploaded archive from its member headers.
+
+    Returns (number of QR images, report, error) like validate_qr_uploads:
+    the report has one entry for the archive followed by its rejected
+    members, and ``error`` is set when the archive is over the batch limit.
+    """
+    entry = {'name': upload.name, 'size': upload.size, 'accepted': False, 'reason': None, 'members': 0}
+    rejected = []
+    total = 0
+    if upload.size > settings.QRGEN_MAX_BATCH_BYTES:
+        return 0, [entry], "The archive is larger than the %s allowed per batch." % (
+            filesizeformat(settings.QRGEN_MAX_BATCH_BYTES))
+    try:
+        for name, size, _ in _iter_members(upload):
+            if _is_ignored(name):
+                continue
+            reason = _member_reason(name, size)
+            if reason:
+                rejected.append({'name': name, 'size': size, 'accepted': False, 'reason': reason})
+                continue
+            entry['members'] += 1
+            total += size
+            if total > settings.QRGEN_MAX_BATCH_BYTES:
+                # Checked on the unpacked sizes, so a small archive cannot expand without bound
+                return 0, [entry], "The archive unpacks to more than the %s allowed per batch." % (
+                    filesizeformat(settings.QRGEN_MAX_BATCH_BYTES))
+    except ARCHIVE_ERRORS:
+        entry['reason'] = "not a readable zip or tar archive"
+        return 0, [entry], None
+    finally:
+        upload.seek(0)
+    if not entry['members']:
+        entry['reason'] = "no QR images in the archive"
+    entry['accepted'] = entry['reason'] is None
+    return entry['members'], [entry] + rejected, None
+
+
+def iter_archive_qr_data(archive_file):
+    """Yield the bytes of the QR images in a stored archive, one member at a time."""
+    try:
+        for name, size, read in _iter_members(archive_file):
+            if _is_ignored(name) or _member_reason(name, size):
+                continue
+            try:
+                yield read()
+            except ARCHIVE_ERRORS:
+                logger.warning("Skipping unreadable archive member %s", name)
+    except ARCHIVE_ERRORS:
+        # Only reachable if the stored archive changed after it was checked
+        logger.exception("Reading the QR archive stopped early")
@@ -0,0 +1,255 @@
+"""
+Rendering for the async views. Drawing a PDF is CPU-bound, so it runs on a
+small pool of render threads (the QR blocks themselves still go to the
+render process pool) while the event loop keeps accepting uploads and
+streaming responses.
+
+At most QRGEN_MAX_CONCURRENT_RENDERS batches render at once per worker
+process. Further downloads wait up to QRGEN_RENDER_QUEUE_TIMEOUT seconds for
+a slot and are then refused, so a burst of clients queues up instead of
+every render slowing down and memory growing with the number of clients.
+
+Code run in the render threads must not use the database: Django keeps a
+connection per thread, and a test case's data is only visible to its own.
+"""
+import asyncio
+import contextvars
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .metrics import profiling
+
+# Finished chunks a render may get ahead of a slow client
+STREAM_QUEUE_CHUNKS = 4
+
+_executor = None
+_slots = None
+_lock = threading.Lock()
+_END = object()
+
+
+class RenderBusy(Exception):
+    """No render slot became free within QRGEN_RENDER_QUEUE_TIMEOUT."""
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class RenderSlots:
+    """
+    Counting semaphore for the render slots. Waiting is awaitable, and
+    release() can be called from any thread (render threads release the
+    slot of a stream): a freed slot is handed straight to the oldest waiter,
+    on that waiter's event loop.
+    """
+
+    def __init__(self, size):
+        self._size = self._free = size
+        self._waiters = deque()  # (loop, future)
+        self._lock = threading.Lock()
+
+    async def acquire(self, timeout):
+        """Take a slot; returns False if none is handed over within ``timeout`` seconds."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return True
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                if self._free >= self._size:
+                    raise ValueError("Render slot released too many times")
+                self._free += 1
+                return
+            loop, future = self._waiters.popleft()
+        try:
+            loop.call_soon_threadsafe(self._hand_over, future)
+        except RuntimeError:
+            # The waiter's loop is closed
+            self.release()
+
+    def _hand_over(self, future):
+        if future.done():
+            # The waiter timed out or was cancelled meanwhile
+            self.release()
+        else:
+            future.set_result(None)
+
+
+def _get_executor():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            size = max(1, settings.QRGEN_MAX_CONCURRENT_RENDERS)
+            _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='qrgen-render')
+            _slots = RenderSlots(size)
+        return _executor, _slots
+
+
+def shutdown_render_executor():
+    """Stop the render threads; the next render starts new ones with the current settings."""
+    global _executor, _slots
+    with _lock:
+        executor, _executor, _slots = _executor, None, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+async def acquire_render_slot():
+    """Wait for a free render slot; raises RenderBusy after QRGEN_RENDER_QUEUE_TIMEOUT."""
+    _, slots = _get_executor()
+    if not await slots.acquire(settings.QRGEN_RENDER_QUEUE_TIMEOUT):
+        raise RenderBusy()
+    return slots
+
+
+def _profiled(func, *args):
+    with profiling():
+        return func(*args)
+
+
+async def run_in_render_thread(func, *args):
+    """Run ``func(*args)`` in a render thread with the caller's context (so its timings and profile count)."""
+    executor, _ = _get_executor()
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, _profiled, func, *args)
+
+
+class RenderStream:
+    """
+    Async iterator, for StreamingHttpResponse, over the chunks of the sync
+    generator returned by ``chunks_factory()``, which runs in a render
+    thread. The render gets at most STREAM_QUEUE_CHUNKS ahead of the client
+    and stops when the client goes away.
+
+    The caller must hold a render slot (acquire_render_slot()); the stream
+    releases it once the render has ended, or on close() if it never started.
+    ``on_complete`` is awaited after the last chunk, before the stream ends;
+    ``on_close`` is called once the stream has ended, whether or not it got
+    that far.
+    """
+
+    def __init__(self, chunks_factory, on_complete=None, on_close=None):
+        self._chunks_factory = chunks_factory
+        self._on_complete = on_complete
+        self._on_close = on_close
+        self._context = contextvars.copy_context()
+        self._executor, self._slots = _get_executor()
+        self._cancelled = threading.Event()
+        self._state_lock = threading.Lock()
+        self._started = self._released = self._closed = False
+        self._loop = self._queue = None
+
+    def _release(self):
+        with self._state_lock:
+            if self._released:
+                return
+            self._released = True
+        self._slots.release()
+
+    def _finish(self):
+        with self._state_lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._on_close is not None:
+            self._on_close()
+
+    def close(self):
+        with self._state_lock:
+            started = self._started
+        if not started:
+            self._release()
+        else:
+            self._cancelled.set()
+            if not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._drain)
+        self._finish()
+
+    def _drain(self):
+        # Unblocks a render thread waiting for room in the queue
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def _put(self, item):
+        future = asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except TimeoutError:
+                if self._cancelled.is_set() or self._loop.is_closed():
+                    future.cancel()
+                    raise _Cancelled()
+
+    def _produce(self):
+        try:
+            with profiling():
+                chunks = self._chunks_factory()
+            try:
+                while True:
+                    # Only the render is profiled, not the wait for the client
+                    with profiling():
+                        chunk = next(chunks, _END)
+                    if chunk is _END:
+                        break
+                    self._put((chunk, None))
+                    if self._cancelled.is_set():
+                        return
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+            self._put((_END, None))
+        except _Cancelled:
+            pass
+        except Exception as exc:
+            if not self._cancelled.is_set():
+                try:
+                    self._put((None, exc))
+                except _Cancelled:
+                    pass
+        finally:
+            self._release()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        # Started by the loop that consumes the stream, which is not always
+        # the one that ran the view (e.g. under WSGI)
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(STREAM_QUEUE_CHUNKS)
+        with self._state_lock:
+            if self._started or self._released:
+                raise RuntimeError("A RenderStream can only be iterated once")
+            self._loop, self._queue = loop, queue
+            self._started = True
+        self._executor.submit(self._context.run, self._produce)
+        try:
+            while True:
+                chunk, error = await self._queue.get()
+                if error is not None:
+                    raise error
+                if chunk is _END:
+                    break
+                yield chunk
+            if self._on_complete is not None:
+                await self._on_complete()
+        finally:
+            self._cancelled.set()
+            self._drain()
+            self._finish()
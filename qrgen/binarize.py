@@ -0,0 +1,135 @@
+"""
+Cleanup of raster QR codes: flatten to grayscale, threshold every pixel to
+black or white and upscale by whole factors with nearest neighbour, so that
+module edges stay crisp and blocks are 1-bit or grayscale instead of RGBA.
+
+Images of the same size are thresholded as one NumPy stack. Without NumPy
+the same steps run image by image with PIL.
+"""
+from PIL import Image
+from .qrmatrix import DARK_THRESHOLD
+
+# Gray level spread below which an image has no usable contrast; it is then
+# cut at DARK_THRESHOLD instead of at its Otsu threshold
+MIN_CONTRAST = 32
+
+
+# numpy is imported by the first binarize_images() call rather than at worker
+# boot; False once it turned out to be missing
+_numpy = None
+
+
+def get_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def to_gray(img, width, height):
+    """
+    Flatten ``img`` onto white as a grayscale image. Sources at least twice
+    the target size are box-reduced by a whole factor first, so every pixel
+    left still averages whole source pixels.
+    """
+    if img.mode in ('RGBA', 'LA', 'P', 'PA'):
+        flat = Image.new("RGBA", img.size, (255, 255, 255, 255))
+        flat.alpha_composite(img.convert("RGBA"))
+        img = flat
+    gray = img.convert("L")
+    factor = min(gray.width // width, gray.height // height)
+    if factor >= 2:
+        gray = gray.reduce(factor)
+    return gray
+
+
+def _scale_factors(size, width, height):
+    return max(1, round(width / size[0])), max(1, round(height / size[1]))
+
+
+def _otsu(histogram):
+    """Otsu threshold of a 256-bin histogram (pure Python fallback)."""
+    total = sum(histogram)
+    sum_all = sum(level * count for level, count in enumerate(histogram))
+    weight = cumulative = 0
+    best, threshold = -1.0, DARK_THRESHOLD
+    for level, count in enumerate(histogram):
+        weight += count
+        if weight == 0 or weight == total:
+            continue
+        cumulative += level * count
+        mean_dark = cumulative / weight
+        mean_light = (sum_all - cumulative) / (total - weight)
+        between = weight * (total - weight) * (mean_dark - mean_light) ** 2
+        if between > best:
+            best, threshold = between, level
+    return threshold
+
+
+def _otsu_stack(np, histograms):
+    """Otsu thresholds of an (N, 256) array of histograms, all at once."""
+    levels = np.arange(256, dtype=np.float64)
+    weights = np.cumsum(histograms, axis=1, dtype=np.float64)
+    sums = np.cumsum(histograms * levels, axis=1, dtype=np.float64)
+    total = weights[:, -1:]
+    light = total - weights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_dark = sums / weights
+        mean_light = (sums[:, -1:] - sums) / light
+        between = weights * light * (mean_dark - mean_light) ** 2
+    between = np.nan_to_num(between, nan=-1.0)
+    return between.argmax(axis=1)
+
+
+def _thresholds(lowest, highest, otsu):
+    return [int(t) if high - low >= MIN_CONTRAST else DARK_THRESHOLD - 1
+            for low, high, t in zip(lowest, highest, otsu)]
+
+
+def binarize_images(grays, width, height, mode='L'):
+    """
+    Threshold grayscale images (from to_gray) and upscale them towards
+    ``width`` x ``height`` by whole factors. Returns images of ``mode`` '1'
+    or 'L' (0 or 255 only) in input order.
+    """
+    np = get_numpy()
+    if np is None:
+        return [_binarize_one(gray, width, height, mode) for gray in grays]
+    results = [None] * len(grays)
+    groups = {}
+    for index, gray in enumerate(grays):
+        groups.setdefault(gray.size, []).append(index)
+    for size, indexes in groups.items():
+        stack = np.stack([np.asarray(grays[index]) for index in indexes])
+        count = len(indexes)
+        # One histogram per image: offset each image's levels by 256 * its index
+        offsets = (np.arange(count, dtype=np.int64) * 256)[:, None, None]
+        histograms = np.bincount((stack + offsets).ravel(), minlength=256 * count).reshape(count, 256)
+        flat = stack.reshape(count, -1)
+        thresholds = _thresholds(flat.min(axis=1), flat.max(axis=1), _otsu_stack(np, histograms))
+        light = stack > np.array(thresholds, dtype=np.uint8)[:, None, None]
+        scale_x, scale_y = _scale_factors(size, width, height)
+        if scale_y > 1:
+            light = light.repeat(scale_y, axis=1)
+        if scale_x > 1:
+            light = light.repeat(scale_x, axis=2)
+        for index, pixels in zip(indexes, light):
+            if mode == '1':
+                results[index] = Image.fromarray(pixels)
+            else:
+                results[index] = Image.fromarray(pixels.astype(np.uint8) * 255)
+    return results
+
+
+def _binarize_one(gray, width, height, mode):
+    low, high = gray.getextrema()
+    threshold = _thresholds([low], [high], [_otsu(gray.histogram())])[0]
+    img = gray.point(lambda p: 255 if p > threshold else 0)
+    scale_x, scale_y = _scale_factors(gray.size, width, height)
+    if scale_x > 1 or scale_y > 1:
+        img = img.resize((gray.width * scale_x, gray.height * scale_y), resample=Image.Resampling.NEAREST)
+    return img.convert('1', dither=Image.Dither.NONE) if mode == '1' else img
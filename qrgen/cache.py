@@ -0,0 +1,223 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image
+from django.conf import settings
+from .qrmatrix import VectorQR
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever a change to the rendering changes the pixels of a block, so
+# that blocks cached on disk by the previous version are not served
+BLOCK_FORMAT_VERSION = 1
+
+
+def block_args_digest(block_args):
+    """Hash everything except the QR image that changes how a block renders."""
+    from .rendering import RENDER_SCALE
+    digest = hashlib.sha256(b'%d %d\0' % (BLOCK_FORMAT_VERSION, RENDER_SCALE))
+    for arg in block_args:
+        if isinstance(arg, bytes):
+            digest.update(hashlib.sha256(arg).digest())
+        else:
+            digest.update(repr(arg).encode('ascii'))
+        digest.update(b'\0')
+    return digest.digest()
+
+
+def block_cache_key(qr_data, args_digest):
+    """Key of one block; ``qr_data`` is image bytes or a str payload."""
+    digest = hashlib.sha256(args_digest)
+    if isinstance(qr_data, str):
+        digest.update(b'payload\0' + qr_data.encode('utf-8'))
+    else:
+        digest.update(qr_data)
+    return digest.hexdigest()
+
+
+def _block_size(block):
+    if isinstance(block, bytes):
+        return len(block)
+    if isinstance(block, VectorQR):
+        return len(block) * 32
+    if block.mode == '1':
+        return (block.width + 7) // 8 * block.height
+    return block.width * block.height * len(block.getbands())
+
+
+class BlockCache:
+    """
+    Two-tier cache of rendered blocks keyed by content hash.
+
+    The memory tier is an LRU bounded by ``max_bytes``. The optional disk tier
+    lives in ``disk_dir`` so every gunicorn worker on the host shares it;
+    files are written atomically and the least recently used ones are removed
+    once the directory grows past ``disk_max_bytes``.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_bytes': self._bytes,
+            'memory_entries': len(self._entries),
+        }
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+        block = self._disk_get(key)
+        with self._lock:
+            if block is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._memory_set(key, block)
+        return block
+
+    def set(self, key, block):
+        self._memory_set(key, block)
+        self._disk_set(key, block)
+
+    def _memory_set(self, key, block):
+        size = _block_size(block)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (block, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Keeps the file recent for eviction
+        except OSError:
+            return None
+        if data.startswith(b'\xff\xd8'):
+            return data
+        if data.startswith(VectorQR.MAGIC):
+            return VectorQR.from_bytes(data)
+        try:
+            with Image.open(BytesIO(data)) as img:
+                img.load()
+                return img
+        except Exception:
+            return None
+
+    def _disk_set(self, key, block):
+        if not self.disk_dir:
+            return
+        if isinstance(block, bytes):
+            data = block
+        elif isinstance(block, VectorQR):
+            data = block.to_bytes()
+        else:
+            img_io = BytesIO()
+            block.save(img_io, format='PNG', compress_level=1)
+            data = img_io.getvalue()
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.warning("Could not write block cache file %s", path, exc_info=True)
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._disk_usage()[0]
+            else:
+                self._disk_bytes += len(data)
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self._evict_disk()
+
+    def _disk_usage(self):
+        files = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.disk_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        return total, files
+
+    def _evict_disk(self):
+        # Other workers share the directory, so measure it again rather than
+        # trusting our own running total, and trim to 90% to leave headroom
+        total, files = self._disk_usage()
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+
+_block_cache = None
+_block_cache_lock = threading.Lock()
+
+
+def get_block_cache():
+    """The process-wide block cache, or None when caching is disabled."""
+    global _block_cache
+    max_bytes = getattr(settings, 'QRGEN_BLOCK_CACHE_MAX_BYTES', 0)
+    if not max_bytes:
+        return None
+    with _block_cache_lock:
+        if _block_cache is None:
+            _block_cache = BlockCache(max_bytes,
+                                      getattr(settings, 'QRGEN_BLOCK_CACHE_DIR', None),
+                                      getattr(settings, 'QRGEN_BLOCK_CACHE_DIR_MAX_BYTES', 0))
+        return _block_cache
+
+
+def reset_block_cache():
+    global _block_cache
+    with _block_cache_lock:
+        _block_cache = None
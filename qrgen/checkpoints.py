@@ -0,0 +1,184 @@
+"""
+Checkpoints of large PDFs while they are rendered.
+
+A batch of thousands of blocks can take longer than a worker is allowed to
+run. While such a batch is rendered, every QRGEN_CHECKPOINT_PAGES pages the
+bytes written since the last checkpoint are saved as a part, together with
+the state of the StreamingCanvas and the number of inputs already laid out,
+under the hash of the PDF. A render of the same PDF after the worker was
+killed or timed out starts from the last checkpoint: the finished pages
+come from the stored parts, their inputs are skipped without being rendered,
+and only the remaining pages are drawn.
+
+Checkpoints are deleted once the finished PDF is stored (see
+qrgen.pdfstore.store_pdf), or after QRGEN_PDF_RETENTION_SECONDS when the
+render is never retried.
+"""
+import itertools
+import json
+import logging
+import posixpath
+import re
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from .metrics import stage
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = 'checkpoints'
+# Bytes per read when sending stored parts
+PART_READ_SIZE = 256 * 1024
+
+_STATE_RE = re.compile(r'^state-(\d+)\.json$')
+
+
+def _storage():
+    from .pdfstore import _storage
+    return _storage()
+
+
+def _part_name(digest, number):
+    return posixpath.join(CHECKPOINT_DIR, digest, 'part-%05d.pdf' % number)
+
+
+def _state_name(digest, number):
+    return posixpath.join(CHECKPOINT_DIR, digest, 'state-%05d.json' % number)
+
+
+def _save(storage, name, data):
+    # A part left over from a render killed before its state was saved is replaced
+    if storage.exists(name):
+        storage.delete(name)
+    storage.save(name, ContentFile(data))
+
+
+def checkpointed(batch):
+    """Whether ``batch`` is big enough to be rendered with checkpoints."""
+    from .pdf import page_grid
+    pages = settings.QRGEN_CHECKPOINT_PAGES
+    if batch.output_format != 'pdf' or pages <= 0:
+        return False
+    blocks_per_row, rows_per_page = page_grid(batch.paper_size, batch.block_width_mm, batch.block_height_mm,
+                                              batch.spacing_mm)[:2]
+    return batch.blocks_total > pages * blocks_per_row * rows_per_page
+
+
+def load_checkpoint(digest):
+    """The latest complete checkpoint of ``digest`` as (state, part names), or None."""
+    storage = _storage()
+    try:
+        _, filenames = storage.listdir(posixpath.join(CHECKPOINT_DIR, digest))
+    except FileNotFoundError:
+        return None
+    numbers = sorted((int(match.group(1)) for match in map(_STATE_RE.match, filenames) if match), reverse=True)
+    for number in numbers:
+        parts = [_part_name(digest, part) for part in range(1, number + 1)]
+        if not all(posixpath.basename(name) in filenames for name in parts):
+            continue
+        try:
+            with storage.open(_state_name(digest, number), 'rb') as f:
+                return json.load(f), parts
+        except (OSError, ValueError):
+            logger.warning("Ignoring unreadable checkpoint %s of %s", number, digest)
+    return None
+
+
+def clear_checkpoint(digest):
+    """Delete every stored part and state of ``digest``."""
+    storage = _storage()
+    directory = posixpath.join(CHECKPOINT_DIR, digest)
+    try:
+        _, filenames = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for filename in filenames:
+        try:
+            storage.delete(posixpath.join(directory, filename))
+        except OSError:
+            continue
+
+
+def expire_checkpoints(now=None):
+    """Delete checkpoints not written to for QRGEN_PDF_RETENTION_SECONDS; returns their digests."""
+    retention = settings.QRGEN_PDF_RETENTION_SECONDS
+    if not retention:
+        return []
+    storage = _storage()
+    cutoff = (now or timezone.now()) - timedelta(seconds=retention)
+    try:
+        digests, _ = storage.listdir(CHECKPOINT_DIR)
+    except FileNotFoundError:
+        return []
+    expired = []
+    for digest in digests:
+        directory = posixpath.join(CHECKPOINT_DIR, digest)
+        try:
+            _, filenames = storage.listdir(directory)
+            if filenames and all(storage.get_modified_time(posixpath.join(directory, name)) < cutoff for name in filenames):
+                clear_checkpoint(digest)
+                expired.append(digest)
+        except OSError:
+            continue  # Finished or cleared by another worker in the meantime
+    return expired
+
+
+def _read_part(storage, name):
+    with storage.open(name, 'rb') as f:
+        while True:
+            chunk = f.read(PART_READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _offset_progress(progress, offset):
+    return lambda blocks_done: progress(offset + blocks_done)
+
+
+def stream_pdf_checkpointed(digest, qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm,
+                            encoding='flate', progress=None):
+    """
+    qrgen.pdf.stream_pdf that saves a checkpoint every QRGEN_CHECKPOINT_PAGES
+    pages under ``digest`` (the hash of the PDF) and resumes from the latest
+    one. Yields the same bytes as stream_pdf.
+    """
+    from .pdf import PAPER_SIZE_MAP, StreamingCanvas, draw_pages
+    storage = _storage()
+    every = max(1, settings.QRGEN_CHECKPOINT_PAGES)
+    checkpoint = load_checkpoint(digest)
+    if checkpoint is None:
+        c = StreamingCanvas(pagesize=PAPER_SIZE_MAP[paper_size])
+        inputs_done = parts = 0
+    else:
+        state, part_names = checkpoint
+        logger.info("Resuming PDF %s after %d inputs", digest, state['inputs'])
+        for name in part_names:
+            yield from _read_part(storage, name)
+        c = StreamingCanvas(pagesize=PAPER_SIZE_MAP[paper_size], checkpoint=state['canvas'])
+        inputs_done, parts = state['inputs'], len(part_names)
+        # Inputs on the stored pages are read but not rendered again
+        qr_data_list = itertools.islice(qr_data_list, inputs_done, None)
+        if progress is not None:
+            progress = _offset_progress(progress, inputs_done)
+
+    unsaved = [c.drain()]
+    yield unsaved[0]
+    pages = 0
+    for inputs in draw_pages(c, qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm,
+                             encoding, progress):
+        chunk = c.drain()
+        unsaved.append(chunk)
+        pages += 1
+        if pages % every == 0:
+            parts += 1
+            with stage('checkpoint'):
+                _save(storage, _part_name(digest, parts), b''.join(unsaved))
+                _save(storage, _state_name(digest, parts), json.dumps(
+                    {'inputs': inputs_done + inputs, 'canvas': c.checkpoint()}).encode('ascii'))
+            unsaved = []
+        yield chunk
+    with stage('save'):
+        c.save()
+    yield c.drain()
@@ -0,0 +1,89 @@
+"""
+Logos: letterboxing into the logo half of a block, and presets.
+
+A logo preset is uploaded once (in the admin) and picked by ID on the
+upload form. The letterboxed logo for each block size is rendered the first
+time it is needed and stored next to the preset, keyed by the preset's
+content hash and the pixel size, so every worker reuses it; each process
+also keeps the renditions it used last in memory.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image
+from django.core.files.base import ContentFile
+
+RENDITION_DIR = 'logo_presets/renditions'
+# Renditions kept decoded in memory per process
+RENDITION_MEMO_ENTRIES = 32
+
+_renditions = OrderedDict()  # (preset digest, width, height) -> RGB image
+_renditions_lock = threading.Lock()
+
+
+def prepare_logo(logo_bytes, width_px, height_px):
+    """Letterbox the logo into ``width_px`` x ``height_px`` on white and return it as an RGB image."""
+    logo_stream = BytesIO(logo_bytes)
+    logo_original = Image.open(logo_stream).convert("RGBA")
+    logo_aspect = logo_original.width / logo_original.height
+
+    if logo_aspect >= 1:
+        new_logo_width = width_px
+        new_logo_height = int(width_px / logo_aspect)
+    else:
+        new_logo_height = height_px
+        new_logo_width = int(height_px * logo_aspect)
+
+    logo_resized = logo_original.resize((new_logo_width, new_logo_height), resample=Image.Resampling.BILINEAR)
+
+    final_logo = Image.new("RGBA", (width_px, height_px), (255, 255, 255, 255))
+    final_logo.paste(logo_resized, ((width_px - new_logo_width) // 2,
+                                    (height_px - new_logo_height) // 2), logo_resized)
+
+    # Cleanup
+    logo_original.close()
+    logo_resized.close()
+    logo_stream.close()
+    return final_logo.convert("RGB")
+
+
+def file_digest(field_file):
+    digest = hashlib.sha256()
+    for chunk in field_file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def preset_rendition(preset, width_px, height_px):
+    """The preset's logo letterboxed to ``width_px`` x ``height_px``, rendered at most once."""
+    key = (preset.digest, width_px, height_px)
+    with _renditions_lock:
+        image = _renditions.get(key)
+        if image is not None:
+            _renditions.move_to_end(key)
+            return image
+
+    storage = preset.image.storage
+    name = '%s/%s-%dx%d.png' % (RENDITION_DIR, preset.digest, width_px, height_px)
+    if storage.exists(name):
+        with storage.open(name, 'rb') as f:
+            image = Image.open(f)
+            image.load()
+    else:
+        with preset.image.open('rb') as f:
+            image = prepare_logo(f.read(), width_px, height_px)
+        buffer = BytesIO()
+        image.save(buffer, format='PNG')  # Lossless, so the PDF is the same as from the upload
+        storage.save(name, ContentFile(buffer.getvalue()))
+
+    with _renditions_lock:
+        _renditions[key] = image
+        while len(_renditions) > RENDITION_MEMO_ENTRIES:
+            _renditions.popitem(last=False)
+    return image
+
+
+def reset_renditions():
+    with _renditions_lock:
+        _renditions.clear()
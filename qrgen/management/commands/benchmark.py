@@ -0,0 +1,257 @@
+"""
+Benchmark the block pipeline and full document rendering on synthetic input.
+
+    python manage.py benchmark --output before.json
+    python manage.py benchmark --output after.json --compare before.json
+"""
+import datetime
+import gc
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from qrgen import rendering
+from qrgen.cache import reset_block_cache
+from qrgen.pdf import PAPER_SIZE_MAP, build_pdf, stream_pdf
+from qrgen.rendering import BLOCK_ENCODINGS, RENDER_SCALE, process_qr_block
+from qrgen.synthetic import INPUT_KINDS, make_logo_png, synthetic_qr_set
+from reportlab.lib.units import mm
+
+# Fields that identify a result when two runs are compared
+CASE_FIELDS = ('stage', 'input', 'encoding', 'writer', 'paper_size', 'block', 'batch_size')
+
+
+def _csv_list(value, choices=None, convert=str):
+    items = [convert(item.strip()) for item in value.split(',') if item.strip()]
+    for item in items:
+        if choices is not None and item not in choices:
+            raise CommandError("%r is not one of %s" % (item, ', '.join(choices)))
+    return items
+
+
+def _block_size(value):
+    try:
+        width, height = value.lower().split('x')
+        return float(width), float(height)
+    except ValueError:
+        raise CommandError("Block sizes are given as WIDTHxHEIGHT in mm, not %r" % value)
+
+
+def _read_peak_rss_kb(pid='self'):
+    """Peak resident set size of a process in KiB (Linux only, None elsewhere)."""
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak_rss(pid='self'):
+    # Writing 5 to clear_refs resets VmHWM to the current RSS (Linux 4.0+)
+    try:
+        with open('/proc/%s/clear_refs' % pid, 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _case_key(result):
+    return tuple(result.get(field) for field in CASE_FIELDS)
+
+
+class Command(BaseCommand):
+    help = "Benchmark QR block rendering and PDF generation on synthetic QR codes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-sizes', default='10,100,1000,5000',
+                            help="Comma separated numbers of QR codes per document.")
+        parser.add_argument('--paper-sizes', default='A4', help="Comma separated paper sizes (A4, A3, A2).")
+        parser.add_argument('--blocks', default='60x30',
+                            help="Comma separated block sizes as WIDTHxHEIGHT in mm.")
+        parser.add_argument('--encodings', default=settings.QRGEN_BLOCK_ENCODING,
+                            help="Comma separated block encodings.")
+        parser.add_argument('--inputs', default='png', help="Comma separated input kinds: png, svg or mixed.")
+        parser.add_argument('--writer', choices=('stream', 'reportlab'),
+                            default='stream' if settings.QRGEN_STREAM_PDF else 'reportlab',
+                            help="PDF writer used for the document benchmarks.")
+        parser.add_argument('--block-sample', type=int, default=200,
+                            help="QR codes rendered in-process for the block pipeline benchmark.")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Override QRGEN_RENDER_WORKERS for the run.")
+        parser.add_argument('--with-cache', action='store_true',
+                            help="Keep the block cache enabled (it is disabled by default).")
+        parser.add_argument('--no-tracemalloc', action='store_true',
+                            help="Skip the extra tracemalloc pass of every document.")
+        parser.add_argument('--output', help="Write the results to this JSON file.")
+        parser.add_argument('--compare', help="JSON file of an earlier run to check for regressions.")
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help="Relative slowdown or growth reported as a regression (default 0.1).")
+
+    def handle(self, *args, **options):
+        encodings = _csv_list(options['encodings'], [name for name, _ in BLOCK_ENCODINGS])
+        paper_sizes = _csv_list(options['paper_sizes'], list(PAPER_SIZE_MAP))
+        inputs = _csv_list(options['inputs'], INPUT_KINDS)
+        batch_sizes = _csv_list(options['batch_sizes'], convert=int)
+        blocks = [_block_size(value) for value in _csv_list(options['blocks'])]
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        overrides = {}
+        if not options['with_cache']:
+            overrides['QRGEN_BLOCK_CACHE_MAX_BYTES'] = 0
+        if options['workers'] is not None:
+            overrides['QRGEN_RENDER_WORKERS'] = options['workers']
+
+        results = []
+        with override_settings(**overrides):
+            # Start from a pool of the requested size
+            rendering.shutdown_process_pool()
+            reset_block_cache()
+            try:
+                self.verbose = options['verbosity'] > 0
+                logo_bytes = make_logo_png((400, 200))
+                for kind in inputs:
+                    qr_set = [data for _, data in synthetic_qr_set(max(batch_sizes + [options['block_sample']]), kind)]
+                    for encoding, (block_w, block_h) in itertools.product(encodings, blocks):
+                        results.append(self.bench_blocks(qr_set[:options['block_sample']], kind, encoding,
+                                                         block_w, block_h))
+                        for paper_size, batch_size in itertools.product(paper_sizes, batch_sizes):
+                            results.append(self.bench_document(
+                                qr_set[:batch_size], logo_bytes, kind, encoding, options['writer'],
+                                paper_size, block_w, block_h, not options['no_tracemalloc']))
+            finally:
+                rendering.shutdown_process_pool()
+                reset_block_cache()
+
+        report = {
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'render_workers': rendering.get_render_workers() if options['workers'] is None else options['workers'],
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write("Results written to %s" % options['output'])
+        if baseline is not None:
+            regressions = self.compare(baseline, report, options['threshold'])
+            if regressions:
+                raise CommandError("%d regression(s) against %s" % (regressions, options['compare']))
+
+    def log(self, result):
+        if not self.verbose:
+            return
+        if result['stage'] == 'block':
+            self.stdout.write("block     %-5s %-6s %-9s %9.1f blocks/s  %7.2f ms/block"
+                              % (result['input'], result['encoding'], result['block'],
+                                 result['blocks_per_second'], result['ms_per_block']))
+        else:
+            self.stdout.write("document  %-5s %-6s %-9s %-3s %5d  %9.1f blocks/s  %8.3f s  %9d bytes  rss %s KiB"
+                              % (result['input'], result['encoding'], result['block'], result['paper_size'],
+                                 result['batch_size'], result['blocks_per_second'], result['wall_seconds'],
+                                 result['pdf_bytes'], result['peak_rss_kb']))
+
+    def bench_blocks(self, qr_set, kind, encoding, block_w, block_h):
+        """Time process_qr_block on the current thread, without the pool or the cache."""
+        qr_width = block_w * mm / 2
+        qr_height = block_h * mm
+        process_qr_block(qr_set[0], qr_width, qr_height, encoding)  # Warm-up
+        failed = 0
+        start = time.perf_counter()
+        for qr_data in qr_set:
+            if process_qr_block(qr_data, qr_width, qr_height, encoding, settings.QRGEN_JPEG_QUALITY) is None:
+                failed += 1
+        elapsed = time.perf_counter() - start
+        result = {
+            'stage': 'block',
+            'input': kind,
+            'encoding': encoding,
+            'block': '%gx%g' % (block_w, block_h),
+            'batch_size': len(qr_set),
+            'block_pixels': '%dx%d' % (int(qr_width * RENDER_SCALE), int(qr_height * RENDER_SCALE)),
+            'failed_blocks': failed,
+            'wall_seconds': elapsed,
+            'ms_per_block': elapsed * 1000 / len(qr_set),
+            'blocks_per_second': len(qr_set) / elapsed,
+        }
+        self.log(result)
+        return result
+
+    def bench_document(self, qr_set, logo_bytes, kind, encoding, writer, paper_size, block_w, block_h, trace):
+        """Render one whole document the way download_pdf does and measure it."""
+        args = (logo_bytes, paper_size, block_w, block_h, 5, encoding)
+
+        def render():
+            if writer == 'stream':
+                return sum(len(chunk) for chunk in stream_pdf(iter(qr_set), *args))
+            return len(build_pdf(iter(qr_set), *args))
+
+        gc.collect()
+        worker_pids = rendering.render_worker_pids()
+        for pid in ['self'] + worker_pids:
+            _reset_peak_rss(pid)
+        start = time.perf_counter()
+        pdf_bytes = render()
+        elapsed = time.perf_counter() - start
+        worker_rss = [_read_peak_rss_kb(pid) for pid in rendering.render_worker_pids()]
+        result = {
+            'stage': 'document',
+            'input': kind,
+            'encoding': encoding,
+            'writer': writer,
+            'paper_size': paper_size,
+            'block': '%gx%g' % (block_w, block_h),
+            'batch_size': len(qr_set),
+            'wall_seconds': elapsed,
+            'blocks_per_second': len(qr_set) / elapsed,
+            'pdf_bytes': pdf_bytes,
+            'peak_rss_kb': _read_peak_rss_kb(),
+            'worker_peak_rss_kb': max([rss for rss in worker_rss if rss is not None], default=None),
+            'tracemalloc_peak_bytes': None,
+        }
+        if trace:
+            # Separate pass: tracing allocations slows rendering down too much to time it
+            tracemalloc.start()
+            try:
+                render()
+                result['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.log(result)
+        return result
+
+    def compare(self, baseline, report, threshold):
+        """Print the change of every case found in both runs; returns the number of regressions."""
+        previous = {_case_key(result): result for result in baseline.get('results', [])}
+        regressions = 0
+        for result in report['results']:
+            old = previous.get(_case_key(result))
+            if old is None:
+                continue
+            speed = result['blocks_per_second'] / old['blocks_per_second'] - 1
+            problems = []
+            if speed < -threshold:
+                problems.append('slower')
+            if result.get('pdf_bytes') and old.get('pdf_bytes') and \
+                    result['pdf_bytes'] > old['pdf_bytes'] * (1 + threshold):
+                problems.append('larger PDF')
+            regressions += bool(problems)
+            line = "%-8s %-5s %-6s %-9s %-3s %5d  %+7.1f%% blocks/s" % (
+                result['stage'], result['input'], result['encoding'], result['block'],
+                result.get('paper_size') or '', result['batch_size'], speed * 100)
+            if problems:
+                self.stdout.write(self.style.ERROR("%s  REGRESSION: %s" % (line, ', '.join(problems))))
+            else:
+                self.stdout.write(line)
+        return regressions
@@ -0,0 +1,23 @@
+"""
+Delete stored PDFs older than QRGEN_PDF_RETENTION_SECONDS, checkpoints of
+renders abandoned for as long, and batches created before then together
+with their uploaded files. Downloads also sweep at most once an hour per
+worker; run this from cron to expire PDFs on idle servers too.
+
+    python manage.py expire_pdfs
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from qrgen.pdfstore import expire_batches, expire_stored_pdfs
+
+
+class Command(BaseCommand):
+    help = "Delete stored PDFs and batches older than the retention period."
+
+    def handle(self, *args, **options):
+        if not settings.QRGEN_PDF_RETENTION_SECONDS:
+            self.stdout.write("QRGEN_PDF_RETENTION_SECONDS is 0; stored PDFs and batches are kept")
+            return
+        expired = expire_stored_pdfs()
+        batches = expire_batches()
+        self.stdout.write("Deleted %d stored PDFs and %d batches" % (len(expired), batches))
@@ -0,0 +1,398 @@
+"""
+Load test the upload -> download flow with many concurrent clients.
+
+Starts the application on a free local port (with its own throwaway database
+and MEDIA_ROOT), then every client repeatedly uploads a synthetic batch to
+the index page, follows the redirect and downloads the PDF. Reports latency
+percentiles, error rate, throughput and the peak RSS of every server
+process. Nothing is fetched from the network.
+
+    python manage.py loadtest --clients 16 --flows 200
+    python manage.py loadtest --server wsgi --workers 4 --output wsgi.json
+    python manage.py loadtest --url http://staging.internal:8000 --clients 4
+"""
+import http.client
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from http.cookies import SimpleCookie
+from io import BytesIO
+from urllib.parse import urljoin, urlsplit
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from qrgen.rendering import OUTPUT_FORMATS
+from qrgen.synthetic import INPUT_KINDS, make_logo_png, synthetic_qr_set
+
+SERVERS = ('asgi', 'wsgi', 'runserver')
+PERCENTILES = (50, 95, 99)
+# Seconds between two samples of the server processes' memory
+RSS_SAMPLE_INTERVAL = 0.2
+
+# Settings for the started server: the project's, with a throwaway database and media root
+SETTINGS_TEMPLATE = '''from %(module)s import *
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': %(db)r}}
+MEDIA_ROOT = %(media)r
+'''
+
+
+def _percentile(values, pct):
+    """Nearest-rank percentile of ``values`` (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def _multipart(fields, files):
+    """Encode form fields and (field, file name, bytes) files as multipart/form-data."""
+    boundary = uuid.uuid4().hex
+    body = BytesIO()
+    for name, value in fields:
+        body.write(b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                   % (boundary.encode(), name.encode(), str(value).encode()))
+    for name, filename, data in files:
+        body.write(b'--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                   b'Content-Type: application/octet-stream\r\n\r\n'
+                   % (boundary.encode(), name.encode(), filename.encode()))
+        body.write(data)
+        body.write(b'\r\n')
+    body.write(b'--%s--\r\n' % boundary.encode())
+    return body.getvalue(), 'multipart/form-data; boundary=%s' % boundary
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _descendants(pid):
+    """(pid, depth) of every process below ``pid`` (Linux /proc only)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                # The command name may contain spaces; the parent pid follows it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found = []
+    stack = [(child, 1) for child in children.get(pid, [])]
+    while stack:
+        child, depth = stack.pop()
+        found.append((child, depth))
+        stack.extend((grandchild, depth + 1) for grandchild in children.get(child, []))
+    return found
+
+
+def _status_kb(pid, field):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class RssSampler(threading.Thread):
+    """Peak RSS of a server process and everything it started, sampled in the background."""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.processes = {}  # pid -> {'role', 'peak_kb'}
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        roles = {0: 'server', 1: 'worker'}
+        for pid, depth in [(self.pid, 0)] + _descendants(self.pid):
+            # VmHWM is the kernel's own peak; VmRSS covers processes without it
+            rss_kb = _status_kb(pid, 'VmHWM') or _status_kb(pid, 'VmRSS')
+            if rss_kb is None:
+                continue
+            entry = self.processes.setdefault(pid, {'role': roles.get(depth, 'render'), 'peak_kb': 0})
+            entry['peak_kb'] = max(entry['peak_kb'], rss_kb)
+
+    def run(self):
+        while not self._stop_event.wait(RSS_SAMPLE_INTERVAL):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+        return [{'pid': pid, 'role': entry['role'], 'peak_rss_mb': round(entry['peak_kb'] / 1024, 1)}
+                for pid, entry in sorted(self.processes.items())]
+
+
+class Client:
+    """One simulated user: keeps its own cookies, like a browser session."""
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.base_url = base_url
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.cookies = SimpleCookie()
+
+    def request(self, method, url, body=None, headers=None):
+        """Returns (status, headers, body bytes)."""
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % (key, morsel.value) for key, morsel in self.cookies.items())
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, urlsplit(urljoin(self.base_url, url)).path or '/', body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        finally:
+            connection.close()
+        for header in response.headers.get_all('Set-Cookie') or ():
+            self.cookies.load(header)
+        return response.status, response.headers, content
+
+    def run_flow(self, form, files):
+        """Upload a batch and download its PDF; returns the timings and size or raises."""
+        started = time.perf_counter()
+        index_url = reverse('qrgen:index')
+        status, _, _ = self.request('GET', index_url)
+        if status != 200:
+            raise FlowError('index HTTP %d' % status)
+        fields = list(form) + [('csrfmiddlewaretoken', self.cookies['csrftoken'].value)]
+        body, content_type = _multipart(fields, files)
+        upload_started = time.perf_counter()
+        status, headers, _ = self.request('POST', index_url, body, {'Content-Type': content_type,
+                                                                    'Referer': urljoin(self.base_url, index_url)})
+        if status != 302:
+            raise FlowError('upload HTTP %d' % status)
+        download_started = time.perf_counter()
+        status, _, document = self.request('GET', headers['Location'])
+        if status != 200:
+            raise FlowError('download HTTP %d' % status)
+        if not document:
+            raise FlowError('download is empty')
+        finished = time.perf_counter()
+        return {'flow': finished - started, 'upload': download_started - upload_started,
+                'download': finished - download_started, 'bytes': len(document)}
+
+
+class FlowError(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Load test the upload and PDF download flow with concurrent clients against a local server."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=8, help="Concurrent clients.")
+        parser.add_argument('--flows', type=int, default=None,
+                            help="Upload and download flows in total (default: 5 per client).")
+        parser.add_argument('--batch-size', type=int, default=20, help="QR codes per uploaded batch.")
+        parser.add_argument('--input', default='png', choices=INPUT_KINDS, help="Kind of synthetic QR codes.")
+        parser.add_argument('--archive', action='store_true',
+                            help="Upload each batch as one zip instead of separate files.")
+        parser.add_argument('--same-inputs', action='store_true',
+                            help="Upload the same batch every time (measures serving stored PDFs).")
+        parser.add_argument('--paper-size', default='A4', help="Paper size of the documents.")
+        parser.add_argument('--block', default='60x30', help="Block size as WIDTHxHEIGHT in mm.")
+        parser.add_argument('--encoding', default='', help="Block encoding (default: the server's).")
+        parser.add_argument('--format', default='', choices=[''] + [name for name, _ in OUTPUT_FORMATS],
+                            help="Output format (default: the server's).")
+        parser.add_argument('--server', default='asgi', choices=SERVERS,
+                            help="Server to start: gunicorn with uvicorn workers (asgi), gunicorn sync "
+                                 "workers (wsgi) or Django's runserver.")
+        parser.add_argument('--workers', type=int, default=2, help="Server worker processes (gunicorn).")
+        parser.add_argument('--url', help="Test an already running server instead of starting one.")
+        parser.add_argument('--timeout', type=float, default=300, help="Seconds before a request fails.")
+        parser.add_argument('--output', help="Write the report to this JSON file.")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        flows = options['flows'] or options['clients'] * 5
+        if options['clients'] < 1 or flows < 1 or options['batch_size'] < 1:
+            raise CommandError("--clients, --flows and --batch-size must be positive")
+        try:
+            block_w, block_h = (float(size) for size in options['block'].lower().split('x'))
+        except ValueError:
+            raise CommandError("The block size is given as WIDTHxHEIGHT in mm, not %r" % options['block'])
+        form = [('paper_size', options['paper_size']), ('block_width_mm', block_w),
+                ('block_height_mm', block_h), ('spacing_mm', 5), ('output_encoding', options['encoding']),
+                ('output_format', options['format'])]
+
+        # Generated up front so the clients only measure the server
+        uploads = [self._batch_files(index, options) for index in range(1 if options['same_inputs'] else flows)]
+
+        workdir = None
+        server = None
+        try:
+            if options['url']:
+                base_url = options['url'].rstrip('/')
+            else:
+                workdir = tempfile.mkdtemp(prefix='qrgen-loadtest-')
+                server, base_url = self._start_server(workdir, options)
+            sampler = RssSampler(server.pid) if server is not None and os.path.isdir('/proc') else None
+            if sampler is not None:
+                sampler.start()
+            report = self._run(base_url, form, uploads, flows, options)
+            report['processes'] = sampler.stop() if sampler is not None else []
+        finally:
+            if server is not None:
+                server.terminate()
+                try:
+                    server.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+            if workdir is not None:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        report.update(server=options['url'] or options['server'], workers=options['workers'],
+                      clients=options['clients'], batch_size=options['batch_size'], input=options['input'],
+                      archive=options['archive'], same_inputs=options['same_inputs'],
+                      output_format=options['format'] or None)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self._print_report(report)
+            if options['output']:
+                self.stdout.write("Report written to %s" % options['output'])
+
+    def _batch_files(self, index, options):
+        qr_set = synthetic_qr_set(options['batch_size'], options['input'], start=index * options['batch_size'])
+        files = [('logo', 'logo.png', make_logo_png())]
+        if options['archive']:
+            buffer = BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for name, data in qr_set:
+                    archive.writestr(name, data)
+            return files + [('qr_archive', 'codes.zip', buffer.getvalue())]
+        return files + [('qr_images', name, data) for name, data in qr_set]
+
+    def _server_command(self, options, port):
+        bind = '127.0.0.1:%d' % port
+        if options['server'] == 'runserver':
+            return [sys.executable, 'manage.py', 'runserver', '--noreload', '--nothreading', bind]
+        command = [sys.executable, '-m', 'gunicorn', '--bind', bind, '--workers', str(options['workers']),
+                   '--timeout', str(int(options['timeout']))]
+        if options['server'] == 'asgi':
+            try:
+                import uvicorn  # noqa: F401
+            except ImportError:
+                raise CommandError("--server asgi needs uvicorn (pip install uvicorn); or use --server wsgi")
+            return command + ['-k', 'uvicorn.workers.UvicornWorker', 'qr_project.asgi:application']
+        return command + [settings.WSGI_APPLICATION.rsplit('.', 1)[0] + ':application']
+
+    def _start_server(self, workdir, options):
+        """Start the server on a free port with its own database and media root."""
+        module = os.environ.get('DJANGO_SETTINGS_MODULE', 'qr_project.settings')
+        with open(os.path.join(workdir, 'qrgen_loadtest_settings.py'), 'w') as f:
+            f.write(SETTINGS_TEMPLATE % {'module': module, 'db': os.path.join(workdir, 'db.sqlite3'),
+                                         'media': os.path.join(workdir, 'media')})
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='qrgen_loadtest_settings',
+                   PYTHONPATH=os.pathsep.join([workdir, str(settings.BASE_DIR), os.environ.get('PYTHONPATH', '')]))
+        migrate = subprocess.run([sys.executable, 'manage.py', 'migrate', '--noinput'], env=env,
+                                 cwd=str(settings.BASE_DIR), capture_output=True, text=True)
+        if migrate.returncode != 0:
+            raise CommandError("Could not create the load test database:\n%s" % migrate.stderr[-2000:])
+
+        port = _free_port()
+        log = open(os.path.join(workdir, 'server.log'), 'w+')
+        server = subprocess.Popen(self._server_command(options, port), env=env, cwd=str(settings.BASE_DIR),
+                                  stdout=log, stderr=subprocess.STDOUT)
+        base_url = 'http://127.0.0.1:%d' % port
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if Client(base_url, timeout=5).request('GET', reverse('qrgen:index'))[0] == 200:
+                    return server, base_url
+            except OSError:
+                pass
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                log.seek(0)
+                raise CommandError("The server did not start:\n%s" % log.read()[-2000:])
+            time.sleep(0.2)
+
+    def _run(self, base_url, form, uploads, flows, options):
+        results, errors = [], {}
+        lock = threading.Lock()
+        next_flow = iter(range(flows))
+
+        def client_loop():
+            client = Client(base_url, options['timeout'])
+            while True:
+                with lock:
+                    index = next(next_flow, None)
+                if index is None:
+                    return
+                try:
+                    result = client.run_flow(form, uploads[index % len(uploads)])
+                except (FlowError, OSError, http.client.HTTPException, KeyError) as exc:
+                    kind = str(exc) if isinstance(exc, FlowError) else type(exc).__name__
+                    with lock:
+                        errors[kind] = errors.get(kind, 0) + 1
+                    continue
+                with lock:
+                    results.append(result)
+
+        threads = [threading.Thread(target=client_loop) for _ in range(min(options['clients'], flows))]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+        failed = sum(errors.values())
+        latency = {}
+        for step in ('flow', 'upload', 'download'):
+            values = [result[step] for result in results]
+            latency[step] = {'p%d' % pct: _percentile(values, pct) for pct in PERCENTILES}
+            latency[step]['max'] = max(values) if values else None
+        downloaded = sum(result['bytes'] for result in results)
+        return {
+            'flows': flows,
+            'succeeded': len(results),
+            'failed': failed,
+            'error_rate': failed / flows,
+            'errors': errors,
+            'wall_seconds': wall,
+            'flows_per_second': len(results) / wall if wall else None,
+            'qr_codes_per_second': len(results) * options['batch_size'] / wall if wall else None,
+            'download_mb_per_second': downloaded / 1024 / 1024 / wall if wall else None,
+            'latency_seconds': latency,
+        }
+
+    def _print_report(self, report):
+        self.stdout.write("%d flows from %d clients against %s: %d ok, %d failed (%.1f%% errors) in %.1f s" % (
+            report['flows'], report['clients'], report['server'], report['succeeded'], report['failed'],
+            report['error_rate'] * 100, report['wall_seconds']))
+        for kind, count in sorted(report['errors'].items()):
+            self.stdout.write("  %5d x %s" % (count, kind))
+        if report['succeeded']:
+            self.stdout.write("Throughput: %.2f flows/s, %.1f QR codes/s, %.2f MB/s of PDF" % (
+                report['flows_per_second'], report['qr_codes_per_second'], report['download_mb_per_second']))
+            for step, values in report['latency_seconds'].items():
+                self.stdout.write("  %-8s  p50 %7.3f s  p95 %7.3f s  p99 %7.3f s  max %7.3f s" % (
+                    step, values['p50'], values['p95'], values['p99'], values['max']))
+        if report['processes']:
+            self.stdout.write("Peak RSS per server process:")
+            for process in report['processes']:
+                self.stdout.write("  %-7s %7d  %8.1f MB" % (process['role'], process['pid'], process['peak_rss_mb']))
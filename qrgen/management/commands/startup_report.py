@@ -0,0 +1,102 @@
+"""
+Measure how long a fresh worker takes to import the ASGI application and how
+much memory that costs, and check the result against the startup budget.
+
+    python manage.py startup_report
+    python manage.py startup_report --max-seconds 1 --max-rss-mb 100
+    python manage.py startup_report --application qr_project.wsgi.application
+"""
+import json
+import os
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Loaded on first use; a worker that imports any of them at boot is a regression
+LAZY_MODULES = ('reportlab', 'cairosvg', 'cairocffi', 'mongoengine', 'pymongo', 'numpy', 'celery', 'kombu')
+
+# Runs in a fresh interpreter, like a gunicorn worker after fork/exec
+BOOT_SCRIPT = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import django
+from django.utils.module_loading import import_string
+import_string(sys.argv[1])
+from django.urls import get_resolver
+get_resolver().url_patterns  # The URLconf is loaded by the first request otherwise
+seconds = time.perf_counter() - start
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss_kb //= 1024
+print(json.dumps({'seconds': seconds, 'max_rss_kb': rss_kb, 'modules': sorted(sys.modules)}))
+'''
+
+
+def _import_times(stderr):
+    """Self time in microseconds of every top-level package, from ``-X importtime``."""
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            self_us, _, name = line[len('import time:'):].split('|')
+            self_us = int(self_us)
+        except ValueError:
+            continue  # Header line
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + self_us
+    return totals
+
+
+class Command(BaseCommand):
+    help = "Report worker import time and memory and check them against the startup budget."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--application', default=settings.ASGI_APPLICATION,
+                            help="Dotted path of the application to boot (default: ASGI_APPLICATION).")
+        parser.add_argument('--max-seconds', type=float, default=settings.QRGEN_STARTUP_MAX_SECONDS,
+                            help="Budget for importing the application and URLconf.")
+        parser.add_argument('--max-rss-mb', type=float, default=settings.QRGEN_STARTUP_MAX_RSS_MB,
+                            help="Budget for the peak resident memory after startup.")
+        parser.add_argument('--top', type=int, default=15, help="Number of slowest packages to list.")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'qr_project.settings'))
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT, options['application']],
+                                 capture_output=True, text=True, env=env, cwd=str(settings.BASE_DIR))
+        if process.returncode != 0:
+            raise CommandError("Worker failed to start:\n%s" % process.stderr[-2000:])
+        boot = json.loads(process.stdout.strip().splitlines()[-1])
+        packages = sorted(_import_times(process.stderr).items(), key=lambda item: item[1], reverse=True)
+        eager = [name for name in LAZY_MODULES if name in boot['modules']]
+        rss_mb = boot['max_rss_kb'] / 1024
+
+        problems = []
+        if boot['seconds'] > options['max_seconds']:
+            problems.append("startup took %.2f s (budget %.2f s)" % (boot['seconds'], options['max_seconds']))
+        if rss_mb > options['max_rss_mb']:
+            problems.append("startup RSS is %.1f MB (budget %.1f MB)" % (rss_mb, options['max_rss_mb']))
+        if eager:
+            problems.append("imported at startup instead of on first use: %s" % ', '.join(eager))
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'application': options['application'],
+                'seconds': boot['seconds'],
+                'rss_mb': rss_mb,
+                'import_ms': {name: us / 1000 for name, us in packages[:options['top']]},
+                'eager_modules': eager,
+                'problems': problems,
+            }, indent=2))
+        else:
+            self.stdout.write("Startup of %s: %.3f s, peak RSS %.1f MB" % (options['application'], boot['seconds'],
+                                                                          rss_mb))
+            self.stdout.write("Slowest packages to import:")
+            for name, us in packages[:options['top']]:
+                self.stdout.write("  %8.1f ms  %s" % (us / 1000, name))
+        if problems:
+            raise CommandError("Startup budget exceeded: " + "; ".join(problems))
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS("Within the startup budget"))
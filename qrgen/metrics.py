@@ -0,0 +1,273 @@
+"""
+Per-stage timing of PDF generation.
+
+Stages are timed with ``with stage('decode'):`` and collected into
+histograms that the metrics view exports in the Prometheus text format.
+Stages timed while a RequestTimer is active are also summed per request for
+the ``Server-Timing`` header, and code run under profiling() (the render
+threads) is added to its cProfile. Render processes collect their stage timings
+with collect_stages() and send them back with the blocks, so the web
+process's histograms include the work done in its pool.
+
+Stages can nest: 'render' is the time the layout waits for the next block,
+which includes the block stages when blocks are rendered inline.
+
+Histograms are per process: with several gunicorn workers every worker
+exports its own numbers.
+"""
+import contextvars
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the histogram buckets; covers a single resize up
+# to a whole 5000 block document
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+METRIC_HELP = {
+    'qrgen_stage_seconds': 'Time spent in each stage of QR block and PDF generation.',
+    'qrgen_request_seconds': 'Wall time of instrumented requests, including streaming the response.',
+}
+
+# List of (stage, seconds) being collected for the current request or render chunk
+_current_stages = contextvars.ContextVar('qrgen_current_stages', default=None)
+# RequestTimer of the current request, for profiling()
+_current_timer = contextvars.ContextVar('qrgen_current_timer', default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Cumulative bucket counts (ending with +Inf), sum and count."""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total, running
+
+
+_histograms = OrderedDict()  # (metric name, sorted label items) -> Histogram
+_histograms_lock = threading.Lock()
+
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(key, Histogram())
+    histogram.observe(value)
+
+
+def reset_metrics():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def record_stage(name, seconds):
+    observe('qrgen_stage_seconds', seconds, stage=name)
+    stages = _current_stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+def record_stages(stages):
+    """Replay timings returned by collect_stages() in another process."""
+    for name, seconds in stages:
+        record_stage(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_stages():
+    """Collect the stages timed inside the block into the yielded list."""
+    stages = []
+    token = _current_stages.set(stages)
+    try:
+        yield stages
+    finally:
+        _current_stages.reset(token)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(items):
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value)) for key, value in items) if items else ''
+
+
+def render_prometheus(extra_lines=()):
+    """All histograms in the Prometheus text exposition format (0.0.4)."""
+    lines = []
+    with _histograms_lock:
+        histograms = list(_histograms.items())
+    seen = set()
+    for (name, labels), histogram in sorted(histograms, key=lambda item: item[0]):
+        if name not in seen:
+            seen.add(name)
+            lines.append('# HELP %s %s' % (name, METRIC_HELP.get(name, name)))
+            lines.append('# TYPE %s histogram' % name)
+        cumulative, total, count = histogram.snapshot()
+        for bound, value in zip(BUCKETS + ('+Inf',), cumulative):
+            lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', bound if bound == '+Inf' else repr(bound)),)),
+                                             value))
+        lines.append('%s_sum%s %r' % (name, _labels(labels), total))
+        lines.append('%s_count%s %d' % (name, _labels(labels), count))
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
+
+
+def _save_profile(profile, view_name, seconds):
+    """
+    Keep the cProfile dumps of the QRGEN_PROFILE_SLOWEST slowest requests in
+    QRGEN_PROFILE_DIR. The duration is part of the file name so every worker
+    sharing the directory agrees on which dumps to keep.
+    """
+    keep = settings.QRGEN_PROFILE_SLOWEST
+    directory = settings.QRGEN_PROFILE_DIR
+    try:
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for name in os.listdir(directory):
+            try:
+                existing.append((float(name.split('-', 1)[0]), name))
+            except ValueError:
+                continue
+        existing.sort()
+        if len(existing) >= keep and seconds <= existing[0][0]:
+            return
+        name = '%012.6f-%s-%d-%d.prof' % (seconds, view_name, os.getpid(), time.time() * 1000)
+        profile.dump_stats(os.path.join(directory, name))
+        for _, old_name in existing[:len(existing) + 1 - keep]:
+            os.remove(os.path.join(directory, old_name))
+    except OSError:
+        logger.warning("Could not save the profile of a slow %s request", view_name, exc_info=True)
+
+
+@contextmanager
+def profiling():
+    """
+    Add the calls made inside the block to the cProfile of the active
+    RequestTimer, if it has one. Each thread gets its own profiler, so
+    render threads working for different requests do not disturb each other.
+    """
+    timer = _current_timer.get()
+    profile = timer._thread_profile() if timer is not None else None
+    if profile is None:
+        yield
+        return
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiler is active (Python 3.12+ allows one per process)
+        profile = None
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+
+
+class RequestTimer:
+    """
+    Times one request: its total duration, the stages run while it is
+    active, and when QRGEN_PROFILE_SLOWEST is set a cProfile of the code it
+    runs under profiling(). The event loop thread is not profiled: it serves
+    every request at once.
+
+    start()/stop() can be called repeatedly; the request is finished with
+    finish().
+    """
+
+    def __init__(self, view_name):
+        self.view_name = view_name
+        self.stages = []
+        # Thread id -> cProfile.Profile
+        self.profiles = {} if settings.QRGEN_PROFILE_SLOWEST else None
+        self._started = time.perf_counter()
+        self._tokens = None
+
+    def _thread_profile(self):
+        if self.profiles is None:
+            return None
+        return self.profiles.setdefault(threading.get_ident(), cProfile.Profile())
+
+    def start(self):
+        self._tokens = _current_stages.set(self.stages), _current_timer.set(self)
+
+    def stop(self):
+        if self._tokens is not None:
+            stages_token, timer_token = self._tokens
+            try:
+                _current_timer.reset(timer_token)
+                _current_stages.reset(stages_token)
+            except ValueError:
+                # Resumed from another context (e.g. an ASGI thread)
+                _current_timer.set(None)
+                _current_stages.set(None)
+            self._tokens = None
+
+    def finish(self):
+        self.stop()
+        seconds = time.perf_counter() - self._started
+        observe('qrgen_request_seconds', seconds, view=self.view_name)
+        if self.profiles:
+            profiles = list(self.profiles.values())
+            self.profiles = None
+            try:
+                stats = pstats.Stats(*profiles)
+            except TypeError:
+                # Nothing was profiled
+                return seconds
+            _save_profile(stats, self.view_name, seconds)
+        return seconds
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def server_timing(self):
+        """Server-Timing header value: milliseconds summed per stage, then the total."""
+        totals = OrderedDict()
+        for name, seconds in self.stages:
+            totals[name] = totals.get(name, 0.0) + seconds
+        entries = ['%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in totals.items()]
+        entries.append('total;dur=%.1f' % ((time.perf_counter() - self._started) * 1000))
+        return ', '.join(entries)
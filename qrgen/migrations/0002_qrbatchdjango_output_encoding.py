@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='output_encoding',
+            field=models.CharField(default='flate', max_length=10),
+        ),
+    ]
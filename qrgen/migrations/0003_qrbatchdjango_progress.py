@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0002_qrbatchdjango_output_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='blocks_done',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='blocks_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='status',
+            field=models.CharField(choices=[('queued', 'queued'), ('rendering', 'rendering'), ('done', 'done'), ('failed', 'failed')], default='queued', max_length=10),
+        ),
+    ]
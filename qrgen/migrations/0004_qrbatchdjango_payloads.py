@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0003_qrbatchdjango_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='payloads',
+            field=models.FileField(blank=True, null=True, upload_to='payloads/'),
+        ),
+    ]
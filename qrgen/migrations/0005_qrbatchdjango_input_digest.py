@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0004_qrbatchdjango_payloads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='input_digest',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0005_qrbatchdjango_input_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='qr_archive',
+            field=models.FileField(blank=True, null=True, upload_to='archives/'),
+        ),
+    ]
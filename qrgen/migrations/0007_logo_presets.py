@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0006_qrbatchdjango_qr_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogoPreset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('image', models.ImageField(upload_to='logo_presets/')),
+                ('digest', models.CharField(editable=False, max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'qrgen_logopreset',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='logo_preset',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='qrgen.logopreset'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0007_logo_presets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrbatchdjango',
+            name='output_format',
+            field=models.CharField(default='pdf', max_length=10),
+        ),
+    ]
@@ -1,37 +1,118 @@
-import mongoengine as me
-import datetime
 from django.db import models
 from django.conf import settings
 
 PAPER_SIZES = ('A4', 'A3', 'A2')
+BATCH_STATUSES = ('queued', 'rendering', 'done', 'failed')
 
-# MongoDB Models (if MongoDB is available)
-class QRBatch(me.Document):
-    logo = me.FileField(required=True)  # Stores logo in MongoDB GridFS
-    paper_size = me.StringField(choices=PAPER_SIZES, required=True)
-    block_width_mm = me.FloatField(required=True)   # NEW: Width of QR+logo block
-    block_height_mm = me.FloatField(required=True)  # NEW: Height of QR+logo block
-    spacing_mm = me.FloatField(required=True, default=5)
-    created_at = me.DateTimeField(default=datetime.datetime.utcnow)
-    generated_pdf = me.FileField()  # Or use GridFS if using MongoEngine
+# MongoDB documents live in qrgen.documents so that mongoengine is only
+# imported, and MongoDB connected, when they are first used
+MONGO_DOCUMENTS = ('QRBatch', 'QRCode')
+
+
+def __getattr__(name):
+    if name in MONGO_DOCUMENTS:
+        from .mongo import connect_mongodb
+        from . import documents
+        connect_mongodb()
+        return getattr(documents, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-class QRCode(me.Document):
-    batch = me.ReferenceField(QRBatch, reverse_delete_rule=me.CASCADE, required=True)
-    qr_image = me.FileField(required=True)
 
 # Django Models (fallback when MongoDB is not available)
+class LogoPreset(models.Model):
+    """A brand logo uploaded once and picked by ID for any number of batches."""
+    name = models.CharField(max_length=100, unique=True)
+    image = models.ImageField(upload_to='logo_presets/')
+    # SHA-256 of the image; renditions are keyed by it (see qrgen.logos)
+    digest = models.CharField(max_length=64, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'qrgen_logopreset'
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        from .logos import file_digest
+        self.digest = file_digest(self.image)
+        super().save(*args, **kwargs)
+
+    def rendition(self, width_px, height_px):
+        """The letterboxed logo for qrgen.pdf, rendered once per pixel size."""
+        from .logos import preset_rendition
+        return preset_rendition(self, width_px, height_px)
+
+
 class QRBatchDjango(models.Model):
     logo = models.FileField(upload_to='logos/')
+    # Set when the logo came from a preset; ``logo`` then names the preset's file
+    logo_preset = models.ForeignKey(LogoPreset, on_delete=models.SET_NULL, blank=True, null=True)
     paper_size = models.CharField(max_length=10, choices=[(size, size) for size in PAPER_SIZES])
     block_width_mm = models.FloatField()
     block_height_mm = models.FloatField()
     spacing_mm = models.FloatField(default=5)
+    output_encoding = models.CharField(max_length=10, default='flate')
+    # 'pdf' or one of the raster formats of qrgen.sheets
+    output_format = models.CharField(max_length=10, default='pdf')
+    # One-column CSV of text payloads to encode as QR codes (see qrgen.payloads)
+    payloads = models.FileField(upload_to='payloads/', blank=True, null=True)
+    # Zip or tar of QR images, read member by member (see qrgen.archives)
+    qr_archive = models.FileField(upload_to='archives/', blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Stored under a content hash of the inputs and shared by batches with the
+    # same inputs (see qrgen.pdfstore)
     generated_pdf = models.FileField(upload_to='pdfs/', blank=True, null=True)
+    input_digest = models.CharField(max_length=64, blank=True, default='')
+    # Progress of background rendering (see qrgen.tasks)
+    status = models.CharField(max_length=10, choices=[(status, status) for status in BATCH_STATUSES], default='queued')
+    blocks_done = models.PositiveIntegerField(default=0)
+    blocks_total = models.PositiveIntegerField(default=0)
 
     class Meta:
         db_table = 'qrgen_qrbatch'
 
+    def pdf_args(self):
+        """Positional arguments for qrgen.pdf.build_pdf / stream_pdf (and qrgen.sheets.write_sheets)."""
+        preset = self.logo_preset
+        if preset is not None and preset.image.name == self.logo.name:
+            # Drawn from the preset's stored renditions
+            logo = preset
+        else:
+            with self.logo.open('rb') as f:
+                logo = f.read()
+        # QR images are read back lazily, one at a time, while rendering
+        return (self.iter_qr_data(), logo, self.paper_size, self.block_width_mm,
+                self.block_height_mm, self.spacing_mm, self.output_encoding)
+
+    def iter_qr_data(self):
+        """
+        Iterate over the QR images of the batch in upload order, reading one
+        file at a time, then the images in its archive in archive order,
+        followed by its text payloads.
+
+        The database is read straight away; the returned iterator only reads
+        files, so it can be consumed in another thread.
+        """
+        names = list(self.qrcodedjango_set.order_by('id').values_list('qr_image', flat=True))
+        return self._read_qr_data(names)
+
+    def _read_qr_data(self, names):
+        from .archives import iter_archive_qr_data
+        from .payloads import iter_stored_payloads
+        storage = QRCodeDjango._meta.get_field('qr_image').storage
+        for name in names:
+            with storage.open(name, 'rb') as f:
+                yield f.read()
+        if self.qr_archive:
+            with self.qr_archive.open('rb') as f:
+                yield from iter_archive_qr_data(f)
+        if self.payloads:
+            with self.payloads.open('rb') as f:
+                yield from iter_stored_payloads(f)
+
+
 class QRCodeDjango(models.Model):
     batch = models.ForeignKey(QRBatchDjango, on_delete=models.CASCADE)
     qr_image = models.FileField(upload_to='qr_codes/')
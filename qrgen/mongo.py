@@ -0,0 +1,26 @@
+"""
+On-demand MongoDB connection. mongoengine and pymongo are only imported, and
+the connection only registered, the first time a MongoDB document is used.
+"""
+import threading
+from django.conf import settings
+
+_connect_lock = threading.Lock()
+_connected = False
+
+
+def connect_mongodb():
+    """
+    Register the default mongoengine connection if that has not happened yet.
+
+    ``connect=False`` makes pymongo open its sockets on the first query, so
+    this returns straight away even when the server is slow or unreachable.
+    """
+    global _connected
+    if _connected:
+        return
+    with _connect_lock:
+        if not _connected:
+            import mongoengine
+            mongoengine.connect(host=settings.MONGODB_URI, connect=False)
+            _connected = True
@@ -0,0 +1,88 @@
+"""
+Bulk QR payloads: a CSV upload, or a text upload or typed list with one
+payload per line, normalised into a one-column CSV file that is stored with
+the batch and read back lazily.
+"""
+import csv
+import io
+import tempfile
+from django.core.files import File
+
+# Header names that select the payload column of an uploaded CSV
+PAYLOAD_COLUMNS = ('payload', 'data', 'url', 'text', 'content')
+
+
+class PayloadError(ValueError):
+    """An uploaded payload file that cannot be read; the message is shown on the form."""
+
+
+def iter_csv_payloads(text_file):
+    """
+    Payloads of a CSV file. If the first row names a column from
+    PAYLOAD_COLUMNS that column is used, otherwise the first column.
+    """
+    reader = csv.reader(text_file)
+    column = 0
+    for line_number, row in enumerate(reader):
+        if line_number == 0:
+            header = [cell.strip().lower() for cell in row]
+            matches = [name for name in PAYLOAD_COLUMNS if name in header]
+            if matches:
+                column = header.index(matches[0])
+                continue
+        if column < len(row) and row[column].strip():
+            yield row[column].strip()
+
+
+def iter_text_payloads(text):
+    """One payload per non-empty line of a str or a text file; commas and quotes are kept."""
+    for line in text.splitlines() if isinstance(text, str) else text:
+        if line.strip():
+            yield line.strip()
+
+
+def _is_csv(upload):
+    """Only .csv files are parsed as CSV; anything else (e.g. .txt) is one payload per line."""
+    name = (getattr(upload, 'name', None) or '').lower()
+    if name.endswith('.csv'):
+        return True
+    return not name.endswith('.txt') and getattr(upload, 'content_type', None) == 'text/csv'
+
+
+def spool_payloads(payload_file=None, payload_text=''):
+    """
+    Normalise the uploaded payloads into a temporary one-column CSV.
+    Returns (File, number of payloads), or (None, 0) when there are none.
+    Raises PayloadError if the file is not UTF-8 text.
+    """
+    spooled = tempfile.TemporaryFile()
+    writer_stream = io.TextIOWrapper(spooled, encoding='utf-8', newline='')
+    writer = csv.writer(writer_stream)
+    count = 0
+    sources = [iter_text_payloads(payload_text or '')]
+    if payload_file is not None:
+        payload_file.seek(0)
+        text_file = io.TextIOWrapper(payload_file, encoding='utf-8-sig', newline='')
+        sources.append(iter_csv_payloads(text_file) if _is_csv(payload_file) else iter_text_payloads(text_file))
+    try:
+        for source in sources:
+            for payload in source:
+                writer.writerow([payload])
+                count += 1
+    except UnicodeDecodeError:
+        writer_stream.close()
+        raise PayloadError("The payload file is not UTF-8 text.")
+    writer_stream.flush()
+    writer_stream.detach()
+    if not count:
+        spooled.close()
+        return None, 0
+    spooled.seek(0)
+    return File(spooled, name='payloads.csv'), count
+
+
+def iter_stored_payloads(binary_file):
+    """Read back a file written by spool_payloads(), one row at a time."""
+    for row in csv.reader(io.TextIOWrapper(binary_file, encoding='utf-8', newline='')):
+        if row:
+            yield row[0]
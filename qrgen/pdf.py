@@ -0,0 +1,365 @@
+import hashlib
+import zlib
+from io import BytesIO
+from PIL import Image
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A4, A3, A2
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from django.conf import settings
+from .logos import prepare_logo
+from .metrics import stage
+from .qrmatrix import VectorQR
+from .rendering import RENDER_SCALE, render_blocks
+
+PAPER_SIZE_MAP = {'A4': A4, 'A3': A3, 'A2': A2}
+
+COLOR_SPACES = {'L': b'/DeviceGray', 'RGB': b'/DeviceRGB', 'CMYK': b'/DeviceCMYK'}
+
+
+class FlateImage:
+    """Raw pixels already compressed with zlib; StreamingCanvas embeds them as they are."""
+    __slots__ = ('width', 'height', 'mode', 'data')
+
+    def __init__(self, width, height, mode, data):
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.data = data
+
+
+def _fmt(value):
+    """Format a number the way PDF operators expect it."""
+    return (b'%.4f' % value).rstrip(b'0').rstrip(b'.') or b'0'
+
+
+class StreamingCanvas:
+    """
+    Minimal PDF writer with the subset of the reportlab canvas API used by
+    the layout code (drawImage, rect, showPage, save).
+
+    Every finished page is written out immediately; call drain() to collect
+    the bytes produced so far. Only the page currently being drawn is kept in
+    memory, plus the offsets needed for the cross-reference table.
+
+    Between pages, checkpoint() returns that state as JSON-serializable data;
+    a canvas created with it carries on after the bytes already written.
+    """
+
+    def __init__(self, pagesize=A4, checkpoint=None):
+        self._pagesize = pagesize
+        self._pending = []
+        self._offset = 0
+        self._offsets = {}
+        self._next_obj = 3  # 1 = catalog, 2 = page tree (written by save())
+        self._page_refs = []
+        self._page_ops = []
+        self._page_images = {}
+        self._images = {}  # content digest -> (resource name, object number)
+        self._images_by_id = {}  # id(image) -> (image, resource name, object number), see reuse_image()
+        if checkpoint is not None:
+            self._offset = checkpoint['offset']
+            self._offsets = {int(num): offset for num, offset in checkpoint['offsets'].items()}
+            self._next_obj = checkpoint['next_obj']
+            self._page_refs = checkpoint['page_refs']
+            self._images = {bytes.fromhex(digest): (name.encode('ascii'), num)
+                            for digest, (name, num) in checkpoint['images'].items()}
+            return
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self._write_obj(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+    def _write(self, data):
+        self._pending.append(data)
+        self._offset += len(data)
+
+    def _alloc(self):
+        num = self._next_obj
+        self._next_obj += 1
+        return num
+
+    def _write_obj(self, num, body, stream=None):
+        self._offsets[num] = self._offset
+        self._write(b'%d 0 obj\n' % num + body)
+        if stream is not None:
+            self._write(b'\nstream\n')
+            self._write(stream)
+            self._write(b'\nendstream')
+        self._write(b'\nendobj\n')
+
+    def _image_xobject(self, image):
+        bits = 8
+        filter_name = b'/FlateDecode'
+        compressed = False
+        if isinstance(image, ImageReader) and image.jpeg_fh() is not None:
+            image = image.jpeg_fh()
+
+        if isinstance(image, ImageReader):
+            data = image.getRGBData()
+            width, height = image.getSize()
+            mode = image.mode
+        elif isinstance(image, Image.Image):
+            if image.mode == '1':
+                # PIL packs 1-bit rows MSB first and pads them to whole bytes,
+                # which is exactly the PDF layout (0 = black, 1 = white)
+                bits = 1
+                mode = 'L'
+            elif image.mode not in COLOR_SPACES:
+                image = image.convert('RGB')
+                mode = 'RGB'
+            else:
+                mode = image.mode
+            data = image.tobytes()
+            width, height = image.size
+        elif isinstance(image, FlateImage):
+            data, width, height, mode = image.data, image.width, image.height, image.mode
+            compressed = True
+        else:
+            # Already JPEG encoded: embed the file as is
+            image.seek(0)
+            data = image.read()
+            with Image.open(BytesIO(data)) as header:
+                width, height = header.size
+                mode = header.mode
+            filter_name = b'/DCTDecode'
+
+        digest = hashlib.md5(b'%d %d %d %s ' % (width, height, bits, filter_name))
+        digest.update(data)
+        digest = digest.digest()
+        if digest in self._images:
+            return self._images[digest]
+
+        if filter_name == b'/FlateDecode' and not compressed:
+            data = zlib.compress(data)
+        num = self._alloc()
+        name = b'Im%d' % len(self._images)
+        self._write_obj(num, b'<< /Type /XObject /Subtype /Image /Width %d /Height %d '
+                             b'/ColorSpace %s /BitsPerComponent %d /Filter %s /Length %d >>'
+                        % (width, height, COLOR_SPACES[mode], bits, filter_name, len(data)), data)
+        self._images[digest] = (name, num)
+        return name, num
+
+    def reuse_image(self, image):
+        """
+        Keep ``image`` (e.g. the logo drawn in every block) so that drawing
+        the same object again skips hashing its pixels. Only for images drawn
+        many times: every registered image stays in memory until the end.
+        """
+        name, num = self._image_xobject(image)
+        # Kept referenced so its id cannot be reused
+        self._images_by_id[id(image)] = (image, name, num)
+
+    def drawImage(self, image, x, y, width=None, height=None, mask=None, **kwargs):
+        known = self._images_by_id.get(id(image))
+        if known is not None and known[0] is image:
+            name, num = known[1:]
+        else:
+            name, num = self._image_xobject(image)
+        self._page_images[name] = num
+        self._page_ops.append(b'q %s 0 0 %s %s %s cm /%s Do Q'
+                              % (_fmt(width), _fmt(height), _fmt(x), _fmt(y), name))
+
+    def rect(self, x, y, width, height, stroke=1, fill=0):
+        operator = {(1, 0): b'S', (0, 1): b'f', (1, 1): b'B'}.get((stroke, fill), b'n')
+        self._page_ops.append(b'%s %s %s %s re %s' % (_fmt(x), _fmt(y), _fmt(width), _fmt(height), operator))
+
+    def showPage(self):
+        content = zlib.compress(b'\n'.join(self._page_ops))
+        content_num = self._alloc()
+        self._write_obj(content_num, b'<< /Filter /FlateDecode /Length %d >>' % len(content), content)
+
+        xobjects = b' '.join(b'/%s %d 0 R' % (name, num) for name, num in self._page_images.items())
+        page_num = self._alloc()
+        self._write_obj(page_num, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] '
+                                  b'/Resources << /ProcSet [/PDF /ImageB /ImageC] /XObject << %s >> >> '
+                                  b'/Contents %d 0 R >>'
+                        % (_fmt(self._pagesize[0]), _fmt(self._pagesize[1]), xobjects, content_num))
+        self._page_refs.append(page_num)
+        self._page_ops = []
+        self._page_images = {}
+
+    def save(self):
+        if self._page_ops or not self._page_refs:
+            self.showPage()
+        kids = b' '.join(b'%d 0 R' % num for num in self._page_refs)
+        self._write_obj(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self._page_refs)))
+
+        xref_offset = self._offset
+        self._write(b'xref\n0 %d\n0000000000 65535 f \n' % self._next_obj)
+        self._write(b''.join(b'%010d 00000 n \n' % self._offsets[num] for num in range(1, self._next_obj)))
+        self._write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (self._next_obj, xref_offset))
+
+    def checkpoint(self):
+        """State to restore the canvas from; only valid between pages and once drained."""
+        if self._page_ops or self._pending:
+            raise ValueError("Checkpoints are taken between pages, after drain()")
+        return {
+            'offset': self._offset,
+            'offsets': self._offsets,
+            'next_obj': self._next_obj,
+            'page_refs': self._page_refs,
+            'images': {digest.hex(): (name.decode('ascii'), num) for digest, (name, num) in self._images.items()},
+        }
+
+    def drain(self):
+        """Return the bytes written since the last call."""
+        data = b''.join(self._pending)
+        self._pending = []
+        return data
+
+
+def _drawable(c, block):
+    """Wrap a rendered block in what ``c.drawImage`` expects."""
+    if isinstance(block, bytes):
+        block = BytesIO(block)
+    if isinstance(c, StreamingCanvas):
+        # Takes 1-bit images and JPEG files as they are
+        return block
+    if isinstance(block, Image.Image) and block.mode == '1':
+        # reportlab would expand 1-bit images to RGB; grayscale is a third of that
+        block = block.convert('L')
+    return ImageReader(block)
+
+
+def letterboxed_logo(logo, width_px, height_px):
+    """The logo (bytes or a LogoPreset, see draw_pages) letterboxed to ``width_px`` x ``height_px``."""
+    if isinstance(logo, bytes):
+        return prepare_logo(logo, width_px, height_px)
+    return logo.rendition(width_px, height_px)
+
+
+def page_grid(paper_size, block_width_mm, block_height_mm, spacing_mm):
+    """
+    Where blocks go on a page, in points: (blocks_per_row, rows_per_page,
+    x_start, y_start, step_x, step_y). The block in ``row``, ``col`` has its
+    bottom-left corner at (x_start + col * step_x, y_start - row * step_y).
+    """
+    page_size = PAPER_SIZE_MAP[paper_size]
+    block_w = float(block_width_mm) * mm
+    block_h = float(block_height_mm) * mm
+    spacing_between_blocks = float(spacing_mm) * mm
+
+    blocks_per_row = max(1, int((page_size[0] + spacing_between_blocks) // (block_w + spacing_between_blocks)))
+    x_margin = (page_size[0] - (blocks_per_row * (block_w + spacing_between_blocks) - spacing_between_blocks)) / 2
+    y_start = page_size[1] - spacing_between_blocks - block_h
+    step_x = block_w + spacing_between_blocks
+    step_y = block_h + spacing_between_blocks
+
+    # The same test as draw_pages uses to start a new page
+    rows_per_page = 1
+    while y_start - rows_per_page * step_y >= spacing_between_blocks:
+        rows_per_page += 1
+    return blocks_per_row, rows_per_page, x_margin, y_start, step_x, step_y
+
+
+def draw_pages(c, qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm, encoding='flate',
+               progress=None):
+    """
+    Lay the QR blocks out on ``c`` in a grid. Yields each time a page has been
+    finished with showPage(), with the number of inputs on the finished
+    pages; the caller is responsible for c.save().
+
+    ``logo`` is the logo image file as bytes, or a LogoPreset (anything with
+    a ``rendition(width_px, height_px)`` method returning the letterboxed
+    logo). ``progress`` is called with the number of blocks handled so far
+    (drawn or skipped) after each block.
+    """
+    # Block dimensions
+    block_w = float(block_width_mm) * mm
+    block_h = float(block_height_mm) * mm
+    spacing_between_blocks = float(spacing_mm) * mm
+
+    qr_width = logo_width = block_w / 2
+    qr_height = logo_height = block_h
+
+    blocks_per_row, _, x_start, y_start, step_x, step_y = page_grid(
+        paper_size, block_width_mm, block_height_mm, spacing_mm)
+
+    # Process logo once; the same image object is drawn in every block so
+    # the PDF holds a single copy that every block position references
+    with stage('logo'):
+        logo_px = int(logo_width * RENDER_SCALE), int(logo_height * RENDER_SCALE)
+        logo_image = _drawable(c, letterboxed_logo(logo, *logo_px))
+        if isinstance(c, StreamingCanvas):
+            c.reuse_image(logo_image)
+
+    row = 0
+    col = 0
+    x = x_start
+    y = y_start
+
+    block_args = (qr_width, qr_height, encoding, settings.QRGEN_JPEG_QUALITY)
+    blocks = render_blocks(qr_data_list, block_args)
+    blocks_done = 0
+    while True:
+        # Time spent waiting for blocks from the render pool (or rendering
+        # them inline), reading QR images back included
+        with stage('render'):
+            block = next(blocks, StopIteration)
+        if block is StopIteration:
+            break
+        blocks_done += 1
+        if block is None:
+            if progress is not None:
+                progress(blocks_done)
+            continue
+
+        # Position
+        x = x_start + col * step_x
+        y = y_start - row * step_y
+
+        if y < spacing_between_blocks:
+            with stage('page'):
+                c.showPage()
+            # This block goes on the next page
+            yield blocks_done - 1
+            row = 0
+            col = 0
+            x = x_start
+            y = y_start
+
+        with stage('draw'):
+            if isinstance(block, VectorQR):
+                # Modules as filled rectangles (default fill colour is black);
+                # the fractions are measured from the top of the QR image
+                for fx, fy, fw, fh in block.rects:
+                    c.rect(x + fx * qr_width, y + (1 - fy - fh) * qr_height,
+                           fw * qr_width, fh * qr_height, stroke=0, fill=1)
+            else:
+                c.drawImage(_drawable(c, block), x, y, qr_width, qr_height)
+            c.drawImage(logo_image, x + qr_width, y, logo_width, logo_height)
+        col = (col + 1) % blocks_per_row
+        if col == 0:
+            row += 1
+        if progress is not None:
+            progress(blocks_done)
+
+
+def build_pdf(qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm, encoding='flate',
+              progress=None):
+    """Render the whole batch into memory and return the PDF bytes."""
+    buffer = BytesIO()
+    # invariant: no timestamp or random document ID, so the same inputs give the same bytes
+    c = canvas.Canvas(buffer, pagesize=PAPER_SIZE_MAP[paper_size], invariant=1)
+    for _ in draw_pages(c, qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm, encoding,
+                        progress):
+        pass
+    with stage('save'):
+        c.save()
+    pdf = buffer.getvalue()
+    buffer.close()
+    return pdf
+
+
+def stream_pdf(qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm, encoding='flate',
+               progress=None):
+    """Yield the PDF in pieces, one finished page at a time."""
+    c = StreamingCanvas(pagesize=PAPER_SIZE_MAP[paper_size])
+    # Send the header straight away so proxies see the first byte early
+    yield c.drain()
+    for _ in draw_pages(c, qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm, encoding,
+                        progress):
+        yield c.drain()
+    with stage('save'):
+        c.save()
+    yield c.drain()
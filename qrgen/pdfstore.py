@@ -0,0 +1,294 @@
+"""
+Finished PDFs are kept in storage under a content hash of everything that
+goes into them (logo, layout, QR images and payloads, render settings), so
+a repeated download, a resumed transfer or another batch with the same
+inputs is served from the stored file instead of being rendered again.
+
+The hash doubles as the ETag. Stored PDFs are deleted once they are older
+than QRGEN_PDF_RETENTION_SECONDS; the next download renders them again.
+Batches are deleted with their uploaded files once they are as old.
+"""
+import hashlib
+import logging
+import posixpath
+import re
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from .checkpoints import checkpointed, clear_checkpoint, expire_checkpoints
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever a change to the rendering changes the bytes of a document, so
+# that PDFs stored by the previous version are not served under the new hash
+PDF_FORMAT_VERSION = 1
+
+PDF_DIR = 'pdfs'
+# Stored file extension of each output format (see qrgen.rendering.OUTPUT_FORMATS)
+OUTPUT_EXTENSIONS = {'pdf': '.pdf', 'pdf_raster': '.pdf', 'tiff': '.tiff', 'png': '.zip'}
+CONTENT_TYPES = {'.pdf': 'application/pdf', '.tiff': 'image/tiff', '.zip': 'application/zip'}
+RANGE_CHUNK_SIZE = 64 * 1024
+# Minimum number of seconds between two expiry sweeps started by a download
+EXPIRY_SWEEP_INTERVAL = 3600
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_last_sweep = 0.0
+
+
+def _storage():
+    from .models import QRBatchDjango
+    return QRBatchDjango._meta.get_field('generated_pdf').storage
+
+
+def hash_inputs(batch, logo_digest, qr_images, qr_archive=None, payloads=None):
+    """
+    Hash of the batch inputs: its layout, the logo (its qrgen.logos.file_digest)
+    and the contents of its QR image, archive and payload files. _create_batch
+    computes it from the uploads while it spools them.
+    """
+    from .logos import file_digest
+    digest = hashlib.sha256()
+    digest.update(repr((batch.paper_size, batch.block_width_mm, batch.block_height_mm,
+                        batch.spacing_mm, batch.output_encoding)).encode('ascii'))
+    digest.update(b'logo\0' + logo_digest.encode('ascii'))
+    for qr_image in qr_images:
+        digest.update(b'qr_image\0' + file_digest(qr_image).encode('ascii'))
+    for kind, f in ((b'qr_archive', qr_archive), (b'payloads', payloads)):
+        if f:
+            digest.update(kind + b'\0' + file_digest(f).encode('ascii'))
+    return digest.hexdigest()
+
+
+def _open_each(storage, names):
+    for name in names:
+        with storage.open(name, 'rb') as f:
+            yield f
+
+
+def input_digest(batch):
+    """Hash of the batch inputs; read back from storage for batches saved without one."""
+    from .logos import file_digest
+    from .models import QRCodeDjango
+    if not batch.input_digest:
+        storage = QRCodeDjango._meta.get_field('qr_image').storage
+        names = batch.qrcodedjango_set.order_by('id').values_list('qr_image', flat=True)
+        batch.input_digest = hash_inputs(batch, file_digest(batch.logo), _open_each(storage, names),
+                                         batch.qr_archive, batch.payloads)
+        batch.save(update_fields=['input_digest'])
+    return batch.input_digest
+
+
+def pdf_digest(batch, writer=None):
+    """
+    Content hash of the batch's PDF: its inputs plus the settings that change
+    the output. ``writer`` is 'stream' or 'reportlab' (default: the one
+    download_pdf uses); the raster formats have a writer of their own.
+    Batches rendered with checkpoints always use the streaming writer.
+    """
+    if batch.output_format != 'pdf':
+        writer = batch.output_format
+    elif checkpointed(batch):
+        writer = 'stream'
+    writer = writer or ('stream' if settings.QRGEN_STREAM_PDF else 'reportlab')
+    key = '%d %s %s %d' % (PDF_FORMAT_VERSION, input_digest(batch), writer, settings.QRGEN_JPEG_QUALITY)
+    return hashlib.sha256(key.encode('ascii')).hexdigest()
+
+
+def stored_pdf_digest(name):
+    """ETag value of a stored PDF: the hash in its file name."""
+    return posixpath.splitext(posixpath.basename(name))[0]
+
+
+def _is_expired(storage, name, now=None):
+    retention = settings.QRGEN_PDF_RETENTION_SECONDS
+    if not retention:
+        return False
+    cutoff = (now or timezone.now()) - timedelta(seconds=retention)
+    return storage.get_modified_time(name) < cutoff
+
+
+def _stored_name(digest, output_format):
+    return posixpath.join(PDF_DIR, digest + OUTPUT_EXTENSIONS[output_format])
+
+
+def stored_pdf(digest, output_format='pdf'):
+    """Name of the stored document for ``digest``, or None if it is missing or expired."""
+    storage = _storage()
+    name = _stored_name(digest, output_format)
+    try:
+        if not storage.exists(name):
+            return None
+        if _is_expired(storage, name):
+            storage.delete(name)
+            return None
+    except OSError:
+        return None
+    return name
+
+
+def store_pdf(batch, digest, pdf_file):
+    """Save a rendered document under its hash (unless already there) and point the batch at it."""
+    storage = _storage()
+    name = _stored_name(digest, batch.output_format)
+    if not storage.exists(name):
+        name = storage.save(name, File(pdf_file))
+    batch.generated_pdf.name = name
+    batch.save(update_fields=['generated_pdf'])
+    clear_checkpoint(digest)
+    maybe_expire_stored_pdfs()
+    return name
+
+
+def expire_stored_pdfs(now=None):
+    """
+    Delete stored PDFs older than the retention period, and checkpoints of
+    renders abandoned for that long; returns the names of the PDFs.
+    """
+    from .models import QRBatchDjango
+    if not settings.QRGEN_PDF_RETENTION_SECONDS:
+        return []
+    expire_checkpoints(now)
+    storage = _storage()
+    try:
+        _, filenames = storage.listdir(PDF_DIR)
+    except FileNotFoundError:
+        return []
+    expired = []
+    for filename in filenames:
+        name = posixpath.join(PDF_DIR, filename)
+        try:
+            if _is_expired(storage, name, now):
+                storage.delete(name)
+                expired.append(name)
+        except OSError:
+            continue  # Deleted by another worker in the meantime
+    if expired:
+        QRBatchDjango.objects.filter(generated_pdf__in=expired).update(generated_pdf=None)
+    return expired
+
+
+def expire_batches(now=None):
+    """
+    Delete batches created before the retention period, with their logo, QR
+    images, archive and payloads; returns the number of batches. Logo presets
+    and stored PDFs, which other batches share, are left alone.
+    """
+    from .models import LogoPreset, QRBatchDjango, QRCodeDjango
+    retention = settings.QRGEN_PDF_RETENTION_SECONDS
+    if not retention:
+        return 0
+    cutoff = (now or timezone.now()) - timedelta(seconds=retention)
+    preset_dir = LogoPreset._meta.get_field('image').upload_to
+    batches = QRBatchDjango.objects.filter(created_at__lt=cutoff)
+    storage = _storage()
+    names = list(QRCodeDjango.objects.filter(batch__in=batches).values_list('qr_image', flat=True))
+    for logo, archive, payloads in batches.values_list('logo', 'qr_archive', 'payloads'):
+        if logo and not logo.startswith(preset_dir):
+            names.append(logo)
+        names.extend(name for name in (archive, payloads) if name)
+    count = len(batches)
+    # Rows first: a file whose row is gone is never read again
+    batches.delete()
+    for name in names:
+        try:
+            storage.delete(name)
+        except OSError:
+            continue
+    return count
+
+
+def maybe_expire_stored_pdfs():
+    """Run expire_stored_pdfs() and expire_batches() at most once per EXPIRY_SWEEP_INTERVAL in this process."""
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep < EXPIRY_SWEEP_INTERVAL:
+        return
+    _last_sweep = now
+    try:
+        expired = expire_stored_pdfs()
+        batches = expire_batches()
+    except Exception:
+        logger.exception("Expiring stored PDFs failed")
+        return
+    if expired or batches:
+        logger.info("Expired %d stored PDFs and %d batches", len(expired), batches)
+
+
+def not_modified(request, digest):
+    """304 (or 412) response if the client already has this version of the PDF, else None."""
+    return get_conditional_response(request, etag=quote_etag(digest))
+
+
+def _byte_range(header, size):
+    """
+    (start, end) of a single-range ``Range`` header, None to send the whole
+    file (missing, malformed or multi-range headers) or False if the range
+    cannot be satisfied.
+    """
+    match = _RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def pdf_file_response(request, name, digest):
+    """
+    Serve a stored document. Whole files go out through FileResponse so the
+    WSGI server can use sendfile; a ``Range`` request gets a 206 with that part.
+    """
+    storage = _storage()
+    extension = posixpath.splitext(name)[1]
+    content_type = CONTENT_TYPES.get(extension, 'application/octet-stream')
+    filename = 'qrcodes' + extension
+    size = storage.size(name)
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if request.method == 'GET' and (if_range is None or if_range == quote_etag(digest)):
+        byte_range = _byte_range(request.headers.get('Range'), size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+    elif byte_range is None:
+        response = FileResponse(storage.open(name, 'rb'), as_attachment=True,
+                                filename=filename, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(_read_range(storage.open(name, 'rb'), start, end - start + 1),
+                                         status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = end - start + 1
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    response['ETag'] = quote_etag(digest)
+    response['Accept-Ranges'] = 'bytes'
+    return response
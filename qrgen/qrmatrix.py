@@ -0,0 +1,388 @@
+"""
+Read the module grid of a QR code from a raster image or an SVG so it can be
+drawn as vector rectangles instead of an embedded bitmap.
+"""
+import math
+import re
+import struct
+from PIL import Image
+try:
+    from defusedxml import ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+# Luminance below which a pixel or fill colour counts as a dark module
+DARK_THRESHOLD = 128
+
+NAMED_COLORS = {'black': 0, 'white': 255, 'none': None, 'transparent': None}
+
+_NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+_number_re = re.compile(_NUMBER)
+_path_token_re = re.compile(r'[MmHhVvLlZz]|' + _NUMBER)
+_transform_re = re.compile(r'(matrix|translate|scale)\s*\(([^)]*)\)')
+
+
+class VectorQR:
+    """
+    Merged dark rectangles of a QR code as (x, y, w, h) fractions of the
+    source image, measured from its top-left corner.
+    """
+    __slots__ = ('rects',)
+    MAGIC = b'VQR1'
+
+    def __init__(self, rects):
+        self.rects = rects
+
+    def __len__(self):
+        return len(self.rects)
+
+    def to_bytes(self):
+        return self.MAGIC + b''.join(struct.pack('<4d', *rect) for rect in self.rects)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls([rect for rect in struct.iter_unpack('<4d', data[len(cls.MAGIC):])])
+
+
+class QRMatrix:
+    """Dark modules of a QR code and where its grid sits inside the source image."""
+
+    def __init__(self, modules, left, top, module_w, module_h):
+        self.modules = modules
+        self.left = left
+        self.top = top
+        self.module_w = module_w
+        self.module_h = module_h
+
+    @property
+    def size(self):
+        return len(self.modules)
+
+    def has_finder_patterns(self):
+        n = self.size
+        if n < 21:
+            return False
+        for row0, col0 in ((0, 0), (0, n - 7), (n - 7, 0)):
+            for r in range(7):
+                for c in range(7):
+                    ring = max(abs(r - 3), abs(c - 3))
+                    if self.modules[row0 + r][col0 + c] != (ring != 2):
+                        return False
+        return True
+
+    def merged_rects(self):
+        """Horizontal runs of dark modules, merged down across identical rows."""
+        open_rects = {}  # (col, width) -> [col, row, width, height]
+        rects = []
+        for row, line in enumerate(self.modules):
+            runs = set()
+            col = 0
+            while col < len(line):
+                if line[col]:
+                    start = col
+                    while col < len(line) and line[col]:
+                        col += 1
+                    runs.add((start, col - start))
+                else:
+                    col += 1
+            for key in list(open_rects):
+                if key not in runs:
+                    rects.append(open_rects.pop(key))
+            for key in runs:
+                if key in open_rects:
+                    open_rects[key][3] += 1
+                else:
+                    open_rects[key] = [key[0], row, key[1], 1]
+        rects.extend(open_rects.values())
+        return rects
+
+    def to_image(self, width, height):
+        """Render the grid as a grayscale image, module edges kept sharp."""
+        n = self.size
+        # Whole image in module units, quiet zone included
+        total_w = round(1 / self.module_w)
+        total_h = round(1 / self.module_h)
+        col0 = round(self.left / self.module_w)
+        row0 = round(self.top / self.module_h)
+        grid = Image.new("L", (total_w, total_h), 255)
+        grid.putdata([0 if 0 <= r - row0 < n and 0 <= c - col0 < n and self.modules[r - row0][c - col0] else 255
+                      for r in range(total_h) for c in range(total_w)])
+        return grid.resize((width, height), resample=Image.Resampling.NEAREST)
+
+    def to_vector(self):
+        return VectorQR([(self.left + col * self.module_w, self.top + row * self.module_h,
+                          width * self.module_w, height * self.module_h)
+                         for col, row, width, height in self.merged_rects()])
+
+
+def _is_qr_size(n):
+    return n >= 21 and (n - 17) % 4 == 0
+
+
+def matrix_from_image(img):
+    """Sample the module grid of a clean raster QR code, or return None."""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        flat = Image.new("RGBA", img.size, (255, 255, 255, 255))
+        flat.alpha_composite(img.convert("RGBA"))
+        img = flat
+    dark = img.convert("L").point(lambda p: 255 if p < DARK_THRESHOLD else 0)
+    bbox = dark.getbbox()
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    pixels = dark.load()
+
+    # The top-left finder pattern starts the first dark row with 7 modules
+    run = 0
+    while left + run < right and pixels[left + run, top]:
+        run += 1
+    if run < 7:
+        return None
+    n = round((right - left) / (run / 7))
+    if not _is_qr_size(n):
+        return None
+
+    module_w = (right - left) / n
+    module_h = (bottom - top) / n
+    modules = [[bool(pixels[int(left + (col + 0.5) * module_w), int(top + (row + 0.5) * module_h)])
+                for col in range(n)]
+               for row in range(n)]
+    matrix = QRMatrix(modules, left / img.width, top / img.height,
+                      module_w / img.width, module_h / img.height)
+    return matrix if matrix.has_finder_patterns() else None
+
+
+def matrix_from_payload(payload, border=4):
+    """Encode ``payload`` as a QR code with a ``border`` module quiet zone."""
+    import qrcode
+    qr = qrcode.QRCode(border=0)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    modules = qr.get_matrix()
+    fraction = 1 / (len(modules) + 2 * border)
+    return QRMatrix(modules, border * fraction, border * fraction, fraction, fraction)
+
+
+def _luminance(color):
+    """0-255 luminance of an SVG colour, None for no paint."""
+    color = (color or '').strip().lower()
+    if color in NAMED_COLORS:
+        return NAMED_COLORS[color]
+    if color.startswith('#'):
+        digits = color[1:]
+        if len(digits) in (3, 4):
+            digits = ''.join(d * 2 for d in digits[:3])
+        try:
+            r, g, b = (int(digits[i:i + 2], 16) for i in (0, 2, 4))
+        except ValueError:
+            return 0
+        return 0.299 * r + 0.587 * g + 0.114 * b
+    if color.startswith('rgb'):
+        values = [float(v) for v in _number_re.findall(color)[:3]]
+        if len(values) == 3:
+            return 0.299 * values[0] + 0.587 * values[1] + 0.114 * values[2]
+    return 0  # Unknown colours are assumed to be dark
+
+
+def _length(value):
+    """Parse an SVG length, ignoring its unit."""
+    match = _number_re.match((value or '').strip())
+    return float(match.group()) if match else None
+
+
+def _style(element, name, inherited):
+    style = dict(part.split(':', 1) for part in element.get('style', '').split(';') if ':' in part)
+    style = {key.strip(): value.strip() for key, value in style.items()}
+    return style.get(name, element.get(name, inherited.get(name)))
+
+
+def _parse_transform(value, transform):
+    """Compose an axis-aligned transform (sx, sy, tx, ty) with ``transform``."""
+    sx, sy, tx, ty = transform
+    for name, args in _transform_re.findall(value or ''):
+        args = [float(a) for a in _number_re.findall(args)]
+        if name == 'translate':
+            a, d, e, f = 1, 1, args[0], args[1] if len(args) > 1 else 0
+        elif name == 'scale':
+            a, d, e, f = args[0], args[1] if len(args) > 1 else args[0], 0, 0
+        else:
+            a, b, c, d, e, f = args
+            if b or c:
+                raise ValueError("Rotated or skewed SVG transforms are not supported")
+        sx, sy, tx, ty = sx * a, sy * d, tx + sx * e, ty + sy * f
+    return sx, sy, tx, ty
+
+
+def _rect_edges(x, y, w, h, transform):
+    """Vertical edges of a clockwise rectangle as (x, y_from, y_to)."""
+    sx, sy, tx, ty = transform
+    x0, x1 = tx + sx * x, tx + sx * (x + w)
+    y0, y1 = ty + sy * y, ty + sy * (y + h)
+    return [(x1, y0, y1), (x0, y1, y0)]
+
+
+def _path_shapes(d):
+    """Split path data into subpaths of absolute points (M/H/V/L/Z only)."""
+    tokens = _path_token_re.findall(d)
+    subpaths = []
+    points = []
+    x = y = 0.0
+    command = None
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token.isalpha():
+            command = token
+            i += 1
+            if command in 'Zz':
+                if points:
+                    x, y = points[0]
+                    subpaths.append((points, True))
+                points = []
+            continue
+        if command is None:
+            raise ValueError("Path data must start with a command")
+        if command in 'Mm':
+            if points:
+                subpaths.append((points, False))
+            dx, dy = float(tokens[i]), float(tokens[i + 1])
+            x, y = (x + dx, y + dy) if command == 'm' else (dx, dy)
+            points = [(x, y)]
+            i += 2
+            # Further coordinate pairs after a moveto are implicit linetos
+            command = 'l' if command == 'm' else 'L'
+            continue
+        if command in 'Ll':
+            dx, dy = float(tokens[i]), float(tokens[i + 1])
+            x, y = (x + dx, y + dy) if command == 'l' else (dx, dy)
+            i += 2
+        elif command in 'Hh':
+            value = float(tokens[i])
+            x = x + value if command == 'h' else value
+            i += 1
+        elif command in 'Vv':
+            value = float(tokens[i])
+            y = y + value if command == 'v' else value
+            i += 1
+        else:
+            raise ValueError("Unsupported path command %r" % command)
+        points.append((x, y))
+    if points:
+        subpaths.append((points, False))
+    return subpaths
+
+
+def _path_edges(element, transform, inherited):
+    """Vertical edges covered by a <path>, filled or drawn with a square stroke."""
+    sx, sy, tx, ty = transform
+    edges = []
+    subpaths = _path_shapes(element.get('d', ''))
+    stroke = _style(element, 'stroke', inherited)
+    stroke = _luminance(stroke) if stroke else None
+    fill = _style(element, 'fill', inherited)
+    if stroke is not None and stroke < DARK_THRESHOLD:
+        # Line-per-run generators (e.g. segno) draw each run as a stroke
+        width = _length(_style(element, 'stroke-width', inherited) or '1')
+        for points, _ in subpaths:
+            for (x0, y0), (x1, y1) in zip(points, points[1:]):
+                if y0 == y1:
+                    edges += _rect_edges(min(x0, x1), y0 - width / 2, abs(x1 - x0), width, transform)
+                elif x0 == x1:
+                    edges += _rect_edges(x0 - width / 2, min(y0, y1), width, abs(y1 - y0), transform)
+                else:
+                    raise ValueError("Diagonal strokes are not supported")
+    lum = _luminance(fill if fill is not None else 'black')
+    if lum is not None and lum < DARK_THRESHOLD and (fill is not None or stroke is None):
+        for points, _ in subpaths:
+            # Fill implicitly closes every subpath
+            for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+                if x0 == x1 and y0 != y1:
+                    edges.append((tx + sx * x0, ty + sy * y0, ty + sy * y1))
+                elif y0 != y1:
+                    raise ValueError("Only axis-aligned paths are supported")
+    return edges
+
+
+def matrix_from_svg(svg_bytes):
+    """Read the module grid from a generator-style SVG QR code, or return None."""
+    try:
+        root = ElementTree.fromstring(svg_bytes)
+        edges = []
+        min_extent = None  # Smallest feature, i.e. the module size
+
+        def walk(element, transform, inherited):
+            nonlocal min_extent
+            tag = element.tag.rsplit('}', 1)[-1]
+            transform = _parse_transform(element.get('transform'), transform)
+            inherited = dict(inherited)
+            for name in ('fill', 'stroke', 'stroke-width', 'fill-rule'):
+                value = _style(element, name, inherited)
+                if value is not None:
+                    inherited[name] = value
+            element_edges = []
+            if tag == 'rect':
+                lum = _luminance(_style(element, 'fill', inherited) or 'black')
+                width, height = element.get('width', ''), element.get('height', '')
+                if lum is not None and lum < DARK_THRESHOLD and '%' not in width + height:
+                    element_edges = _rect_edges(_length(element.get('x', '0')), _length(element.get('y', '0')),
+                                                _length(width), _length(height), transform)
+            elif tag == 'path':
+                element_edges = _path_edges(element, transform, inherited)
+            for x, y0, y1 in element_edges:
+                extent = abs(y1 - y0)
+                if extent > 1e-9:
+                    min_extent = extent if min_extent is None else min(min_extent, extent)
+            edges.extend(element_edges)
+            for child in element:
+                walk(child, transform, inherited)
+
+        walk(root, (1.0, 1.0, 0.0, 0.0), {})
+    except (ElementTree.ParseError, ValueError, TypeError, IndexError):
+        return None
+    if not edges or not min_extent:
+        return None
+
+    left = min(x for x, _, _ in edges)
+    right = max(x for x, _, _ in edges)
+    top = min(min(y0, y1) for _, y0, y1 in edges)
+    bottom = max(max(y0, y1) for _, y0, y1 in edges)
+    n = round((right - left) / min_extent)
+    if not _is_qr_size(n) or round((bottom - top) / min_extent) != n:
+        return None
+    module_w = (right - left) / n
+    module_h = (bottom - top) / n
+
+    # Scanline fill at module centres using the nonzero winding rule. Each
+    # edge is filed under the rows whose centre line it crosses, so a row
+    # only looks at its own edges
+    row_edges = [[] for _ in range(n)]
+    for x, y0, y1 in edges:
+        low, high = min(y0, y1), max(y0, y1)
+        first = max(0, math.ceil((low - top) / module_h - 0.5))
+        last = min(n - 1, math.floor((high - top) / module_h - 0.5))
+        for row in range(first, last + 1):
+            row_edges[row].append((x, y0, y1))
+    modules = []
+    for row in range(n):
+        y = top + (row + 0.5) * module_h
+        crossings = sorted((x, 1 if y1 > y0 else -1) for x, y0, y1 in row_edges[row]
+                           if min(y0, y1) < y < max(y0, y1))
+        line = [False] * n
+        winding = 0
+        for (x, direction), following in zip(crossings, crossings[1:] + [(right, 0)]):
+            winding += direction
+            if winding:
+                first = max(0, int((x - left) / module_w + 0.5))
+                last = min(n, int((following[0] - left) / module_w + 0.5))
+                for col in range(first, last):
+                    line[col] = True
+        modules.append(line)
+
+    # Place the grid relative to the viewport the SVG is scaled into
+    view_box = [float(v) for v in _number_re.findall(root.get('viewBox', ''))]
+    if len(view_box) != 4:
+        width, height = _length(root.get('width')), _length(root.get('height'))
+        view_box = [0, 0, width or right, height or bottom]
+    vx, vy, vw, vh = view_box
+    matrix = QRMatrix(modules, (left - vx) / vw, (top - vy) / vh, module_w / vw, module_h / vh)
+    return matrix if matrix.has_finder_patterns() else None
@@ -0,0 +1,416 @@
+import atexit
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+import multiprocessing
+from PIL import Image
+from django.conf import settings
+from .binarize import binarize_images, to_gray
+from .cache import block_args_digest, block_cache_key, get_block_cache
+from .metrics import collect_stages, record_stages, stage
+from .qrmatrix import matrix_from_image, matrix_from_payload, matrix_from_svg
+
+logger = logging.getLogger(__name__)
+
+# Blocks are rasterized at this multiple of their size in points
+RENDER_SCALE = 4
+
+BLOCK_ENCODINGS = [
+    ('flate', 'Lossless (Flate)'),
+    ('jpeg', 'JPEG'),
+    ('1bit', '1-bit black and white'),
+    ('vector', 'Vector (QR drawn as shapes)'),
+]
+
+# 'pdf' draws every block as its own image; the others composite each page
+# into a single image first (see qrgen.sheets)
+OUTPUT_FORMATS = [
+    ('pdf', 'PDF'),
+    ('pdf_raster', 'PDF, one image per page'),
+    ('tiff', 'Multi-page TIFF'),
+    ('png', 'PNG sheets (zip)'),
+]
+
+
+# Not fork: the web process runs render and ASGI threads, and a child forked
+# while one of them holds a lock can deadlock. The forkserver imports this
+# module once, so each worker forked from it starts without importing PIL and
+# Django again. Windows can only spawn.
+POOL_START_METHOD = 'spawn' if os.name == 'nt' else 'forkserver'
+
+# Long-lived pool shared by every request handled by this web worker
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+# Parsed and rasterized SVG uploads by content digest (see _memoize_svg)
+_svg_memo = OrderedDict()
+_svg_memo_lock = threading.Lock()
+
+# cairosvg (and libcairo behind it) is loaded the first time an SVG needs
+# rasterizing; False once it turned out to be unavailable
+_cairosvg = None
+
+
+def get_render_workers():
+    """Number of render processes; 0 or 1 renders on the request thread."""
+    if multiprocessing.current_process().daemon:
+        # Daemonic processes (e.g. Celery prefork workers) cannot start children
+        return 0
+    return int(getattr(settings, 'QRGEN_RENDER_WORKERS', 0) or 0)
+
+
+def get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            context = multiprocessing.get_context(POOL_START_METHOD)
+            if POOL_START_METHOD == 'forkserver':
+                context.set_forkserver_preload([__name__])
+            _process_pool = ProcessPoolExecutor(max_workers=get_render_workers(), mp_context=context)
+        return _process_pool
+
+
+def shutdown_process_pool(pool=None):
+    """Shut the shared pool down. If ``pool`` is given, only if it is still current."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None or (pool is not None and pool is not _process_pool):
+            return
+        old_pool, _process_pool = _process_pool, None
+    old_pool.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(shutdown_process_pool)
+
+
+def submit_to_pool(fn, *args):
+    """
+    Submit ``fn(*args)`` to the shared pool; returns (pool, future). A pool
+    that is broken, or was shut down by another batch after a crash, is
+    replaced.
+    """
+    pool = get_process_pool()
+    try:
+        return pool, pool.submit(fn, *args)
+    except (BrokenProcessPool, RuntimeError):
+        # RuntimeError: cannot schedule new futures after shutdown
+        shutdown_process_pool(pool)
+        pool = get_process_pool()
+        return pool, pool.submit(fn, *args)
+
+
+def render_worker_pids():
+    """Process ids of the running render workers (empty when there is no pool)."""
+    with _process_pool_lock:
+        if _process_pool is None:
+            return []
+        return [process.pid for process in (_process_pool._processes or {}).values()]
+
+
+def get_cairosvg():
+    """The cairosvg module, or None when it or libcairo is not installed."""
+    global _cairosvg
+    if _cairosvg is None:
+        try:
+            import cairosvg
+            _cairosvg = cairosvg
+        except (ImportError, OSError):
+            # OSError: the Python package is installed but libcairo is missing
+            logger.warning("cairosvg not available, SVG QR codes cannot be rasterized")
+            _cairosvg = False
+    return _cairosvg or None
+
+
+def _encode_block(img, encoding, jpeg_quality):
+    """Convert a clean QR image ('1' or 'L') into the block for ``encoding``."""
+    if encoding == '1bit':
+        # Threshold without dithering so every module stays a solid
+        # black or white area
+        return img.convert("1", dither=Image.Dither.NONE)
+    if img.mode not in ('L', 'RGB'):
+        img = img.convert("L")
+    if encoding == 'jpeg':
+        img_io = BytesIO()
+        img.save(img_io, format='JPEG', quality=jpeg_quality)
+        return img_io.getvalue()
+    return img
+
+
+def _memoize_svg(key, compute):
+    """Look ``key`` up in the per-process SVG memo, computing and storing it on a miss."""
+    with _svg_memo_lock:
+        if key in _svg_memo:
+            _svg_memo.move_to_end(key)
+            return _svg_memo[key]
+    value = compute()
+    with _svg_memo_lock:
+        _svg_memo[key] = value
+        while len(_svg_memo) > max(0, int(getattr(settings, 'QRGEN_SVG_MEMO_ENTRIES', 512))):
+            _svg_memo.popitem(last=False)
+    return value
+
+
+def _svg_matrix(svg_bytes):
+    """Module grid of an SVG QR code (None if it is not a plain grid), parsed once per content."""
+    def parse():
+        with stage('svg_parse'):
+            return matrix_from_svg(svg_bytes)
+    return _memoize_svg(('matrix', hashlib.sha256(svg_bytes).digest()), parse)
+
+
+def _rasterize_svg(svg_bytes, width, height):
+    """PNG of an arbitrary SVG through cairosvg, rendered once per content and size."""
+    cairosvg = get_cairosvg()
+    if cairosvg is None:
+        raise ValueError("SVG is not a plain QR module grid and cairosvg is not installed")
+
+    def rasterize():
+        with stage('svg_rasterize'):
+            return cairosvg.svg2png(bytestring=svg_bytes, output_width=width, output_height=height)
+    return _memoize_svg(('png', hashlib.sha256(svg_bytes).digest(), width, height), rasterize)
+
+
+def _decode_qr(qr_data, width, height, encoding):
+    """
+    First stage of process_qr_blocks for one input. Returns ('block', block)
+    when it is already finished, ('image', img) when it only needs encoding
+    or ('gray', img) when it still needs to be binarized.
+    """
+    if isinstance(qr_data, str):
+        with stage('qr_encode'):
+            matrix = matrix_from_payload(qr_data)
+        if encoding == 'vector':
+            with stage('vectorize'):
+                return 'block', matrix.to_vector()
+        with stage('upscale'):
+            return 'image', matrix.to_image(width, height)
+
+    img_bytes = qr_data
+    # Detect if the input is SVG
+    head = img_bytes[:256].lstrip(b'\xef\xbb\xbf \t\r\n')
+    is_svg = head.startswith((b'<?xml', b'<svg', b'<!DOCTYPE svg'))
+
+    if is_svg:
+        # Generator-style SVGs (rect grids, module paths) are read as a
+        # module grid and drawn directly; cairosvg only handles the rest
+        matrix = _svg_matrix(img_bytes)
+        if matrix is not None:
+            if encoding == 'vector':
+                with stage('vectorize'):
+                    return 'block', matrix.to_vector()
+            with stage('upscale'):
+                return 'image', matrix.to_image(width, height)
+        img_data = _rasterize_svg(img_bytes, width, height)
+    else:
+        # Handle binary input
+        img_data = img_bytes
+
+    with Image.open(BytesIO(img_data)) as qr_img:
+        if encoding == 'vector' and not is_svg:
+            with stage('vectorize'):
+                matrix = matrix_from_image(qr_img)
+            if matrix is not None:
+                return 'block', matrix.to_vector()
+        with stage('decode'):
+            return 'gray', to_gray(qr_img, width, height)
+
+
+def process_qr_blocks(qr_data_list, qr_width, qr_height, encoding='flate', jpeg_quality=85):
+    """
+    Process QR codes and return them ready to be drawn, in input order: a
+    grayscale image for 'flate', JPEG bytes for 'jpeg' or a 1-bit image for
+    '1bit'. Inputs that fail come back as None.
+
+    Each ``qr_data`` is either the bytes of an uploaded QR image (PNG, JPEG
+    or SVG) or a str payload, which is encoded here straight from its module
+    matrix without an intermediate image file. SVGs from QR generators are
+    read as a module grid too; only other SVGs are rasterized by cairosvg,
+    and fail when it is not installed.
+
+    Raster inputs are thresholded to pure black and white and upscaled by
+    whole factors with nearest neighbour (see qrgen.binarize); inputs of the
+    same size are binarized together as one stack.
+
+    For 'vector' the QR's module grid is returned as a VectorQR; inputs
+    that are not a clean module grid fall back to a raster block.
+
+    Blocks hold the QR alone: the logo is the same for every block, so the
+    layout draws it beside the QR and the PDF embeds it only once.
+    """
+    width = int(qr_width * RENDER_SCALE)
+    height = int(qr_height * RENDER_SCALE)
+    blocks = [None] * len(qr_data_list)
+    images = {}  # index -> image that only needs encoding
+    grays = {}  # index -> grayscale image to binarize
+    for index, qr_data in enumerate(qr_data_list):
+        try:
+            kind, result = _decode_qr(qr_data, width, height, encoding)
+        except Exception as e:
+            logger.warning("Skipping QR input that could not be read: %s", e)
+            continue
+        if kind == 'block':
+            blocks[index] = result
+        elif kind == 'image':
+            images[index] = result
+        else:
+            grays[index] = result
+
+    if grays:
+        try:
+            with stage('binarize'):
+                cleaned = binarize_images(list(grays.values()), width, height, '1' if encoding == '1bit' else 'L')
+            images.update(zip(grays, cleaned))
+        except Exception:
+            logger.exception("Binarizing %d QR images failed", len(grays))
+
+    for index, img in images.items():
+        try:
+            with stage('encode'):
+                blocks[index] = _encode_block(img, encoding, jpeg_quality)
+        except Exception:
+            continue
+    return blocks
+
+
+def process_qr_block(qr_data, qr_width, qr_height, encoding='flate', jpeg_quality=85):
+    """Process a single QR code; see process_qr_blocks."""
+    return process_qr_blocks([qr_data], qr_width, qr_height, encoding, jpeg_quality)[0]
+
+
+def _render_chunk(chunk, block_args):
+    """
+    Render a list of QR inputs in a worker. Failed blocks come back as None.
+    Returns the blocks and the stage timings to record in the web process.
+    """
+    with collect_stages() as stages:
+        return process_qr_blocks(chunk, *block_args), stages
+
+
+def _render_alone(qr_data_list, block_args):
+    """
+    Render blocks one at a time in a private worker, so that a crash is put
+    down to the block that caused it and not to another batch sharing the
+    pool. Returns the blocks, None for those that failed or crashed.
+    """
+    context = multiprocessing.get_context(POOL_START_METHOD)
+    blocks = []
+    pool = None
+    try:
+        for qr_data in qr_data_list:
+            if pool is None:
+                pool = ProcessPoolExecutor(max_workers=1, mp_context=context)
+            try:
+                results, stages = pool.submit(_render_chunk, [qr_data], block_args).result()
+                record_stages(stages)
+            except BrokenProcessPool:
+                logger.warning("Skipping QR block that crashed its render worker")
+                pool.shutdown(wait=False)
+                pool = None
+                results = [None]
+            blocks.extend(results)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False)
+    return blocks
+
+
+def render_blocks(qr_data_list, block_args):
+    """
+    Render QR blocks in parallel and yield the results in input order.
+
+    ``block_args`` are the arguments of ``process_qr_block`` after the image.
+    Blocks found in the block cache are not rendered again. Blocks that fail,
+    or that crash their worker, are yielded as None so the caller can skip them.
+    """
+    cache = get_block_cache()
+    if cache is not None:
+        args_digest = block_args_digest(block_args)
+        stats_before = cache.stats()
+
+    def log_cache_stats():
+        if cache is not None:
+            stats = cache.stats()
+            logger.info("Block cache: %d memory hits, %d disk hits, %d misses",
+                        *(stats[name] - stats_before[name] for name in ('memory_hits', 'disk_hits', 'misses')))
+
+    def lookup(qr_data):
+        if cache is None:
+            return None, None
+        key = block_cache_key(qr_data, args_digest)
+        return key, cache.get(key)
+
+    workers = get_render_workers()
+    chunk_size = max(1, int(getattr(settings, 'QRGEN_RENDER_CHUNK_SIZE', 8)))
+    items = iter(qr_data_list)
+
+    def next_chunk():
+        return [(qr_data,) + lookup(qr_data) for _, qr_data in zip(range(chunk_size), items)]
+
+    def merge(chunk, results):
+        results = iter(results)
+        for qr_data, key, cached in chunk:
+            if cached is not None:
+                yield cached
+                continue
+            block = next(results)
+            if block is not None and cache is not None:
+                cache.set(key, block)
+            yield block
+
+    if workers <= 1:
+        # Rendered inline, a chunk at a time so same-size images are
+        # still binarized together
+        try:
+            while True:
+                chunk = next_chunk()
+                if not chunk:
+                    return
+                misses = [qr_data for qr_data, _, cached in chunk if cached is None]
+                yield from merge(chunk, process_qr_blocks(misses, *block_args) if misses else [])
+        finally:
+            log_cache_stats()
+
+    max_in_flight = workers * 2
+    # (chunk, pool, future) in submission order; a chunk is a list of
+    # (qr_data, cache key, cached block) and only the misses are rendered
+    pending = deque()
+
+    def fill():
+        while len(pending) < max_in_flight:
+            chunk = next_chunk()
+            if not chunk:
+                return
+            misses = [qr_data for qr_data, _, cached in chunk if cached is None]
+            pool, future = submit_to_pool(_render_chunk, misses, block_args) if misses else (None, None)
+            pending.append((chunk, pool, future))
+
+    try:
+        fill()
+        while pending:
+            chunk, pool, future = pending.popleft()
+            try:
+                results, stages = future.result() if future is not None else ([], [])
+                record_stages(stages)
+            except (BrokenProcessPool, CancelledError):
+                # A worker died, maybe one rendering another batch, and took
+                # every queued future of the pool with it; or another batch
+                # replaced the pool after that and cancelled them. The chunk
+                # is rendered again so that only a block that crashes its
+                # own worker is dropped.
+                logger.warning("Render pool lost a chunk, rendering its blocks again one at a time")
+                shutdown_process_pool(pool)
+                results = _render_alone([qr_data for qr_data, _, cached in chunk if cached is None], block_args)
+            except Exception:
+                logger.exception("Render chunk failed")
+                results = [None] * len(chunk)
+            yield from merge(chunk, results)
+            fill()
+    finally:
+        for _, _, future in pending:
+            if future is not None:
+                future.cancel()
+        log_cache_stats()
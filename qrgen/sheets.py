@@ -0,0 +1,192 @@
+"""
+Raster output: every page composited into a single image.
+
+With small blocks most of the cost of a PDF is per drawn image, in reportlab
+and again in the viewer or RIP. The raster formats paste the blocks of a
+page into one image at RENDER_SCALE (SHEET_DPI), on the grid of
+qrgen.pdf.page_grid, and write it as the only image of a PDF page
+('pdf_raster'), as a frame of a multi-page TIFF ('tiff') or as one PNG in a
+zip ('png').
+
+Pages do not depend on each other: once its blocks are rendered, a page is
+composited and compressed in the render process pool while the blocks of
+the next pages are still being rendered.
+"""
+import logging
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import CancelledError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from PIL import Image, TiffImagePlugin
+from reportlab.lib.units import mm
+from django.conf import settings
+from .metrics import collect_stages, record_stages, stage
+from .pdf import PAPER_SIZE_MAP, FlateImage, StreamingCanvas, letterboxed_logo, page_grid
+from .rendering import RENDER_SCALE, get_render_workers, render_blocks, shutdown_process_pool, submit_to_pool
+
+logger = logging.getLogger(__name__)
+
+SHEET_DPI = 72 * RENDER_SCALE
+
+RASTER_FORMATS = ('pdf_raster', 'tiff', 'png')
+
+
+def compose_page(blocks, logo_image, grid_args, output_format, encoding, jpeg_quality):
+    """
+    Paste one page of rendered blocks, each followed by the logo, into an RGB
+    image and encode it for ``output_format``: TIFF or PNG bytes, or for
+    'pdf_raster' JPEG bytes (``encoding`` 'jpeg') or a FlateImage.
+    """
+    paper_size, block_width_mm, block_height_mm, _ = grid_args
+    page_w, page_h = PAPER_SIZE_MAP[paper_size]
+    blocks_per_row, _, x_start, y_start, step_x, step_y = page_grid(*grid_args)
+    qr_width = float(block_width_mm) * mm / 2
+    qr_height = float(block_height_mm) * mm
+    qr_px = int(qr_width * RENDER_SCALE), int(qr_height * RENDER_SCALE)
+
+    with stage('composite'):
+        page = Image.new('RGB', (round(page_w * RENDER_SCALE), round(page_h * RENDER_SCALE)), 'white')
+        for index, block in enumerate(blocks):
+            if block.size != qr_px:
+                # Blocks are upscaled by whole factors only (or not reduced at
+                # all), so stretch them to the slot the way drawImage does
+                block = block.resize(qr_px, Image.NEAREST)
+            row, col = divmod(index, blocks_per_row)
+            x = x_start + col * step_x
+            # Measured from the top of the image, not the bottom of the page
+            top = round((page_h - (y_start - row * step_y) - qr_height) * RENDER_SCALE)
+            page.paste(block, (round(x * RENDER_SCALE), top))
+            page.paste(logo_image, (round((x + qr_width) * RENDER_SCALE), top))
+
+    with stage('page_encode'):
+        if output_format == 'pdf_raster' and encoding != 'jpeg':
+            return FlateImage(page.width, page.height, page.mode, zlib.compress(page.tobytes()))
+        buffer = BytesIO()
+        if output_format == 'tiff':
+            page.save(buffer, format='TIFF', compression='tiff_deflate', dpi=(SHEET_DPI, SHEET_DPI))
+        elif output_format == 'png':
+            page.save(buffer, format='PNG', dpi=(SHEET_DPI, SHEET_DPI))
+        else:
+            page.save(buffer, format='JPEG', quality=jpeg_quality, dpi=(SHEET_DPI, SHEET_DPI))
+        return buffer.getvalue()
+
+
+def _compose_page_task(blocks, *page_args):
+    """compose_page in a render worker; returns the page and the stage timings."""
+    with collect_stages() as stages:
+        return compose_page(blocks, *page_args), stages
+
+
+def _page_blocks(blocks, per_page, progress):
+    """Group rendered blocks into pages, leaving out blocks that failed; always at least one page."""
+    page = []
+    pages = 0
+    blocks_done = 0
+    while True:
+        with stage('render'):
+            block = next(blocks, StopIteration)
+        if block is StopIteration:
+            break
+        blocks_done += 1
+        if block is not None:
+            page.append(block)
+        if progress is not None:
+            progress(blocks_done)
+        if len(page) == per_page:
+            yield page
+            pages += 1
+            page = []
+    if page or not pages:
+        yield page
+
+
+def iter_pages(qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm, encoding='flate',
+               output_format='pdf_raster', progress=None):
+    """
+    Yield the pages of the batch in order, encoded by compose_page. Takes the
+    arguments of qrgen.pdf.draw_pages; ``output_format`` is one of
+    RASTER_FORMATS.
+    """
+    grid_args = (paper_size, block_width_mm, block_height_mm, spacing_mm)
+    blocks_per_row, rows_per_page = page_grid(*grid_args)[:2]
+    qr_width = float(block_width_mm) * mm / 2
+    qr_height = float(block_height_mm) * mm
+    qr_px = int(qr_width * RENDER_SCALE), int(qr_height * RENDER_SCALE)
+    with stage('logo'):
+        logo_image = letterboxed_logo(logo, *qr_px)
+    page_args = (logo_image, grid_args, output_format, encoding, settings.QRGEN_JPEG_QUALITY)
+
+    # Blocks are pure black and white whatever the encoding, so they are
+    # rendered 1-bit: the same pixels at an eighth of the size to pass
+    # between processes. ``encoding`` only decides how a PDF page is stored.
+    blocks = render_blocks(qr_data_list, (qr_width, qr_height, '1bit', settings.QRGEN_JPEG_QUALITY))
+    pages = _page_blocks(blocks, blocks_per_row * rows_per_page, progress)
+
+    workers = get_render_workers()
+    if workers <= 1:
+        for page_blocks in pages:
+            yield compose_page(page_blocks, *page_args)
+        return
+
+    # (blocks, pool, future) in page order; a page is a few MB once
+    # composited, so only one per worker is in flight
+    pending = deque()
+
+    def result(page_blocks, pool, future):
+        try:
+            page, stages = future.result()
+        except (BrokenProcessPool, CancelledError):
+            # A worker crashed, or another batch replaced the pool after a crash
+            logger.warning("Render pool lost a page, compositing it in the web process")
+            shutdown_process_pool(pool)
+            return compose_page(page_blocks, *page_args)
+        record_stages(stages)
+        return page
+
+    try:
+        for page_blocks in pages:
+            pending.append((page_blocks,) + submit_to_pool(_compose_page_task, page_blocks, *page_args))
+            if len(pending) >= workers:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+
+
+def write_sheets(fp, output_format, qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm,
+                 encoding='flate', progress=None):
+    """
+    Write the batch to the seekable binary file ``fp`` in one of
+    RASTER_FORMATS. The other arguments are those of qrgen.pdf.build_pdf.
+    """
+    pages = iter_pages(qr_data_list, logo, paper_size, block_width_mm, block_height_mm, spacing_mm, encoding,
+                       output_format, progress)
+    if output_format == 'pdf_raster':
+        page_size = PAPER_SIZE_MAP[paper_size]
+        c = StreamingCanvas(pagesize=page_size)
+        for page in pages:
+            c.drawImage(page if isinstance(page, FlateImage) else BytesIO(page), 0, 0, *page_size)
+            c.showPage()
+            fp.write(c.drain())
+        with stage('save'):
+            c.save()
+        fp.write(c.drain())
+    elif output_format == 'tiff':
+        # Joins the single-page TIFFs, fixing up their offsets, as pages arrive
+        tiff = TiffImagePlugin.AppendingTiffWriter(fp)
+        for page in pages:
+            tiff.write(page)
+            tiff.newFrame()
+    elif output_format == 'png':
+        with zipfile.ZipFile(fp, 'w', zipfile.ZIP_STORED) as archive:
+            for number, page in enumerate(pages, 1):
+                # Fixed timestamp, so the same inputs give the same bytes
+                info = zipfile.ZipInfo('page-%04d.png' % number, (1980, 1, 1, 0, 0, 0))
+                info.external_attr = 0o644 << 16
+                archive.writestr(info, page)
+    else:
+        raise ValueError("Not a raster output format: %r" % output_format)
@@ -0,0 +1,75 @@
+"""
+Synthetic QR codes and logos for benchmarks and load tests. Everything is
+generated locally, so no network access or fixture files are needed.
+"""
+from io import BytesIO
+import qrcode
+import qrcode.image.svg
+from PIL import Image
+
+INPUT_KINDS = ('png', 'svg', 'mixed')
+
+
+def make_qr_png(data="https://example.com", box_size=4):
+    qr = qrcode.QRCode(box_size=box_size, border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_qr_svg(data="https://example.com", style='path'):
+    """
+    SVG QR in the styles of common generators: 'path' (a single path of
+    module squares, like most write them), 'rect' or segno-like 'stroke'.
+    """
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    if style == 'stroke':
+        matrix = qr.get_matrix()
+        runs = []
+        for row, line in enumerate(matrix):
+            col = 0
+            while col < len(line):
+                if line[col]:
+                    start = col
+                    while col < len(line) and line[col]:
+                        col += 1
+                    runs.append('M%d %d.5h%d' % (start, row, col - start))
+                col += 1
+        size = len(matrix)
+        return ('<?xml version="1.0" encoding="utf-8"?>\n<svg xmlns="http://www.w3.org/2000/svg" '
+                'width="%d" height="%d"><g transform="scale(10)"><path fill="#fff" d="M0 0h%dv%dh-%dz"/>'
+                '<path stroke="#000" d="%s"/></g></svg>' % (size * 10, size * 10, size, size, size, ''.join(runs))).encode()
+    factory = qrcode.image.svg.SvgPathImage if style == 'path' else qrcode.image.svg.SvgImage
+    buffer = BytesIO()
+    qr.make_image(image_factory=factory).save(buffer)
+    return buffer.getvalue()
+
+
+def make_logo_png(size=(80, 40), color=(200, 30, 30)):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def synthetic_payload(index):
+    return "https://example.com/item/%06d" % index
+
+
+def synthetic_qr_set(count, kind='png', start=0):
+    """
+    ``count`` distinct QR inputs as (file name, bytes). ``kind`` is one of
+    INPUT_KINDS; 'mixed' alternates PNG and SVG. Sets with different
+    ``start`` indexes do not overlap.
+    """
+    qr_set = []
+    for index in range(start, start + count):
+        svg = kind == 'svg' or (kind == 'mixed' and index % 2)
+        if svg:
+            qr_set.append(('qr%06d.svg' % index, make_qr_svg(synthetic_payload(index))))
+        else:
+            qr_set.append(('qr%06d.png' % index, make_qr_png(synthetic_payload(index))))
+    return qr_set
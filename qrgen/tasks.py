@@ -0,0 +1,77 @@
+import logging
+import tempfile
+import time
+from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+# Configures the app @shared_task binds to (it is not loaded at Django startup)
+from qr_project.celery import app  # noqa: F401
+from .checkpoints import checkpointed, stream_pdf_checkpointed
+from .models import QRBatchDjango
+from .pdf import stream_pdf
+from .pdfstore import pdf_digest, store_pdf, stored_pdf
+from .sheets import write_sheets
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of seconds between two progress writes to the database
+PROGRESS_INTERVAL = 1.0
+# Times a batch that hits the soft time limit is retried before it is marked failed
+MAX_RETRIES = 3
+
+
+# acks_late and reject_on_worker_lost: a batch whose worker is killed (e.g. by the
+# hard time limit) is delivered again and resumes from its last checkpoint
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=MAX_RETRIES)
+def render_batch_pdf(self, batch_id):
+    """Render a queued batch and store the result in ``generated_pdf``."""
+    batch = QRBatchDjango.objects.get(pk=batch_id)
+    QRBatchDjango.objects.filter(pk=batch_id).update(status='rendering', blocks_done=0)
+    last_update = time.monotonic()
+
+    def progress(blocks_done):
+        nonlocal last_update
+        now = time.monotonic()
+        if now - last_update >= PROGRESS_INTERVAL:
+            QRBatchDjango.objects.filter(pk=batch_id).update(blocks_done=blocks_done)
+            last_update = now
+
+    try:
+        digest = pdf_digest(batch, 'stream')
+        name = stored_pdf(digest, batch.output_format)
+        if name is not None:
+            # Same inputs as a PDF rendered before; share the stored file
+            batch.generated_pdf.name = name
+        else:
+            _render_and_store(batch, digest, progress)
+    except SoftTimeLimitExceeded:
+        if self.request.retries >= self.max_retries:
+            logger.error("Rendering batch %s hit the time limit %d times, giving up", batch_id,
+                         self.request.retries + 1)
+            QRBatchDjango.objects.filter(pk=batch_id).update(status='failed')
+            raise
+        logger.warning("Rendering batch %s hit the time limit, retrying from its last checkpoint", batch_id)
+        QRBatchDjango.objects.filter(pk=batch_id).update(status='queued')
+        raise self.retry(countdown=0)
+    except Exception:
+        logger.exception("Rendering batch %s failed", batch_id)
+        QRBatchDjango.objects.filter(pk=batch_id).update(status='failed')
+        raise
+
+    batch.status = 'done'
+    batch.blocks_done = batch.blocks_total
+    batch.save(update_fields=['generated_pdf', 'status', 'blocks_done'])
+
+
+def _render_and_store(batch, digest, progress):
+    # Spool to a temporary file so memory stays bounded for large batches
+    with tempfile.TemporaryFile() as pdf_file:
+        if batch.output_format != 'pdf':
+            write_sheets(pdf_file, batch.output_format, *batch.pdf_args(), progress=progress)
+        elif checkpointed(batch):
+            for chunk in stream_pdf_checkpointed(digest, *batch.pdf_args(), progress=progress):
+                pdf_file.write(chunk)
+        else:
+            for chunk in stream_pdf(*batch.pdf_args(), progress=progress):
+                pdf_file.write(chunk)
+        pdf_file.seek(0)
+        store_pdf(batch, digest, pdf_file)
@@ -1,5 +1,1195 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+import qrcode
+from PIL import Image
+from asgiref.sync import async_to_sync
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import LiveServerTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from . import metrics, rendering
+from .models import QRBatchDjango, QRCodeDjango
+from .cache import BlockCache, get_block_cache, reset_block_cache
+from .synthetic import make_logo_png, make_qr_png, make_qr_svg
+
+
+def qr_modules(data="https://example.com"):
+    """Module matrix of ``data`` without the quiet zone."""
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return [row[4:-4] for row in qr.get_matrix()[4:-4]]
+
+
+def streamed_content(response):
+    """Body of a streaming response, consumed and closed the way a server would."""
+    try:
+        if response.is_async:
+            async def collect():
+                return [chunk async for chunk in response.streaming_content]
+            return b''.join(async_to_sync(collect)())
+        return b''.join(response.streaming_content)
+    finally:
+        response.close()
+
+
+def crash_on_marker(qr_data_list, *args):
+    if 'crash' in qr_data_list:
+        os._exit(1)
+    return list(qr_data_list)
+
+
+def slow_blocks(qr_data_list, *args):
+    import time
+    time.sleep(0.1)
+    return crash_on_marker(qr_data_list)
+
 
 class QrgenTests(TestCase):
     def test_example(self):
-        self.assertEqual(1 + 1, 2)  # Example test case to demonstrate structure.
\ No newline at end of file
+        self.assertEqual(1 + 1, 2)  # Example test case to demonstrate structure.
+
+
+class MediaRootMixin:
+    """Keep uploaded and generated files in a throwaway MEDIA_ROOT."""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+
+
+class UploadBatchMixin:
+    """Post a batch of QR images with a logo and an A4 layout."""
+
+    def upload_batch(self, qr_images, url='qrgen:index', **fields):
+        data = {
+            'logo': SimpleUploadedFile('logo.png', make_logo_png(), content_type='image/png'),
+            'paper_size': 'A4',
+            'block_width_mm': 60,
+            'block_height_mm': 30,
+            'spacing_mm': 5,
+            'qr_images': [SimpleUploadedFile('qr%d.png' % i, png, content_type='image/png')
+                          for i, png in enumerate(qr_images)],
+        }
+        data.update(fields)
+        return self.client.post(reverse(url), data)
+
+
+class DownloadPdfTests(UploadBatchMixin, MediaRootMixin, TestCase):
+
+    def test_upload_redirects_to_pdf_download(self):
+        response = self.upload_batch([make_qr_png("a"), make_qr_png("b")])
+        self.assertRedirects(response, reverse('qrgen:download_pdf'), fetch_redirect_response=False)
+
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(response.content.startswith(b'%PDF'))
+
+    def test_session_keeps_only_the_batch_id(self):
+        self.upload_batch([make_qr_png("a"), b'not an image', make_qr_png("b")])
+        self.assertEqual(list(self.client.session.keys()), ['qr_batch_id'])
+
+        batch = QRBatchDjango.objects.get(pk=self.client.session['qr_batch_id'])
+        self.assertEqual(list(batch.iter_qr_data()), [make_qr_png("a"), make_qr_png("b")])
+
+    def test_blank_encoding_and_format_use_the_server_defaults(self):
+        from .rendering import BLOCK_ENCODINGS, OUTPUT_FORMATS
+        page = self.client.get(reverse('qrgen:index'))
+        for name, choices in (('output_encoding', BLOCK_ENCODINGS), ('output_format', OUTPUT_FORMATS)):
+            self.assertEqual(page.context['form'][name].field.choices, [('', "Server default")] + choices)
+        # Rendered from the form, with nothing selected so browsers post the blank value
+        self.assertContains(page, '<option value="">Server default</option>', count=2)
+        self.assertNotContains(page, ' selected>')
+        with override_settings(QRGEN_BLOCK_ENCODING='1bit', QRGEN_OUTPUT_FORMAT='tiff'):
+            self.upload_batch([make_qr_png("a")], output_encoding='', output_format='')
+        batch = QRBatchDjango.objects.get()
+        self.assertEqual((batch.output_encoding, batch.output_format), ('1bit', 'tiff'))
+
+    def test_download_without_batch(self):
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(QRGEN_RENDER_WORKERS=2, QRGEN_RENDER_CHUNK_SIZE=2, QRGEN_BLOCK_CACHE_MAX_BYTES=0)
+class RenderPoolTests(TestCase):
+    def setUp(self):
+        rendering.shutdown_process_pool()
+        self.addCleanup(rendering.shutdown_process_pool)
+        # Forked workers inherit the process_qr_blocks patched by the tests
+        patcher = mock.patch.object(rendering, 'POOL_START_METHOD', 'fork')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results_keep_input_order(self):
+        items = ['block-%d' % i for i in range(11)]
+        with mock.patch.object(rendering, 'process_qr_blocks', crash_on_marker):
+            self.assertEqual(list(rendering.render_blocks(items, ())), items)
+
+    def test_worker_crash_skips_only_that_block(self):
+        items = ['a', 'b', 'crash', 'c', 'd', 'e']
+        with mock.patch.object(rendering, 'process_qr_blocks', crash_on_marker):
+            results = list(rendering.render_blocks(items, ()))
+        self.assertEqual(results, ['a', 'b', None, 'c', 'd', 'e'])
+
+    def test_crash_in_another_batch_costs_no_blocks(self):
+        from concurrent.futures import ThreadPoolExecutor
+        crashing = ['a%d' % i for i in range(6)] + ['crash'] + ['a%d' % i for i in range(6, 12)]
+        clean = ['b%d' % i for i in range(12)]
+        with mock.patch.object(rendering, 'process_qr_blocks', slow_blocks), \
+                ThreadPoolExecutor(max_workers=2) as threads:
+            first = threads.submit(lambda: list(rendering.render_blocks(crashing, ())))
+            second = threads.submit(lambda: list(rendering.render_blocks(clean, ())))
+            self.assertEqual(second.result(), clean)
+            self.assertEqual(first.result(), [None if item == 'crash' else item for item in crashing])
+
+    def test_chunks_cancelled_by_another_batch_are_rendered_again(self):
+        items = ['block-%d' % i for i in range(12)]
+        with mock.patch.object(rendering, 'process_qr_blocks', slow_blocks), \
+                override_settings(QRGEN_RENDER_CHUNK_SIZE=1):
+            blocks = rendering.render_blocks(items, ())
+            results = [next(blocks)]
+            # What another batch does after one of its blocks crashed a worker
+            rendering.shutdown_process_pool()
+            results.extend(blocks)
+        self.assertEqual(results, items)
+
+    def test_pool_is_reused_across_batches(self):
+        with mock.patch.object(rendering, 'process_qr_blocks', crash_on_marker):
+            list(rendering.render_blocks(['a', 'b', 'c'], ()))
+            pool = rendering.get_process_pool()
+            list(rendering.render_blocks(['d', 'e', 'f'], ()))
+        self.assertIs(rendering.get_process_pool(), pool)
+
+
+def xref_offsets_are_valid(pdf):
+    """Check every xref entry of a single-section PDF points at its object."""
+    xref_at = int(pdf.rsplit(b'startxref\n', 1)[1].split()[0])
+    lines = pdf[xref_at:].split(b'\n')
+    count = int(lines[1].split()[1])
+    for num, entry in enumerate(lines[3:2 + count], start=1):
+        offset = int(entry.split()[0])
+        if not pdf[offset:].startswith(b'%d 0 obj' % num):
+            return False
+    return True
+
+
+class StreamingPdfTests(UploadBatchMixin, MediaRootMixin, TestCase):
+    def test_streamed_document_is_well_formed(self):
+        from .pdf import stream_pdf
+        qr_data_list = [make_qr_png(str(i)) for i in range(30)]
+        chunks = list(stream_pdf(qr_data_list, make_logo_png(), 'A4', 60, 30, 5))
+
+        pdf = b''.join(chunks)
+        self.assertTrue(chunks[0].startswith(b'%PDF-1.4'))
+        self.assertTrue(pdf.endswith(b'%%EOF\n'))
+        self.assertTrue(xref_offsets_are_valid(pdf))
+        # 3 x 8 blocks fit on an A4 page: header, first page, last page + trailer
+        self.assertEqual(pdf.count(b'/Type /Page '), 2)
+        self.assertEqual(len(chunks), 3)
+
+    @override_settings(QRGEN_BLOCK_CACHE_MAX_BYTES=0, QRGEN_RENDER_WORKERS=0)
+    def test_memory_does_not_grow_with_the_batch(self):
+        import tracemalloc
+        from .pdf import PAPER_SIZE_MAP, StreamingCanvas, draw_pages
+
+        def peak(count):
+            c = StreamingCanvas(pagesize=PAPER_SIZE_MAP['A4'])
+            payloads = ['https://example.com/%d' % i for i in range(count)]
+            tracemalloc.start()
+            try:
+                for _ in draw_pages(c, payloads, make_logo_png(), 'A4', 60, 30, 5):
+                    c.drain()
+                return tracemalloc.get_traced_memory()[1], len(c._images_by_id)
+            finally:
+                tracemalloc.stop()
+
+        small, small_kept = peak(48)
+        large, large_kept = peak(192)
+        # Only the logo is kept across pages, not the blocks
+        self.assertEqual((small_kept, large_kept), (1, 1))
+        self.assertLess(large, small * 1.5)
+
+    @override_settings(QRGEN_STREAM_PDF=True)
+    def test_download_streams_when_enabled(self):
+        self.upload_batch([make_qr_png("a")])
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertTrue(response.streaming)
+        pdf = streamed_content(response)
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        self.assertTrue(xref_offsets_are_valid(pdf))
+
+
+@override_settings(QRGEN_RENDER_WORKERS=0)
+class BlockEncodingTests(TestCase):
+    def render(self, encoding):
+        return rendering.process_qr_block(make_qr_png(), 100, 100, encoding)
+
+    def test_flate_returns_binarized_grayscale_image(self):
+        block = self.render('flate')
+        # 132 px source (33 modules of 4 px) upscaled 3x towards 400 px
+        self.assertEqual((block.mode, block.size), ('L', (396, 396)))
+        self.assertEqual(set(block.getdata()), {0, 255})
+
+    def test_jpeg_returns_encoded_bytes(self):
+        self.assertTrue(self.render('jpeg').startswith(b'\xff\xd8'))
+
+    def test_1bit_returns_1bit_image(self):
+        block = self.render('1bit')
+        self.assertEqual((block.mode, block.size), ('1', (396, 396)))
+
+    def test_logo_is_embedded_once_per_document(self):
+        from .pdf import build_pdf, stream_pdf
+        qr_data_list = [make_qr_png(str(i)) for i in range(4)]
+        for encoding in ('flate', 'jpeg'):
+            pdf = b''.join(stream_pdf(qr_data_list, make_logo_png(), 'A4', 60, 30, 5, encoding))
+            # 4 QR images + 1 logo
+            self.assertEqual(pdf.count(b'/Subtype /Image'), 5, encoding)
+            pdf = build_pdf(qr_data_list, make_logo_png(), 'A4', 60, 30, 5, encoding)
+            self.assertEqual(pdf.count(b'/Subtype /Image'), 5, encoding)
+
+    def test_streamed_1bit_blocks_share_one_logo(self):
+        from .pdf import stream_pdf
+        qr_data_list = [make_qr_png(str(i)) for i in range(4)]
+        pdf = b''.join(stream_pdf(qr_data_list, make_logo_png(), 'A4', 60, 30, 5, '1bit'))
+        self.assertTrue(xref_offsets_are_valid(pdf))
+        self.assertEqual(pdf.count(b'/BitsPerComponent 1 '), 4)
+        self.assertEqual(pdf.count(b'/ColorSpace /DeviceRGB'), 1)
+
+    def test_buffered_pdf_for_every_encoding(self):
+        from .pdf import build_pdf
+        qr_data_list = [make_qr_png()]
+        for encoding, _ in rendering.BLOCK_ENCODINGS:
+            pdf = build_pdf(qr_data_list, make_logo_png(), 'A4', 60, 30, 5, encoding)
+            self.assertTrue(pdf.startswith(b'%PDF'), encoding)
+
+
+class BlockCacheTests(TestCase):
+    block_args = (100, 100, 'flate', 85)
+
+    def setUp(self):
+        reset_block_cache()
+        self.addCleanup(reset_block_cache)
+
+    def render_twice(self, workers):
+        qr_data_list = [make_qr_png(str(i)) for i in range(5)]
+        with override_settings(QRGEN_RENDER_WORKERS=workers):
+            first = list(rendering.render_blocks(qr_data_list, self.block_args))
+            qr_data_list[2] = make_qr_png("changed")
+            second = list(rendering.render_blocks(qr_data_list, self.block_args))
+        return first, second
+
+    def test_rerun_renders_only_changed_blocks(self):
+        for workers in (0, 2):
+            reset_block_cache()
+            first, second = self.render_twice(workers)
+            stats = get_block_cache().stats()
+            self.assertEqual((stats['memory_hits'], stats['misses']), (4, 6), workers)
+            self.assertIs(second[0], first[0])
+            self.assertIsNot(second[2], first[2])
+            self.assertNotEqual(second[2].tobytes(), first[2].tobytes())
+
+    def test_format_version_and_scale_change_the_key(self):
+        from . import cache
+        digest = cache.block_args_digest(self.block_args)
+        with mock.patch.object(cache, 'BLOCK_FORMAT_VERSION', cache.BLOCK_FORMAT_VERSION + 1):
+            self.assertNotEqual(cache.block_args_digest(self.block_args), digest)
+        with mock.patch.object(rendering, 'RENDER_SCALE', rendering.RENDER_SCALE * 2):
+            self.assertNotEqual(cache.block_args_digest(self.block_args), digest)
+        self.assertEqual(cache.block_args_digest(self.block_args), digest)
+
+    def test_lru_evicts_oldest_entry(self):
+        cache = BlockCache(max_bytes=25)
+        for key in 'abc':
+            cache.set(key, key.encode() * 10)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), b'c' * 10)
+
+    def test_disk_tier_is_shared_and_capped(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            writer = BlockCache(max_bytes=1000, disk_dir=disk_dir, disk_max_bytes=100)
+            image = Image.new('1', (16, 16), 1)
+            writer.set('k1', image)
+            writer.set('k2', b'\xff\xd8' + b'j' * 60)
+
+            reader = BlockCache(max_bytes=1000, disk_dir=disk_dir, disk_max_bytes=100)
+            self.assertEqual(reader.get('k2'), b'\xff\xd8' + b'j' * 60)
+            self.assertEqual(reader.stats()['disk_hits'], 1)
+            writer.set('k3', b'\xff\xd8' + b'j' * 60)
+            usage, files = writer._disk_usage()
+            self.assertLessEqual(usage, 100)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, QRGEN_RENDER_WORKERS=0)
+class BackgroundRenderingTests(UploadBatchMixin, MediaRootMixin, TestCase):
+    def test_submit_status_download(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.upload_batch([make_qr_png("a"), make_qr_png("b")], url='qrgen:submit_batch')
+        self.assertEqual(response.status_code, 202)
+        submitted = response.json()
+        self.assertEqual(submitted['blocks_total'], 2)
+
+        status = self.client.get(submitted['status_url']).json()
+        self.assertEqual((status['status'], status['blocks_done'], status['blocks_total']), ('done', 2, 2))
+
+        response = self.client.get(submitted['download_url'])
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(streamed_content(response).startswith(b'%PDF'))
+        self.assertEqual(self.client.get(submitted['download_url'],
+                                         headers={'If-None-Match': response['ETag']}).status_code, 304)
+
+        QRBatchDjango.objects.update(generated_pdf=None)
+        self.assertEqual(self.client.get(submitted['download_url']).status_code, 410)
+
+    def test_download_before_rendering_finishes(self):
+        response = self.upload_batch([make_qr_png("a")], url='qrgen:submit_batch')
+        submitted = response.json()
+        self.assertEqual(submitted['status'], 'queued')
+        self.assertEqual(self.client.get(submitted['download_url']).status_code, 409)
+
+    def test_other_sessions_cannot_see_the_batch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.upload_batch([make_qr_png("a")], url='qrgen:submit_batch')
+        self.client.logout()
+        self.client.cookies.clear()
+        self.assertEqual(self.client.get(response.json()['status_url']).status_code, 404)
+
+
+class VectorQRTests(TestCase):
+    def test_matrix_from_png(self):
+        from .qrmatrix import matrix_from_image
+        matrix = matrix_from_image(Image.open(BytesIO(make_qr_png("vector"))))
+        self.assertEqual(matrix.modules, qr_modules("vector"))
+        self.assertAlmostEqual(matrix.left, 4 / (len(qr_modules("vector")) + 8))
+
+    def test_matrix_from_svg_styles(self):
+        from .qrmatrix import matrix_from_svg
+        for style in ('path', 'rect', 'stroke'):
+            matrix = matrix_from_svg(make_qr_svg("vector", style))
+            self.assertIsNotNone(matrix, style)
+            self.assertEqual(matrix.modules, qr_modules("vector"), style)
+
+    def test_non_qr_input_is_rejected(self):
+        from .qrmatrix import matrix_from_image, matrix_from_svg
+        self.assertIsNone(matrix_from_image(Image.open(BytesIO(make_logo_png()))))
+        self.assertIsNone(matrix_from_svg(b'<svg xmlns="http://www.w3.org/2000/svg"><circle r="4"/></svg>'))
+
+    def test_merged_rects_cover_every_dark_module(self):
+        from .qrmatrix import QRMatrix
+        modules = qr_modules("vector")
+        rects = QRMatrix(modules, 0, 0, 1, 1).merged_rects()
+        covered = [[False] * len(modules) for _ in modules]
+        for col, row, width, height in rects:
+            for r in range(row, row + height):
+                for c in range(col, col + width):
+                    self.assertFalse(covered[r][c])
+                    covered[r][c] = True
+        self.assertEqual(covered, [[bool(m) for m in row] for row in modules])
+        self.assertLess(len(rects), sum(map(sum, modules)) / 2)
+
+    @override_settings(QRGEN_RENDER_WORKERS=0)
+    def test_vector_pdf_draws_rectangles_instead_of_qr_images(self):
+        from .pdf import stream_pdf
+        qr_data_list = [make_qr_png("a"), make_qr_svg("b", 'stroke'), make_logo_png()]
+        pdf = b''.join(stream_pdf(qr_data_list, make_logo_png(), 'A4', 60, 30, 5, 'vector'))
+        self.assertTrue(xref_offsets_are_valid(pdf))
+        # One shared logo plus the raster fallback for the input that is not a QR
+        self.assertEqual(pdf.count(b'/Subtype /Image'), 2)
+
+
+class PayloadTests(MediaRootMixin, TestCase):
+    def post_payloads(self, **extra):
+        data = {
+            'logo': SimpleUploadedFile('logo.png', make_logo_png(), content_type='image/png'),
+            'paper_size': 'A4',
+            'block_width_mm': 60,
+            'block_height_mm': 30,
+            'spacing_mm': 5,
+            'output_encoding': 'vector',
+        }
+        data.update(extra)
+        return self.client.post(reverse('qrgen:index'), data)
+
+    def test_csv_header_selects_payload_column(self):
+        from .payloads import iter_csv_payloads
+        rows = io.StringIO('id,url\n1,https://a.example\n2,"multi\nline"\n3,\n')
+        self.assertEqual(list(iter_csv_payloads(rows)), ['https://a.example', 'multi\nline'])
+        self.assertEqual(list(iter_csv_payloads(io.StringIO('x,1\ny,2\n'))), ['x', 'y'])
+
+    def test_payloads_are_stored_and_read_back_lazily(self):
+        csv_file = SimpleUploadedFile('codes.csv', b'payload\nfrom-csv-1\nfrom-csv-2\n', content_type='text/csv')
+        self.post_payloads(payload_file=csv_file, payload_text='typed-1\n\ntyped-2\n')
+        batch = QRBatchDjango.objects.get(pk=self.client.session['qr_batch_id'])
+        self.assertEqual(batch.blocks_total, 4)
+        self.assertEqual(list(batch.iter_qr_data()), ['typed-1', 'typed-2', 'from-csv-1', 'from-csv-2'])
+
+    def test_text_file_is_one_payload_per_line(self):
+        payloads = ['https://example.com/?ids=1,2,3', 'MECARD:N:Doe,John;TEL:123;;', 'say "hi"']
+        text_file = SimpleUploadedFile('codes.txt', '\r\n'.join(payloads).encode(), content_type='text/plain')
+        self.post_payloads(payload_file=text_file)
+        batch = QRBatchDjango.objects.get(pk=self.client.session['qr_batch_id'])
+        self.assertEqual(list(batch.iter_qr_data()), payloads)
+
+    def test_non_utf8_payload_file_is_a_form_error(self):
+        text_file = SimpleUploadedFile('codes.txt', 'caf\xe9\n'.encode('latin-1'), content_type='text/plain')
+        response = self.post_payloads(payload_file=text_file)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "The payload file is not UTF-8 text.")
+        self.assertFalse(QRBatchDjango.objects.exists())
+
+    def test_pdf_from_payloads(self):
+        self.post_payloads(payload_text='\n'.join('https://example.com/%d' % i for i in range(30)))
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        pdf = response.content
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        # Vector QR codes: only the shared logo is an image
+        self.assertEqual(pdf.count(b'/Subtype /Image'), 1)
+
+    def test_generated_blocks_match_payload(self):
+        from .qrmatrix import matrix_from_image
+        block = rendering.process_qr_block('https://example.com', 100, 100, '1bit')
+        self.assertEqual(matrix_from_image(block).modules, qr_modules('https://example.com'))
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_benchmark_writes_and_compares_results(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'run.json')
+            options = dict(batch_sizes='2', block_sample=2, inputs='png', encodings='vector', workers=0,
+                           stdout=io.StringIO())
+            call_command('benchmark', output=output, **options)
+            with open(output) as f:
+                results = json.load(f)['results']
+            self.assertEqual([result['stage'] for result in results], ['block', 'document'])
+            document = results[1]
+            self.assertEqual(document['batch_size'], 2)
+            self.assertGreater(document['pdf_bytes'], 0)
+            self.assertGreater(document['tracemalloc_peak_bytes'], 0)
+
+            call_command('benchmark', compare=output, threshold=100, no_tracemalloc=True, **options)
+            results[1]['pdf_bytes'] = 1
+            with open(output, 'w') as f:
+                json.dump({'results': results}, f)
+            with self.assertRaises(CommandError):
+                call_command('benchmark', compare=output, no_tracemalloc=True, **options)
+
+
+class MetricsTests(UploadBatchMixin, MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset_metrics()
+        reset_block_cache()
+        self.addCleanup(reset_block_cache)
+        self.upload_batch([make_qr_png("a"), make_qr_png("b")])
+
+    def test_download_reports_stage_timings(self):
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        stages = dict(entry.split(';dur=') for entry in response['Server-Timing'].split(', '))
+        for name in ('load', 'logo', 'render', 'decode', 'binarize', 'encode', 'draw', 'save', 'total'):
+            self.assertIn(name, stages)
+        self.assertGreaterEqual(float(stages['total']), float(stages['save']))
+
+        text = self.client.get(reverse('qrgen:metrics')).content.decode()
+        self.assertIn('# TYPE qrgen_stage_seconds histogram', text)
+        self.assertIn('qrgen_stage_seconds_count{stage="decode"} 2', text)
+        self.assertIn('qrgen_stage_seconds_bucket{stage="decode",le="+Inf"} 2', text)
+        self.assertIn('qrgen_request_seconds_count{view="download_pdf"} 1', text)
+
+    @override_settings(QRGEN_RENDER_WORKERS=2)
+    def test_stages_timed_in_render_workers_are_collected(self):
+        self.addCleanup(rendering.shutdown_process_pool)
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertIn('binarize;dur=', response['Server-Timing'])
+        text = self.client.get(reverse('qrgen:metrics')).content.decode()
+        self.assertIn('qrgen_stage_seconds_count{stage="decode"} 2', text)
+
+    def test_metrics_are_local_only(self):
+        response = self.client.get(reverse('qrgen:metrics'), REMOTE_ADDR='203.0.113.9')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(QRGEN_STREAM_PDF=True)
+    def test_streaming_download_is_timed_when_consumed(self):
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertIn('load;dur=', response['Server-Timing'])
+        streamed_content(response)
+        text = self.client.get(reverse('qrgen:metrics')).content.decode()
+        self.assertIn('qrgen_request_seconds_count{view="download_pdf"} 1', text)
+        self.assertIn('qrgen_stage_seconds_count{stage="draw"} 2', text)
+
+    def test_profiles_of_slowest_requests_are_kept(self):
+        with tempfile.TemporaryDirectory() as profile_dir, \
+                override_settings(QRGEN_PROFILE_SLOWEST=2, QRGEN_PROFILE_DIR=profile_dir):
+            for index in range(3):
+                # A new batch each time, so every download renders
+                self.upload_batch([make_qr_png("profile %d" % index)])
+                self.client.get(reverse('qrgen:download_pdf'))
+            profiles = sorted(os.listdir(profile_dir))
+            self.assertEqual(len(profiles), 2)
+            import pstats
+            stats = pstats.Stats(os.path.join(profile_dir, profiles[0]))
+            # Rendering runs in a render thread, not on the event loop
+            self.assertTrue(any(name == 'draw_pages' for _, _, name in stats.stats))
+
+
+class StartupTests(TestCase):
+    def test_worker_boot_does_not_load_heavy_modules(self):
+        from django.core.management import call_command
+        out = io.StringIO()
+        call_command('startup_report', json=True, max_seconds=60, max_rss_mb=4096, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['application'], 'qr_project.asgi.application')
+        self.assertEqual(report['eager_modules'], [])
+        self.assertEqual(report['problems'], [])
+
+    def test_wsgi_application_can_be_measured(self):
+        from django.core.management import call_command
+        out = io.StringIO()
+        call_command('startup_report', application='qr_project.wsgi.application', max_seconds=60,
+                     max_rss_mb=4096, stdout=out)
+        self.assertIn('Startup of qr_project.wsgi.application:', out.getvalue())
+
+    def test_startup_budget_is_enforced(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        with self.assertRaises(CommandError):
+            call_command('startup_report', max_seconds=0, stdout=io.StringIO())
+
+    def test_mongo_documents_connect_on_first_use(self):
+        from . import models, mongo
+        self.addCleanup(setattr, mongo, '_connected', mongo._connected)
+        mongo._connected = False
+        with mock.patch('mongoengine.connect') as connect:
+            self.assertEqual(models.QRBatch.__name__, 'QRBatch')
+            models.QRCode
+        connect.assert_called_once_with(host=mock.ANY, connect=False)
+
+
+class BinarizeTests(TestCase):
+    def scanned_qr(self, data="https://example.com", dark=90, light=170, box_size=4):
+        """A low-contrast grayscale QR, like a faint scan."""
+        img = Image.open(BytesIO(make_qr_png(data, box_size=box_size))).convert("L")
+        return img.point(lambda p: light if p > 127 else dark)
+
+    def test_low_contrast_input_becomes_pure_black_and_white(self):
+        from .binarize import binarize_images, to_gray
+        from .qrmatrix import matrix_from_image
+        gray = to_gray(self.scanned_qr(), 400, 400)
+        block, = binarize_images([gray], 400, 400)
+        self.assertEqual(set(block.getdata()), {0, 255})
+        self.assertEqual(matrix_from_image(block).modules, qr_modules())
+
+    def test_stack_matches_image_by_image_fallback(self):
+        from . import binarize
+        grays = [binarize.to_gray(self.scanned_qr(str(i), dark=40 * i, light=250), 300, 300) for i in range(4)]
+        grays.append(binarize.to_gray(self.scanned_qr(box_size=6), 300, 300))  # Another size
+        stacked = binarize.binarize_images(grays, 300, 300, '1')
+        with mock.patch.object(binarize, 'get_numpy', lambda: None):
+            one_by_one = binarize.binarize_images(grays, 300, 300, '1')
+        for a, b in zip(stacked, one_by_one):
+            self.assertEqual((a.mode, a.size), (b.mode, b.size))
+            self.assertEqual(a.tobytes(), b.tobytes())
+
+    def test_large_sources_are_reduced_by_whole_factors(self):
+        from .binarize import to_gray
+        big = Image.open(BytesIO(make_qr_png(box_size=40))).convert("RGBA")  # 1320 px
+        self.assertEqual(to_gray(big, 400, 400).size, (440, 440))
+
+
+class SvgInputTests(TestCase):
+    def setUp(self):
+        rendering._svg_memo.clear()
+        self.addCleanup(rendering._svg_memo.clear)
+
+    def test_generator_svgs_are_drawn_without_cairosvg(self):
+        from .qrmatrix import matrix_from_image
+        with mock.patch.object(rendering, 'get_cairosvg', side_effect=AssertionError("cairosvg used")):
+            for style in ('path', 'rect', 'stroke'):
+                block = rendering.process_qr_block(make_qr_svg("svg", style), 100, 100, 'flate')
+                self.assertEqual(block.mode, 'L', style)
+                self.assertEqual(set(block.getdata()), {0, 255}, style)
+                self.assertEqual(matrix_from_image(block).modules, qr_modules("svg"), style)
+
+    def test_other_svgs_fail_without_cairosvg(self):
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10"><circle r="4"/></svg>'
+        with mock.patch.object(rendering, 'get_cairosvg', return_value=None):
+            self.assertIsNone(rendering.process_qr_block(svg, 100, 100, 'flate'))
+
+    def test_duplicate_svgs_are_parsed_once(self):
+        svg = make_qr_svg("duplicate")
+        with mock.patch.object(rendering, 'matrix_from_svg', wraps=rendering.matrix_from_svg) as parse:
+            blocks = rendering.process_qr_blocks([svg, svg, svg], 100, 100, '1bit')
+            rendering.process_qr_block(svg, 50, 50, 'vector')
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(blocks[0].tobytes(), blocks[2].tobytes())
+
+    def test_arbitrary_svgs_are_rasterized_once_per_size(self):
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg"><circle r="4"/></svg>'
+        cairosvg = mock.Mock()
+        cairosvg.svg2png.return_value = make_qr_png()
+        with mock.patch.object(rendering, 'get_cairosvg', return_value=cairosvg):
+            blocks = rendering.process_qr_blocks([svg, svg], 100, 100, 'flate')
+        self.assertEqual(cairosvg.svg2png.call_count, 1)
+        self.assertEqual(blocks[0].mode, 'L')
+
+
+class UploadValidationTests(UploadBatchMixin, MediaRootMixin, TestCase):
+
+    def test_rejected_files_are_reported(self):
+        response = self.upload_batch([make_qr_png("a"), b'not an image'])
+        self.assertEqual(response.status_code, 200)
+        report = response.context['report']
+        self.assertEqual([(entry['name'], entry['accepted']) for entry in report], [('qr0.png', True), ('qr1.png', False)])
+        self.assertEqual(report[0]['format'], 'PNG')
+        self.assertContains(response, 'Rejected: not a valid image')
+        self.assertContains(response, reverse('qrgen:download_pdf'))
+        self.assertEqual(QRBatchDjango.objects.get().blocks_total, 1)
+
+    def test_only_headers_are_read(self):
+        # A truncated PNG has a valid header: accepted here, skipped when it fails to render
+        from .uploads import sniff_qr_upload
+        entry = sniff_qr_upload(SimpleUploadedFile('qr.png', make_qr_png()[:100]))
+        self.assertTrue(entry['accepted'])
+        self.assertEqual((entry['width'], entry['height']), (132, 132))
+
+    @override_settings(QRGEN_MAX_QR_FILE_BYTES=1000, QRGEN_MAX_QR_PIXELS=100 * 100)
+    def test_per_file_limits(self):
+        from .uploads import sniff_qr_upload
+        big = sniff_qr_upload(SimpleUploadedFile('big.png', make_qr_png() + bytes(1000)))
+        self.assertEqual((big['accepted'], big['reason']), (False, 'larger than 1000\xa0bytes'))
+        tall = Image.new('L', (50, 400), 255)
+        buffer = BytesIO()
+        tall.save(buffer, format='PNG')
+        tall = sniff_qr_upload(SimpleUploadedFile('tall.png', buffer.getvalue()))
+        self.assertEqual((tall['accepted'], tall['reason']), (False, '50x400 pixels is too large'))
+
+    @override_settings(QRGEN_MAX_BATCH_BYTES=400)
+    def test_batch_over_the_limit_is_rejected(self):
+        response = self.upload_batch([make_qr_png("a"), make_qr_png("b")])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'more than the 400\xa0bytes allowed per batch')
+        self.assertFalse(QRBatchDjango.objects.exists())
+
+    @override_settings(QRGEN_MAX_BATCH_BYTES=100, QRGEN_MAX_QR_FILE_BYTES=100)
+    def test_oversized_request_is_refused_before_parsing(self):
+        response = self.upload_batch([make_qr_png("a")])
+        self.assertEqual(response.status_code, 413)
+        response = self.upload_batch([make_qr_png("a")], url='qrgen:submit_batch')
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(QRBatchDjango.objects.exists())
+
+    def test_nothing_valid_creates_no_batch(self):
+        response = self.upload_batch([b'junk'])
+        self.assertContains(response, 'Upload at least one valid QR image')
+        self.assertFalse(QRBatchDjango.objects.exists())
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_submit_batch_reports_files(self):
+        response = self.upload_batch([make_qr_png("a"), b'junk'], url='qrgen:submit_batch')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([entry['accepted'] for entry in response.json()['files']], [True, False])
+
+
+@override_settings(QRGEN_RENDER_WORKERS=0)
+class StoredPdfTests(UploadBatchMixin, MediaRootMixin, TestCase):
+
+    def download(self, **headers):
+        response = self.client.get(reverse('qrgen:download_pdf'), headers=headers)
+        content = streamed_content(response) if response.streaming else response.content
+        return response, content
+
+    def test_redownload_is_served_from_storage(self):
+        self.upload_batch([make_qr_png("a"), make_qr_png("b")])
+        first, pdf = self.download()
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        batch = QRBatchDjango.objects.get()
+        self.assertEqual(batch.generated_pdf.name, 'pdfs/%s.pdf' % first['ETag'].strip('"'))
+
+        with mock.patch('qrgen.pdf.draw_pages') as draw_pages:
+            second, again = self.download()
+            self.assertEqual(self.download(**{'If-None-Match': first['ETag']})[0].status_code, 304)
+        draw_pages.assert_not_called()
+        self.assertEqual((second['ETag'], again), (first['ETag'], pdf))
+
+    @override_settings(QRGEN_STREAM_PDF=True)
+    def test_streamed_pdf_is_stored_once_complete(self):
+        self.upload_batch([make_qr_png("a")])
+        first, pdf = self.download()
+        with mock.patch('qrgen.pdf.draw_pages') as draw_pages:
+            second, again = self.download()
+        draw_pages.assert_not_called()
+        self.assertEqual(again, pdf)
+
+    def test_range_requests(self):
+        self.upload_batch([make_qr_png("a")])
+        full, pdf = self.download()
+        partial, content = self.download(Range='bytes=10-19')
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial['Content-Range'], 'bytes 10-19/%d' % len(pdf))
+        self.assertEqual(content, pdf[10:20])
+        self.assertEqual(self.download(Range='bytes=-5')[1], pdf[-5:])
+        self.assertEqual(self.download(Range='bytes=%d-' % len(pdf))[0].status_code, 416)
+        # A range for another version of the file gets the whole file
+        response, content = self.download(Range='bytes=10-19', **{'If-Range': '"other"'})
+        self.assertEqual((response.status_code, content), (200, pdf))
+
+    def test_batches_with_the_same_inputs_share_the_pdf(self):
+        self.upload_batch([make_qr_png("a")])
+        first = self.download()[0]
+        self.upload_batch([make_qr_png("a")])
+        second = self.download()[0]
+        self.upload_batch([make_qr_png("b")])
+        third = self.download()[0]
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertNotEqual(first['ETag'], third['ETag'])
+        names = set(QRBatchDjango.objects.values_list('generated_pdf', flat=True))
+        self.assertEqual(len(names), 2)
+
+    def test_expired_pdfs_are_deleted_and_rendered_again(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .pdfstore import expire_stored_pdfs
+        self.upload_batch([make_qr_png("a")])
+        pdf = self.download()[1]
+        batch = QRBatchDjango.objects.get()
+        path = batch.generated_pdf.path
+        self.assertEqual(expire_stored_pdfs(), [])
+
+        with override_settings(QRGEN_PDF_RETENTION_SECONDS=60):
+            self.assertEqual(expire_stored_pdfs(timezone.now() + timedelta(seconds=61)), [batch.generated_pdf.name])
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(QRBatchDjango.objects.get().generated_pdf)
+        self.assertEqual(self.download()[1], pdf)
+        self.assertTrue(os.path.exists(path))
+
+    def test_inputs_are_hashed_on_upload(self):
+        from .pdfstore import input_digest
+        archive = SimpleUploadedFile('codes.zip', make_archive([('c.png', make_qr_png("c"))]),
+                                     content_type='application/zip')
+        self.upload_batch([make_qr_png("a"), make_qr_png("b")], qr_archive=archive, payload_text="d")
+        batch = QRBatchDjango.objects.get()
+        digest = batch.input_digest
+        self.assertEqual(len(digest), 64)
+        # Batches saved without a hash get the same one from their stored files
+        batch.input_digest = ''
+        self.assertEqual(input_digest(batch), digest)
+
+    def test_old_batches_are_deleted_with_their_files(self):
+        from datetime import timedelta
+        from django.core.management import call_command
+        from django.utils import timezone
+        from .pdfstore import expire_batches
+        self.upload_batch([make_qr_png("a"), make_qr_png("b")], payload_text="c")
+        batch = QRBatchDjango.objects.get()
+        paths = [batch.logo.path, batch.payloads.path] + [code.qr_image.path for code in batch.qrcodedjango_set.all()]
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        self.assertEqual(expire_batches(), 0)
+
+        later = timezone.now() + timedelta(days=8)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            out = io.StringIO()
+            call_command('expire_pdfs', stdout=out)
+        self.assertIn('and 1 batches', out.getvalue())
+        self.assertFalse(QRBatchDjango.objects.exists())
+        self.assertFalse(QRCodeDjango.objects.exists())
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+def make_archive(members, kind='zip'):
+    """Zip or tar.gz of (name, bytes) members, in order."""
+    import tarfile
+    import zipfile
+    buffer = BytesIO()
+    if kind == 'zip':
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, data in members:
+                archive.writestr(name, data)
+    else:
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, BytesIO(data))
+    return buffer.getvalue()
+
+
+@override_settings(QRGEN_RENDER_WORKERS=0)
+class ArchiveUploadTests(MediaRootMixin, TestCase):
+    def upload_archive(self, archive, name='codes.zip', url='qrgen:index'):
+        return self.client.post(reverse(url), {
+            'logo': SimpleUploadedFile('logo.png', make_logo_png(), content_type='image/png'),
+            'paper_size': 'A4',
+            'block_width_mm': 60,
+            'block_height_mm': 30,
+            'spacing_mm': 5,
+            'qr_archive': SimpleUploadedFile(name, archive),
+        })
+
+    def test_members_are_read_in_archive_order(self):
+        members = [('b.png', make_qr_png("b")), ('sub/a.png', make_qr_png("a")), ('c.svg', make_qr_svg("c"))]
+        for kind, name in (('zip', 'codes.zip'), ('tar', 'codes.tar.gz')):
+            response = self.upload_archive(make_archive(members, kind), name)
+            self.assertRedirects(response, reverse('qrgen:download_pdf'), fetch_redirect_response=False)
+            batch = QRBatchDjango.objects.get(pk=self.client.session['qr_batch_id'])
+            self.assertEqual(batch.blocks_total, 3)
+            self.assertEqual(list(batch.iter_qr_data()), [data for _, data in members])
+
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content.startswith(b'%PDF'))
+
+    def test_unsupported_members_are_reported_and_skipped(self):
+        archive = make_archive([('a.png', make_qr_png("a")), ('notes.txt', b'hello'),
+                                ('__MACOSX/._a.png', b'junk'), ('.DS_Store', b'junk')])
+        response = self.upload_archive(archive)
+        report = response.context['report']
+        self.assertEqual([(entry['name'], entry['accepted']) for entry in report],
+                         [('codes.zip', True), ('notes.txt', False)])
+        self.assertEqual(report[0]['members'], 1)
+        batch = QRBatchDjango.objects.get()
+        self.assertEqual(list(batch.iter_qr_data()), [make_qr_png("a")])
+
+    def test_unreadable_archive_is_rejected(self):
+        response = self.upload_archive(b'not an archive')
+        self.assertContains(response, 'not a readable zip or tar archive')
+        self.assertFalse(QRBatchDjango.objects.exists())
+
+    @override_settings(QRGEN_MAX_BATCH_BYTES=2000)
+    def test_unpacked_size_is_limited(self):
+        archive = make_archive([('a%d.png' % i, b'\0' * 600) for i in range(4)])
+        self.assertLess(len(archive), 2000)
+        response = self.upload_archive(archive)
+        self.assertContains(response, 'unpacks to more than')
+        self.assertFalse(QRBatchDjango.objects.exists())
+
+
+@override_settings(QRGEN_RENDER_WORKERS=0)
+class LogoPresetTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        from .logos import reset_renditions
+        from .models import LogoPreset
+        reset_renditions()
+        self.addCleanup(reset_renditions)
+        self.preset = LogoPreset.objects.create(
+            name='Acme', image=SimpleUploadedFile('acme.png', make_logo_png(), content_type='image/png'))
+
+    def upload(self, **data):
+        return self.client.post(reverse('qrgen:index'), dict({
+            'paper_size': 'A4',
+            'block_width_mm': 60,
+            'block_height_mm': 30,
+            'spacing_mm': 5,
+            'qr_images': [SimpleUploadedFile('qr.png', make_qr_png("a"), content_type='image/png')],
+        }, **data))
+
+    def test_batch_uses_the_preset_by_id(self):
+        response = self.upload(logo_preset=self.preset.pk)
+        self.assertRedirects(response, reverse('qrgen:download_pdf'), fetch_redirect_response=False)
+        batch = QRBatchDjango.objects.get()
+        self.assertEqual((batch.logo_preset, batch.logo.name), (self.preset, self.preset.image.name))
+        self.assertEqual(batch.pdf_args()[1], self.preset)
+        self.assertTrue(self.client.get(reverse('qrgen:download_pdf')).content.startswith(b'%PDF'))
+
+    def test_expiring_a_batch_keeps_the_preset_logo(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .pdfstore import expire_batches
+        self.upload(logo_preset=self.preset.pk)
+        self.assertEqual(expire_batches(timezone.now() + timedelta(days=8)), 1)
+        self.assertTrue(os.path.exists(self.preset.image.path))
+
+    def test_renditions_are_rendered_once_and_match_the_upload(self):
+        from .logos import reset_renditions
+        from .pdf import build_pdf
+        uploaded = build_pdf([make_qr_png("a")], make_logo_png(), 'A4', 60, 30, 5)
+        self.assertEqual(build_pdf([make_qr_png("a")], self.preset, 'A4', 60, 30, 5), uploaded)
+        # Another process finds the stored rendition instead of rendering it again
+        reset_renditions()
+        with mock.patch('qrgen.logos.prepare_logo') as prepare_logo:
+            self.assertEqual(build_pdf([make_qr_png("a")], self.preset, 'A4', 60, 30, 5), uploaded)
+            build_pdf([make_qr_png("a")], self.preset, 'A4', 60, 30, 5)
+        prepare_logo.assert_not_called()
+
+    def test_logo_or_preset_is_required(self):
+        self.assertContains(self.upload(), 'Upload a logo or choose a logo preset.')
+        response = self.upload(logo_preset=self.preset.pk + 1)
+        self.assertEqual(response.context['form'].errors['logo_preset'], ['Unknown logo preset.'])
+        self.assertFalse(QRBatchDjango.objects.exists())
+
+
+@override_settings(QRGEN_RENDER_WORKERS=0, QRGEN_MAX_CONCURRENT_RENDERS=1)
+class AsyncDownloadTests(UploadBatchMixin, MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        from .async_render import shutdown_render_executor
+        shutdown_render_executor()
+        self.addCleanup(shutdown_render_executor)
+        self.upload_batch([make_qr_png("a")])
+        self.async_client.cookies = self.client.cookies
+
+    @override_settings(QRGEN_RENDER_QUEUE_TIMEOUT=0.1)
+    def test_downloads_over_the_render_limit_are_refused(self):
+        from .async_render import acquire_render_slot
+        slots = async_to_sync(acquire_render_slot)()
+        try:
+            response = self.client.get(reverse('qrgen:download_pdf'))
+        finally:
+            slots.release()
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+        self.assertEqual(self.client.get(reverse('qrgen:download_pdf')).status_code, 200)
+
+    async def test_released_slot_is_handed_to_the_oldest_waiter(self):
+        import asyncio
+        from .async_render import RenderSlots
+        slots = RenderSlots(1)
+        self.assertTrue(await slots.acquire(0))
+        self.assertFalse(await slots.acquire(0.01))
+        first = asyncio.ensure_future(slots.acquire(5))
+        second = asyncio.ensure_future(slots.acquire(5))
+        await asyncio.sleep(0)
+        # Released from a render thread
+        await asyncio.to_thread(slots.release)
+        self.assertTrue(await first)
+        self.assertFalse(second.done())
+        slots.release()
+        self.assertTrue(await second)
+        slots.release()
+        with self.assertRaises(ValueError):
+            slots.release()
+
+    async def test_rendering_does_not_block_other_requests(self):
+        import asyncio
+        import threading
+        from . import pdf
+        started, finish = threading.Event(), threading.Event()
+        build_pdf = pdf.build_pdf
+
+        def slow_build_pdf(*args):
+            started.set()
+            finish.wait(5)
+            return build_pdf(*args)
+
+        with mock.patch('qrgen.pdf.build_pdf', slow_build_pdf):
+            download = asyncio.ensure_future(self.async_client.get(reverse('qrgen:download_pdf')))
+            await asyncio.to_thread(started.wait, 5)
+            page = await self.async_client.get(reverse('qrgen:index'))
+            self.assertEqual(page.status_code, 200)
+            self.assertFalse(download.done())
+            finish.set()
+            response = await download
+        self.assertTrue(response.content.startswith(b'%PDF'))
+
+    @override_settings(QRGEN_STREAM_PDF=True)
+    def test_abandoned_stream_frees_its_slot(self):
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertTrue(response.streaming)
+        response.close()
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertTrue(streamed_content(response).startswith(b'%PDF'))
+
+
+@override_settings(QRGEN_RENDER_WORKERS=0)
+class RasterSheetTests(UploadBatchMixin, MediaRootMixin, TestCase):
+    # 100 mm square blocks: two per row and two rows on A4, so five blocks make two pages
+    sheet_fields = dict(block_width_mm=100, block_height_mm=100)
+
+    def download_format(self, output_format, count=5):
+        self.upload_batch([make_qr_png("sheet %d" % i) for i in range(count)],
+                          output_format=output_format, **self.sheet_fields)
+        response = self.client.get(reverse('qrgen:download_pdf'))
+        self.assertEqual(response.status_code, 200)
+        return response, streamed_content(response)
+
+    def test_page_grid_matches_pdf_layout(self):
+        from .pdf import page_grid
+        self.assertEqual(page_grid('A4', 100, 100, 5)[:2], (2, 2))
+        self.assertEqual(page_grid('A4', 60, 30, 5)[:2], (3, 8))
+
+    def test_tiff_has_one_frame_per_page(self):
+        response, content = self.download_format('tiff')
+        self.assertEqual(response['Content-Type'], 'image/tiff')
+        self.assertIn('qrcodes.tiff', response['Content-Disposition'])
+        with Image.open(BytesIO(content)) as tiff:
+            self.assertEqual(tiff.n_frames, 2)
+            self.assertEqual(tiff.info['dpi'], (288, 288))
+            # A4 at 4 pixels per point
+            self.assertEqual(tiff.size, (2381, 3368))
+            # Black QR modules on white paper
+            self.assertEqual(tiff.convert('L').getextrema(), (0, 255))
+
+    def test_png_sheets_are_zipped_in_page_order(self):
+        import zipfile
+        response, content = self.download_format('png')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            self.assertEqual(archive.namelist(), ['page-0001.png', 'page-0002.png'])
+            with Image.open(BytesIO(archive.read('page-0002.png'))) as page:
+                self.assertEqual(page.mode, 'RGB')
+        batch = QRBatchDjango.objects.get()
+        self.assertTrue(batch.generated_pdf.name.endswith('.zip'))
+
+    def test_raster_pdf_has_one_image_per_page(self):
+        response, pdf = self.download_format('pdf_raster')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(pdf.count(b'/Type /Page '), 2)
+        self.assertEqual(pdf.count(b'/Subtype /Image'), 2)
+        self.assertTrue(xref_offsets_are_valid(pdf))
+
+    def test_blocks_are_scaled_to_their_slot(self):
+        from reportlab.lib.units import mm
+        from .pdf import PAPER_SIZE_MAP, page_grid
+        from .rendering import RENDER_SCALE
+        from .sheets import compose_page
+        grid_args = ('A4', 40, 20, 5)
+        qr_px = int(20 * mm * RENDER_SCALE), int(20 * mm * RENDER_SCALE)
+        # 290 px source for a 226 px slot: not reduced by the binarizer
+        block = rendering.process_qr_block(make_qr_png("hello", box_size=10), 20 * mm, 20 * mm, '1bit')
+        self.assertGreater(block.width, qr_px[0])
+        logo = Image.new('RGB', qr_px, (200, 30, 30))
+        page = Image.open(BytesIO(compose_page([block], logo, grid_args, 'png', 'flate', 85)))
+        _, _, x_start, y_start, _, _ = page_grid(*grid_args)
+        left = round(x_start * RENDER_SCALE)
+        top = round((PAPER_SIZE_MAP['A4'][1] - y_start - 20 * mm) * RENDER_SCALE)
+        slot = page.crop((left, top, left + qr_px[0], top + qr_px[1]))
+        self.assertEqual(slot.tobytes(), block.resize(qr_px, Image.NEAREST).convert('RGB').tobytes())
+        # Nothing spills into the spacing below the block
+        below = page.crop((left, top + qr_px[1] + 2, left + qr_px[0], top + qr_px[1] + 10))
+        self.assertEqual(below.getextrema(), ((255, 255),) * 3)
+
+    def test_formats_are_stored_separately(self):
+        first, _ = self.download_format('png', count=1)
+        second, _ = self.download_format('tiff', count=1)
+        self.assertNotEqual(first['ETag'], second['ETag'])
+
+    @override_settings(QRGEN_RENDER_WORKERS=2)
+    def test_pages_composited_in_workers_match_inline(self):
+        from .rendering import shutdown_process_pool
+        from .sheets import write_sheets
+        shutdown_process_pool()
+        self.addCleanup(shutdown_process_pool)
+        qr_data = [make_qr_png("sheet %d" % i) for i in range(9)]
+
+        def render():
+            output = BytesIO()
+            write_sheets(output, 'png', iter(qr_data), make_logo_png(), 'A4', 100, 100, 5)
+            return output.getvalue()
+
+        parallel = render()
+        with override_settings(QRGEN_RENDER_WORKERS=0):
+            self.assertEqual(render(), parallel)
+
+
+@override_settings(QRGEN_RENDER_WORKERS=0, QRGEN_BLOCK_CACHE_MAX_BYTES=0, QRGEN_CHECKPOINT_PAGES=1)
+class CheckpointTests(UploadBatchMixin, MediaRootMixin, TestCase):
+    # Four 100 mm blocks per A4 page: eleven make three pages
+    qr_data = [make_qr_png("checkpoint %d" % i) for i in range(11)]
+
+    def interrupted_render(self, digest, qr_data):
+        """Render until two pages are checkpointed, then stop as if the worker was killed."""
+        from .checkpoints import load_checkpoint, stream_pdf_checkpointed
+        chunks = stream_pdf_checkpointed(digest, iter(qr_data), make_logo_png(), 'A4', 100, 100, 5)
+        for _ in range(3):  # The header and two pages
+            next(chunks)
+        chunks.close()
+        state, parts = load_checkpoint(digest)
+        self.assertEqual((state['inputs'], len(parts)), (8, 2))
+
+    def test_resumed_render_matches_uninterrupted(self):
+        from .checkpoints import stream_pdf_checkpointed
+        from .pdf import stream_pdf
+        full = b''.join(stream_pdf(iter(self.qr_data), make_logo_png(), 'A4', 100, 100, 5))
+        self.interrupted_render('resume', self.qr_data)
+
+        progress = []
+        with mock.patch('qrgen.rendering.process_qr_blocks', side_effect=rendering.process_qr_blocks) as render:
+            resumed = b''.join(stream_pdf_checkpointed('resume', iter(self.qr_data), make_logo_png(), 'A4',
+                                                       100, 100, 5, progress=progress.append))
+        self.assertEqual(resumed, full)
+        # Only the inputs of the last page are rendered again
+        self.assertEqual(sum(len(call.args[0]) for call in render.call_args_list), 3)
+        self.assertEqual(progress[-1], 11)
+
+    def test_download_resumes_from_checkpoint_and_clears_it(self):
+        from .checkpoints import load_checkpoint
+        from .pdf import stream_pdf
+        from .pdfstore import pdf_digest
+        self.upload_batch(self.qr_data, block_width_mm=100, block_height_mm=100)
+        batch = QRBatchDjango.objects.get()
+        digest = pdf_digest(batch)
+        self.interrupted_render(digest, self.qr_data)
+
+        with mock.patch('qrgen.rendering.process_qr_blocks', side_effect=rendering.process_qr_blocks) as render:
+            response = self.client.get(reverse('qrgen:download_pdf'))
+            pdf = streamed_content(response)
+        self.assertEqual(sum(len(call.args[0]) for call in render.call_args_list), 3)
+        self.assertEqual(response['ETag'], '"%s"' % digest)
+        self.assertEqual(pdf, b''.join(stream_pdf(iter(self.qr_data), make_logo_png(), 'A4', 100, 100, 5)))
+        self.assertIsNone(load_checkpoint(digest))
+
+    def test_task_retries_after_soft_time_limit(self):
+        from celery.exceptions import SoftTimeLimitExceeded
+        from .tasks import _render_and_store, render_batch_pdf
+        calls = []
+
+        def time_out_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise SoftTimeLimitExceeded()
+            return _render_and_store(*args)
+
+        self.upload_batch(self.qr_data[:2], url='qrgen:submit_batch')
+        batch = QRBatchDjango.objects.get()
+        with mock.patch('qrgen.tasks._render_and_store', side_effect=time_out_once):
+            # apply() runs the retry straight away
+            render_batch_pdf.apply((batch.pk,), throw=False)
+        self.assertEqual(len(calls), 2)
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'done')
+
+    def test_task_fails_once_retries_are_exhausted(self):
+        from celery.exceptions import SoftTimeLimitExceeded
+        from .tasks import MAX_RETRIES, render_batch_pdf
+        self.upload_batch(self.qr_data[:2], url='qrgen:submit_batch')
+        batch = QRBatchDjango.objects.get()
+        with mock.patch('qrgen.tasks._render_and_store', side_effect=SoftTimeLimitExceeded()) as render:
+            # Run as the last retry; an eager retry would propagate celery.exceptions.Retry
+            result = render_batch_pdf.apply((batch.pk,), retries=MAX_RETRIES, throw=False)
+        self.assertEqual(render.call_count, 1)
+        self.assertIsInstance(result.result, SoftTimeLimitExceeded)
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'failed')
+
+    def test_abandoned_checkpoints_expire(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .checkpoints import expire_checkpoints, load_checkpoint
+        self.interrupted_render('abandoned', self.qr_data)
+        self.assertEqual(expire_checkpoints(), [])
+        self.assertEqual(expire_checkpoints(timezone.now() + timedelta(days=30)), ['abandoned'])
+        self.assertIsNone(load_checkpoint('abandoned'))
+
+
+class LoadtestCommandTests(MediaRootMixin, LiveServerTestCase):
+    def test_loadtest_reports_latency_against_running_server(self):
+        from django.core.management import call_command
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'load.json')
+            # One client: the live server shares a single in-memory sqlite connection between threads
+            call_command('loadtest', url=self.live_server_url, clients=1, flows=3, batch_size=2,
+                         output=output, stdout=io.StringIO())
+            with open(output) as f:
+                report = json.load(f)
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(report['succeeded'], 3)
+        self.assertEqual(set(report['latency_seconds']), {'flow', 'upload', 'download'})
+        self.assertLessEqual(report['latency_seconds']['flow']['p50'], report['latency_seconds']['flow']['p99'])
+        self.assertGreater(report['download_mb_per_second'], 0)
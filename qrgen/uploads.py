@@ -0,0 +1,86 @@
+"""
+Validation of uploaded QR images. Only the headers are read (format and
+dimensions), in a thread pool, and size limits are checked before any file
+is opened so oversized batches are turned away straight away.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.template.defaultfilters import filesizeformat
+
+QR_EXTENSIONS = ('png', 'jpg', 'jpeg', 'svg')
+RASTER_FORMATS = ('PNG', 'JPEG')
+
+# Bytes read from an SVG upload to recognise it
+SVG_SNIFF_BYTES = 4096
+
+
+def request_too_large(request):
+    """True if the request body alone is over the batch limit, before it is parsed."""
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return False
+    # Leave room for the other form fields and the multipart framing
+    return length > settings.QRGEN_MAX_BATCH_BYTES + settings.QRGEN_MAX_QR_FILE_BYTES
+
+
+def _sniff_svg(upload):
+    head = upload.read(SVG_SNIFF_BYTES).lstrip(b'\xef\xbb\xbf \t\r\n')
+    if not head.startswith((b'<?xml', b'<svg', b'<!DOCTYPE svg', b'<!--')) or b'<svg' not in head:
+        return "not an SVG image"
+    return None
+
+
+def sniff_qr_upload(upload):
+    """Check one upload from its header; returns its report entry."""
+    entry = {'name': upload.name, 'size': upload.size, 'accepted': False, 'reason': None}
+    ext = upload.name.rsplit('.', 1)[-1].lower() if '.' in upload.name else ''
+    if ext not in QR_EXTENSIONS:
+        entry['reason'] = "unsupported file type"
+        return entry
+    if upload.size > settings.QRGEN_MAX_QR_FILE_BYTES:
+        entry['reason'] = "larger than %s" % filesizeformat(settings.QRGEN_MAX_QR_FILE_BYTES)
+        return entry
+    try:
+        upload.seek(0)
+        if ext == 'svg':
+            entry['format'] = 'SVG'
+            entry['reason'] = _sniff_svg(upload)
+        else:
+            from PIL import Image
+            # Image.open only parses the header; pixel data is never decoded here
+            with Image.open(upload) as img:
+                entry['format'] = img.format
+                entry['width'], entry['height'] = img.size
+            if img.format not in RASTER_FORMATS:
+                entry['reason'] = "unsupported image format %s" % img.format
+            elif img.width * img.height > settings.QRGEN_MAX_QR_PIXELS:
+                entry['reason'] = "%dx%d pixels is too large" % img.size
+    except Exception:
+        entry['reason'] = "not a valid image"
+    finally:
+        upload.seek(0)
+    entry['accepted'] = entry['reason'] is None
+    return entry
+
+
+def validate_qr_uploads(uploads):
+    """
+    Validate the uploaded QR images of one batch.
+
+    Returns (accepted uploads, report, error): the report has one entry per
+    upload in order, and ``error`` is set (with nothing accepted) when the
+    batch as a whole is over the limits.
+    """
+    total = sum(upload.size for upload in uploads)
+    if total > settings.QRGEN_MAX_BATCH_BYTES:
+        error = "The QR images add up to %s, more than the %s allowed per batch." % (
+            filesizeformat(total), filesizeformat(settings.QRGEN_MAX_BATCH_BYTES))
+        return [], [], error
+    if not uploads:
+        return [], [], None
+    workers = max(1, min(settings.QRGEN_UPLOAD_VALIDATION_THREADS, len(uploads)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        report = list(executor.map(sniff_qr_upload, uploads))
+    accepted = [upload for upload, entry in zip(uploads, report) if entry['accepted']]
+    return accepted, report, None
@@ -6,4 +6,8 @@ app_name = 'qrgen'
 urlpatterns = [
     path('', views.index, name='index'),
     path('download/', views.download_pdf, name='download_pdf'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('batches/', views.submit_batch, name='submit_batch'),
+    path('batches/<int:batch_id>/status/', views.batch_status, name='batch_status'),
+    path('batches/<int:batch_id>/download/', views.batch_download, name='batch_download'),
 ]
\ No newline at end of file
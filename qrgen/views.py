@@ -1,251 +1,363 @@
-import datetime
 import logging
-import os
-import base64
-try:
-    import cairosvg
-    CAIRO_AVAILABLE = True
-except ImportError:
-    CAIRO_AVAILABLE = False
-    print("Warning: cairosvg not available, PDF features will be limited")      
+import tempfile
+from functools import partial
 from io import BytesIO
-from PIL import Image, ImageFilter, ImageEnhance
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4, A3, A2
-from reportlab.lib.units import mm
-from reportlab.lib.utils import ImageReader
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_POST
 from django import forms
-from concurrent.futures import ProcessPoolExecutor
-import multiprocessing
-from functools import partial
-
-# Initialize process pool at module level for Windows compatibility
-def initialize_process_pool():
-    if os.name == 'nt':  # Windows
-        multiprocessing.set_start_method('spawn', force=True)
-    else:
-        multiprocessing.set_start_method('fork', force=True)
-
-try:
-    initialize_process_pool()
-except RuntimeError:
-    # Process pool already initialized
-    pass
-
-USE_MONGODB = None
-ObjectId = None
+from django.template.defaultfilters import filesizeformat
+from .metrics import RequestTimer, render_prometheus, stage
+from .archives import scan_qr_archive
+from .async_render import RenderBusy, RenderStream, acquire_render_slot, run_in_render_thread
+from .checkpoints import checkpointed, stream_pdf_checkpointed
+from .payloads import PayloadError, spool_payloads
+from .pdfstore import (hash_inputs, input_digest, not_modified, pdf_digest, pdf_file_response, store_pdf,
+                       stored_pdf, stored_pdf_digest)
+from .rendering import BLOCK_ENCODINGS, OUTPUT_FORMATS
+from .uploads import request_too_large, validate_qr_uploads
 
 logger = logging.getLogger(__name__)
-PAPER_SIZE_MAP = {'A4': A4, 'A3': A3, 'A2': A2}
 
 class QRBatchForm(forms.Form):
-    logo = forms.ImageField(required=True)
+    # Either an uploaded logo or the ID of a LogoPreset
+    logo = forms.ImageField(required=False)
+    logo_preset = forms.IntegerField(required=False, label="Logo Preset")
     paper_size = forms.ChoiceField(choices=[('A4', 'A4'), ('A3', 'A3'), ('A2', 'A2')])
     block_width_mm = forms.FloatField(min_value=10, label="Block Width (mm)")
     block_height_mm = forms.FloatField(min_value=10, label="Block Height (mm)")
     spacing_mm = forms.FloatField(min_value=0, label="Spacing Between Blocks (mm)", initial=5)
+    # Left blank, QRGEN_BLOCK_ENCODING / QRGEN_OUTPUT_FORMAT apply
+    output_encoding = forms.ChoiceField(choices=[('', "Server default")] + BLOCK_ENCODINGS, required=False,
+                                        label="Output Encoding")
+    output_format = forms.ChoiceField(choices=[('', "Server default")] + OUTPUT_FORMATS, required=False,
+                                      label="Output Format")
+    # A zip or tar of QR images; lifts the per-request file count limit of multipart uploads
+    qr_archive = forms.FileField(required=False, label="QR Image Archive (zip or tar)")
+    # Payloads to encode as QR codes, as an alternative to uploading QR images
+    payload_file = forms.FileField(required=False, label="Payload CSV / Text File")
+    payload_text = forms.CharField(widget=forms.Textarea, required=False, label="Payloads (one per line)")
+
+    def clean_logo_preset(self):
+        from .models import LogoPreset
+        preset_id = self.cleaned_data['logo_preset']
+        if preset_id is None:
+            return None
+        preset = LogoPreset.objects.filter(pk=preset_id).first()
+        if preset is None:
+            raise forms.ValidationError("Unknown logo preset.")
+        return preset
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('logo') and not cleaned_data.get('logo_preset') and 'logo_preset' not in self.errors:
+            self.add_error(None, "Upload a logo or choose a logo preset.")
+        return cleaned_data
+
+
+def _create_batch(request, form):
+    """
+    Spool the uploads to storage once. Returns the new QRBatchDjango, or
+    None after adding the reason to ``form``, and the per-file upload report.
+    """
+    # Import models here to avoid multiprocessing import issues
+    from .logos import file_digest
+    from .models import QRBatchDjango, QRCodeDjango
+    # Get logo and QR images directly from upload; a preset's logo file is shared, not copied
+    logo_preset = form.cleaned_data['logo_preset']
+    logo_file = logo_preset.image.name if logo_preset else form.cleaned_data['logo']
+    valid_images, report, error = validate_qr_uploads(request.FILES.getlist('qr_images'))
+    if error:
+        form.add_error(None, error)
+        return None, report
+
+    archive = form.cleaned_data['qr_archive']
+    archive_count = 0
+    if archive is not None:
+        archive_count, archive_report, error = scan_qr_archive(archive)
+        report += archive_report
+        if error:
+            form.add_error(None, error)
+            return None, report
+        if not archive_count:
+            archive = None
+
+    try:
+        payloads, payload_count = spool_payloads(form.cleaned_data['payload_file'],
+                                                 form.cleaned_data['payload_text'])
+    except PayloadError as e:
+        form.add_error(None, str(e))
+        return None, report
+    if not valid_images and not archive_count and not payload_count:
+        form.add_error(None, "Upload at least one valid QR image or enter some payloads.")
+        return None, report
 
-def index(request):
+    batch = QRBatchDjango(
+        logo=logo_file,
+        logo_preset=logo_preset,
+        paper_size=form.cleaned_data['paper_size'],
+        block_width_mm=form.cleaned_data['block_width_mm'],
+        block_height_mm=form.cleaned_data['block_height_mm'],
+        spacing_mm=form.cleaned_data['spacing_mm'],
+        output_encoding=form.cleaned_data['output_encoding'] or settings.QRGEN_BLOCK_ENCODING,
+        output_format=form.cleaned_data['output_format'] or settings.QRGEN_OUTPUT_FORMAT,
+        payloads=payloads,
+        qr_archive=archive,
+        blocks_total=len(valid_images) + archive_count + payload_count,
+    )
+    # Hashed from the uploads at hand, so the first download does not read every input back
+    with stage('hash'):
+        logo_digest = logo_preset.digest if logo_preset else file_digest(logo_file)
+        batch.input_digest = hash_inputs(batch, logo_digest, valid_images, archive, payloads)
+    with transaction.atomic():
+        batch.save()
+        QRCodeDjango.objects.bulk_create(
+            [QRCodeDjango(batch=batch, qr_image=img) for img in valid_images])
+    return batch, report
+
+
+def _too_large_message():
+    return "The upload is larger than the %s allowed per batch." % filesizeformat(settings.QRGEN_MAX_BATCH_BYTES)
+
+
+def _render_index(request, context, status=200):
+    from .models import LogoPreset
+    context['logo_presets'] = LogoPreset.objects.all()
+    return render(request, 'qrgen/index.html', context, status=status)
+
+
+def _index(request):
+    report = []
     if request.method == 'POST':
-        # Import models here to avoid multiprocessing import issues
         form = QRBatchForm(request.POST, request.FILES)
         if form.is_valid():
-            # Get logo and QR images directly from upload
-            logo_file = form.cleaned_data['logo']
-            qr_images = request.FILES.getlist('qr_images')
-            qr_data_list = []
-            for img in qr_images:
-                ext = img.name.split('.')[-1].lower()
-                if ext not in ['png', 'jpg', 'jpeg', 'svg']:
-                    continue
-                if ext != 'svg':
-                    try:
-                        img.seek(0)
-                        with Image.open(img) as test_img:
-                            test_img.verify()  # Will raise if not a valid image
-                    except Exception:
-                        continue
-                qr_data_list.append(img.read())
-
-            # Store everything in session for download (stateless)
-            request.session['logo_bytes'] = base64.b64encode(logo_file.read()).decode('ascii')
-            request.session['paper_size'] = form.cleaned_data['paper_size']
-            request.session['block_width_mm'] = form.cleaned_data['block_width_mm']
-            request.session['block_height_mm'] = form.cleaned_data['block_height_mm']
-            request.session['spacing_mm'] = form.cleaned_data['spacing_mm']
-            request.session['qr_data_list'] = [img.decode('latin1') for img in qr_data_list]
-            return redirect('qrgen:download_pdf')
+            batch, report = _create_batch(request, form)
+            if batch is not None:
+                # The session only keeps the batch id
+                request.session['qr_batch_id'] = batch.pk
+                if all(entry['accepted'] for entry in report):
+                    return redirect('qrgen:download_pdf')
+                # Show which files were left out before the download
+                return _render_index(request, {
+                    'form': QRBatchForm(), 'report': report, 'download_url': reverse('qrgen:download_pdf')})
     else:
         form = QRBatchForm()
-    return render(request, 'qrgen/index.html', {'form': form})
+    return _render_index(request, {'form': form, 'report': report})
 
 
-def process_qr_block(img_str, qr_width, qr_height, logo_width, logo_height, block_w, block_h, spacing_between_qr_logo, final_logo_bytes):
-    """Process a single QR code block"""
-    try:
-        # Detect if the input is SVG
-        is_svg = img_str.startswith('<?xml') or img_str.startswith('<svg')
-        
-        if is_svg:
-            # Handle SVG input
-            if CAIRO_AVAILABLE:
-                img_data = cairosvg.svg2png(bytestring=img_str.encode('utf-8'), 
-                                          output_width=int(qr_width * 4), 
-                                          output_height=int(qr_height * 4), 
-                                          dpi=1200)
-            else:
-                # Fallback: generate PNG QR code instead
-                import qrcode
-                qr = qrcode.QRCode(version=1, box_size=10, border=4)
-                qr.add_data("fallback")
-                qr.make(fit=True)
-                qr_pil = qr.make_image(fill_color="black", back_color="white")
-                buffer = BytesIO()
-                qr_pil.save(buffer, format='PNG')
-                img_data = buffer.getvalue()
-        else:
-            # Handle binary input
-            img_data = img_str.encode('latin1')
-            
-        # Open and process QR code efficiently
-        with Image.open(BytesIO(img_data)) as qr_img:
-            qr_img = qr_img.convert("RGBA")
-            # Use BICUBIC for better performance, still good quality
-            qr_img = qr_img.resize((int(qr_width * 4), int(qr_height * 4)), 
-                                 resample=Image.Resampling.BICUBIC)
-            
-            # Only enhance if it's not an SVG (SVGs are usually sharp already)
-            if not is_svg:
-                qr_img = qr_img.filter(ImageFilter.UnsharpMask(radius=0.5, 
-                                                              percent=120, 
-                                                              threshold=2))
-                qr_img = ImageEnhance.Contrast(qr_img).enhance(1.2)
-            
-            # Create combined image
-            combined = Image.new("RGBA", (int(block_w * 4), int(block_h * 4)), 
-                               (255, 255, 255, 255))
-            combined.paste(qr_img, (0, 0), qr_img)
-            
-            # Add logo at a fixed pixel offset (not scaled)
-            with Image.open(BytesIO(final_logo_bytes)) as final_logo:
-                final_logo = final_logo.convert("RGBA")
-                fixed_spacing_px = 0  # Change this value for desired spacing
-                combined.paste(final_logo, 
-                             (int(qr_width * 4) + fixed_spacing_px, 0), 
-                             final_logo)
-
-        img_io = BytesIO()
-        combined.convert("RGB").save(img_io, format='TIFF', compression='lzw', dpi=(1200, 1200))
-        img_io.seek(0)
-        return img_io
-    except Exception:
+async def index(request):
+    if request.method == 'POST' and request_too_large(request):
+        # Turned away before the body is parsed
+        return await sync_to_async(_render_index)(
+            request, {'form': QRBatchForm(), 'upload_error': _too_large_message()}, status=413)
+    # The body has already been read without blocking the event loop; parsing
+    # it, checking the uploads and saving the batch use files and the
+    # database, so they run in a thread
+    return await sync_to_async(_index)(request)
+
+
+def _download_batch(request):
+    """The session's batch, hashed, or None if it has nothing to render."""
+    from .models import QRBatchDjango
+    batch = QRBatchDjango.objects.filter(pk=request.session.get('qr_batch_id')).first()
+    if batch is None or not (batch.payloads or batch.qr_archive or batch.qrcodedjango_set.exists()):
         return None
+    input_digest(batch)
+    return batch
 
-def download_pdf(request):
-    # Get everything from session
-    logo_bytes = base64.b64decode(request.session.get('logo_bytes'))
-    paper_size = request.session.get('paper_size')
-    block_width_mm = request.session.get('block_width_mm')
-    block_height_mm = request.session.get('block_height_mm')
-    spacing_mm = request.session.get('spacing_mm')
-    qr_data_list_raw = request.session.get('qr_data_list')
-    if not logo_bytes or not qr_data_list_raw:
-        return HttpResponse("No batch found", status=404)
 
-    qr_data_list = qr_data_list_raw  # List of latin1-encoded strings
+def _stored_download(batch, digest):
+    """Name of the stored PDF for ``digest``, linked to ``batch``, or None."""
+    name = stored_pdf(digest, batch.output_format)
+    if name is not None and batch.generated_pdf.name != name:
+        batch.generated_pdf.name = name
+        batch.save(update_fields=['generated_pdf'])
+    return name
+
 
-    response = HttpResponse(content_type='application/pdf')
+async def download_pdf(request):
+    # reportlab is only loaded by the first download, not at worker boot
+    from .pdf import build_pdf, stream_pdf
+    timer = RequestTimer('download_pdf')
+    streaming = False
+    try:
+        with timer:
+            with stage('load'):
+                batch = await sync_to_async(_download_batch)(request)
+            if batch is None:
+                timer.finish()
+                return HttpResponse("No batch found", status=404)
+            digest = pdf_digest(batch)
+            response = not_modified(request, digest)
+            # Re-downloads, resumed transfers and batches with the same inputs
+            # are answered from the stored PDF
+            name = await sync_to_async(_stored_download)(batch, digest) if response is None else None
+            if name is not None:
+                response = await sync_to_async(pdf_file_response)(request, name, digest)
+            elif response is None:
+                # Rendering runs in a render thread once a slot is free; the
+                # event loop keeps serving other clients meanwhile
+                slots = await acquire_render_slot()
+                try:
+                    pdf_args = await sync_to_async(batch.pdf_args)()
+                except BaseException:
+                    slots.release()
+                    raise
+                resumable = checkpointed(batch)
+                if settings.QRGEN_STREAM_PDF and batch.output_format == 'pdf':
+                    if resumable:
+                        stream_pdf = partial(stream_pdf_checkpointed, digest)
+                    response = _streaming_pdf_response(batch, digest, stream_pdf, pdf_args, timer)
+                    streaming = True
+                elif batch.output_format != 'pdf' or resumable:
+                    # Raster formats (a TIFF is patched up as pages are
+                    # appended) and large PDFs, which save checkpoints as they
+                    # go, are written to a spool and served once stored
+                    with tempfile.TemporaryFile() as spool:
+                        try:
+                            await run_in_render_thread(_write_document, spool, batch, digest, pdf_args)
+                        finally:
+                            slots.release()
+                        with stage('store'):
+                            spool.seek(0)
+                            name = await sync_to_async(store_pdf)(batch, digest, spool)
+                    response = await sync_to_async(pdf_file_response)(request, name, digest)
+                else:
+                    try:
+                        pdf = await run_in_render_thread(build_pdf, *pdf_args)
+                    finally:
+                        slots.release()
+                    with stage('store'):
+                        await sync_to_async(store_pdf)(batch, digest, BytesIO(pdf))
+                    response = HttpResponse(pdf, content_type='application/pdf')
+                    response['Content-Disposition'] = 'attachment; filename="qrcodes.pdf"'
+    except RenderBusy:
+        timer.finish()
+        response = HttpResponse("Too many PDFs are being rendered, please try again shortly.", status=503)
+        response['Retry-After'] = max(1, round(settings.QRGEN_RENDER_QUEUE_TIMEOUT))
+        return response
+    if not streaming:
+        timer.finish()
+    response['Server-Timing'] = timer.server_timing()
+    response['ETag'] = quote_etag(digest)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _write_document(spool, batch, digest, pdf_args):
+    """Render a raster format, or a PDF with checkpoints, into ``spool``."""
+    from .sheets import write_sheets
+    if batch.output_format != 'pdf':
+        write_sheets(spool, batch.output_format, *pdf_args)
+        return
+    for chunk in stream_pdf_checkpointed(digest, *pdf_args):
+        spool.write(chunk)
+
+
+def _streaming_pdf_response(batch, digest, stream_pdf, pdf_args, timer):
+    """
+    Pages are sent as soon as they are finished, so memory stays bounded by
+    the page being drawn instead of the size of the batch. Headers go out
+    before rendering starts, so only the stages so far are in Server-Timing;
+    the rest is still recorded in the metrics. The PDF is spooled to a
+    temporary file and stored once the last page has been sent.
+    """
+    spool = tempfile.TemporaryFile()
+
+    def render_chunks():
+        for chunk in stream_pdf(*pdf_args):
+            spool.write(chunk)
+            yield chunk
+
+    async def store():
+        spool.seek(0)
+        await sync_to_async(store_pdf)(batch, digest, spool)
+
+    def close():
+        spool.close()
+        timer.finish()
+
+    response = StreamingHttpResponse(RenderStream(render_chunks, on_complete=store, on_close=close),
+                                     content_type='application/pdf')
     response['Content-Disposition'] = 'attachment; filename="qrcodes.pdf"'
-    buffer = BytesIO()
-    page_size = PAPER_SIZE_MAP[paper_size]
-    c = canvas.Canvas(buffer, pagesize=page_size)
-
-    # Block dimensions
-    block_w = float(block_width_mm) * mm
-    block_h = float(block_height_mm) * mm
-    spacing_between_blocks = float(spacing_mm) * mm
-
-    # Hardcoded space between QR and logo
-    spacing_between_qr_logo = 5
-    qr_width = logo_width = block_w / 2
-    qr_height = logo_height = block_h
-
-    full_block_w = block_w
-    full_block_h = block_h
-
-    blocks_per_row = max(1, int((page_size[0] + spacing_between_blocks) // (full_block_w + spacing_between_blocks)))
-    x_margin = (page_size[0] - (blocks_per_row * (full_block_w + spacing_between_blocks) - spacing_between_blocks)) / 2
-    x_start = x_margin
-    y_start = page_size[1] - spacing_between_blocks - full_block_h
-
-    # Process logo once
-    logo_stream = BytesIO(logo_bytes)
-    logo_original = Image.open(logo_stream).convert("RGBA")
-    logo_aspect = logo_original.width / logo_original.height
-    target_logo_width_px = int(logo_width * 4)
-    target_logo_height_px = int(logo_height * 4)
-
-    if logo_aspect >= 1:
-        new_logo_width = target_logo_width_px
-        new_logo_height = int(target_logo_width_px / logo_aspect)
-    else:
-        new_logo_height = target_logo_height_px
-        new_logo_width = int(target_logo_height_px * logo_aspect)
-
-    logo_resized = logo_original.resize((new_logo_width, new_logo_height), resample=Image.Resampling.BILINEAR)
-
-    final_logo = Image.new("RGBA", (target_logo_width_px, target_logo_height_px), (255, 255, 255, 255))
-    final_logo.paste(logo_resized, ((target_logo_width_px - new_logo_width) // 2,
-                                    (target_logo_height_px - new_logo_height) // 2), logo_resized)
-
-    final_logo_bytes = BytesIO()
-    final_logo.save(final_logo_bytes, format='PNG', optimize=True)
-    final_logo_bytes = final_logo_bytes.getvalue()
-
-    # Cleanup
-    logo_original.close()
-    logo_resized.close()
-    logo_stream.close()
-
-    row = 0
-    col = 0
-    x = x_start
-    y = y_start
-
-    for img_str in qr_data_list:
-        img_io = process_qr_block(img_str, qr_width, qr_height, logo_width, logo_height, 
-                                  block_w, block_h, spacing_between_qr_logo, final_logo_bytes)
-        if img_io is None:
-            continue
-
-        # Position
-        x = x_start + col * (full_block_w + spacing_between_blocks)
-        y = y_start - row * (full_block_h + spacing_between_blocks)
-
-        if y < spacing_between_blocks:
-            c.showPage()
-            row = 0
-            col = 0
-            x = x_start
-            y = y_start
-
-        img_io.seek(0)
-        # Save as JPEG to reduce memory
-        with Image.open(img_io) as im:
-            out_io = BytesIO()
-            im.convert("RGB").save(out_io, format='JPEG', quality=85, dpi=(300, 300))
-            out_io.seek(0)
-            c.drawImage(ImageReader(out_io), x, y, full_block_w, full_block_h, mask='auto')
-
-        img_io.close()
-        col = (col + 1) % blocks_per_row
-        if col == 0:
-            row += 1
-
-    c.save()
-    pdf = buffer.getvalue()
-    buffer.close()
-    response.write(pdf)
     return response
+
+
+def metrics(request):
+    """Stage and request timings of this worker process in the Prometheus text format."""
+    if request.META.get('REMOTE_ADDR') not in settings.QRGEN_METRICS_ALLOWED_IPS:
+        return HttpResponse("Forbidden", status=403)
+    from .cache import get_block_cache
+    extra_lines = []
+    cache = get_block_cache()
+    if cache is not None:
+        stats = cache.stats()
+        extra_lines.append('# HELP qrgen_block_cache_hits_total Rendered blocks served from the block cache.')
+        extra_lines.append('# TYPE qrgen_block_cache_hits_total counter')
+        extra_lines.append('qrgen_block_cache_hits_total{tier="memory"} %d' % stats['memory_hits'])
+        extra_lines.append('qrgen_block_cache_hits_total{tier="disk"} %d' % stats['disk_hits'])
+        extra_lines.append('# HELP qrgen_block_cache_misses_total Rendered blocks not found in the block cache.')
+        extra_lines.append('# TYPE qrgen_block_cache_misses_total counter')
+        extra_lines.append('qrgen_block_cache_misses_total %d' % stats['misses'])
+    return HttpResponse(render_prometheus(extra_lines), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _session_batch(request, batch_id):
+    """A batch submitted from this session, or None."""
+    from .models import QRBatchDjango
+    if batch_id not in request.session.get('qr_submitted_batch_ids', []):
+        return None
+    return QRBatchDjango.objects.filter(pk=batch_id).first()
+
+
+def _batch_status_data(batch):
+    return {
+        'id': batch.pk,
+        'status': batch.status,
+        'blocks_done': batch.blocks_done,
+        'blocks_total': batch.blocks_total,
+        'status_url': reverse('qrgen:batch_status', args=[batch.pk]),
+        'download_url': reverse('qrgen:batch_download', args=[batch.pk]),
+    }
+
+
+@require_POST
+def submit_batch(request):
+    """Queue a batch for background rendering; poll batch_status for progress."""
+    from .tasks import render_batch_pdf
+    if request_too_large(request):
+        return JsonResponse({'errors': {'__all__': [_too_large_message()]}}, status=413)
+    form = QRBatchForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    batch, report = _create_batch(request, form)
+    if batch is None:
+        return JsonResponse({'errors': form.errors, 'files': report}, status=400)
+    transaction.on_commit(lambda: render_batch_pdf.delay(batch.pk))
+    request.session['qr_submitted_batch_ids'] = request.session.get('qr_submitted_batch_ids', []) + [batch.pk]
+    return JsonResponse(dict(_batch_status_data(batch), files=report), status=202)
+
+
+def batch_status(request, batch_id):
+    batch = _session_batch(request, batch_id)
+    if batch is None:
+        return JsonResponse({'error': 'No batch found'}, status=404)
+    return JsonResponse(_batch_status_data(batch))
+
+
+def batch_download(request, batch_id):
+    batch = _session_batch(request, batch_id)
+    if batch is None:
+        return HttpResponse("No batch found", status=404)
+    if batch.status == 'done' and not batch.generated_pdf:
+        # Deleted after QRGEN_PDF_RETENTION_SECONDS
+        return JsonResponse(_batch_status_data(batch), status=410)
+    if batch.status != 'done':
+        return JsonResponse(_batch_status_data(batch), status=409)
+    digest = stored_pdf_digest(batch.generated_pdf.name)
+    return not_modified(request, digest) or pdf_file_response(request, batch.generated_pdf.name, digest)